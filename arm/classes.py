@@ -1,4 +1,3 @@
-import pyudev
 import os
 import logging
 import fcntl
@@ -18,10 +17,18 @@ class Disc(object):
         label
         disctype
         errors
+        titles
+        plan
+        mainfeature
+        job
+        identification
 
     Methods:
         __init__(self, devpath)
         __str__(self)
+        dump(self)
+        restore(self, state)
+        wait_identified(self)
         parse_udev(self)
         eject(self)
         drive_status(self)
@@ -45,6 +52,12 @@ class Disc(object):
         self.label = ""
         self.disctype = ""
         self.errors = []
+        self.titles = {}
+        self.plan = []
+        # whether only the main feature is processed, once decided (see Ripper.admit)
+        self.mainfeature = None
+        self.job = None
+        self.identification = None
         self.parse_udev()
 
     def __str__(self):
@@ -63,6 +76,49 @@ class Disc(object):
 
         return s
 
+    def dump(self):
+        """
+        Returns the disc attributes that are saved with the disc's job
+
+        Parameters:
+        None
+
+        Return value: dict of attribute names and values
+        """
+
+        return dict((attr, value) for attr, value in self.__dict__.items() if attr not in ["job", "identification"])
+
+    def restore(self, state):
+        """
+        Restores disc attributes saved with dump()
+
+        Parameters:
+        state: dict returned by dump()
+
+        Return value: None
+        """
+
+        for attr, value in state.items():
+            setattr(self, attr, value)
+        # JSON turns the title numbers into strings
+        self.titles = dict((int(title), info) for title, info in self.titles.items())
+
+    def wait_identified(self):
+        """
+        Wait for the title lookup started by identify.identify_async, if any,
+        and apply its result.  Returns right away if the disc is identified.
+
+        Parameters:
+        None
+
+        Return value: None
+        """
+
+        if self.identification is not None:
+            identification = self.identification
+            self.identification = None
+            identification.wait(self)
+
     def parse_udev(self):
         """
         Parse udev for properties of current disc
@@ -73,6 +129,7 @@ class Disc(object):
         Return Value: None
         """
 
+        import pyudev
         logging.debug("**** Logging udev attributes ****")
         context = pyudev.Context()
         device = pyudev.Devices.from_device_file(context, self.devpath)
@@ -1,30 +1,406 @@
 #!/usr/bin/python3
 
-# import os
-# import re
-import yaml
-
-yamlfile = "/etc/arm/arm.yaml"
-# cfgfile = "/etc/arm/arm.conf"
-
-# if os.path.exists(yamlfile):
-#     try:
-#         os.remove(yamlfile)
-#     except OSError:
-#         err = "Could not delete .yaml path at:  " + yamlfile + " Probably a permissions error.  Exiting"
-#         print(err)
-#         raise ValueError(err, "config")
-
-
-# with open(cfgfile, 'r') as f:
-#     with open(yamlfile, 'w') as of:
-#         for line in f:
-#             if '#' not in line and line.strip():
-#                 # print(line.strip())
-#                 line = re.sub("true", "\"true\"", line)
-#                 line = re.sub("false", "\"false\"", line)
-#                 line = re.sub("=", ": ", line, 1)
-#                 of.writelines(line)
-
-with open(yamlfile, "r") as f:
-    cfg = yaml.load(f, Loader=yaml.FullLoader)
+import os
+import marshal
+import logging
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+
+class ConfigError(Exception):
+    """
+    Raised when the config file can't be read or has values of the wrong type
+    """
+
+
+def boolean(value):
+    """ true/false, also accepting the quoted "true" and "false" of old config files """
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.strip().lower() in ("true", "yes", "on", "1"):
+        return True
+    if isinstance(value, str) and value.strip().lower() in ("false", "no", "off", "0", ""):
+        return False
+    raise ValueError("expected true or false, got " + repr(value))
+
+
+def integer(value):
+    """ Whole number, also accepting a quoted one such as MINLENGTH: "600" """
+    if isinstance(value, bool) or isinstance(value, float) and not value.is_integer():
+        raise ValueError("expected a whole number, got " + repr(value))
+    return int(value)
+
+
+def number(value):
+    """ Number, whole or not """
+    if isinstance(value, bool):
+        raise ValueError("expected a number, got " + repr(value))
+    return float(value)
+
+
+def positive(value):
+    """ Number greater than zero, e.g. a speed that is divided by """
+    value = number(value)
+    if not value > 0:
+        raise ValueError("expected a number greater than 0, got " + repr(value))
+    return value
+
+
+def text(value):
+    """ String; an empty value becomes "" """
+    return "" if value is None else str(value)
+
+
+def octal(value):
+    """ File mode written as octal digits, e.g. 777; returns the mode """
+    if isinstance(value, bool) or not str(value).isdigit():
+        raise ValueError("expected a mode such as 777, got " + repr(value))
+    return int(str(value), 8)
+
+
+def choice(*allowed):
+    """ Converter accepting one of the allowed strings, in any case """
+    def convert(value):
+        for option in allowed:
+            if str(value).lower() == option.lower():
+                return option
+        raise ValueError("expected one of " + ", ".join(allowed) + ", got " + repr(value))
+    return convert
+
+
+# Every config key with the converter its value goes through and the value used when the config file
+# doesn't set it.  See docs/arm.yaml.sample for what they do.
+FIELDS = {
+    'ARM_CHECK_UDF': (boolean, True),
+    'GET_VIDEO_TITLE': (boolean, True),
+    'VIDEO_TITLE': (text, ""),
+    'VIDEO_YEAR': (text, ""),
+    'METADATA_CACHE': (boolean, True),
+    'METADATA_CACHE_DAYS': (integer, 180),
+    'METADATA_CACHE_MISS_DAYS': (integer, 7),
+    'METADATA_TIMEOUT': (number, 10.0),
+    'ASYNC_IDENTIFY': (boolean, True),
+    'SKIP_TRANSCODE': (boolean, False),
+    'VIDEOTYPE': (choice("auto", "movie", "series"), "auto"),
+    'MINLENGTH': (integer, 600),
+    'MAXLENGTH': (integer, 99999),
+    'DEDUPE_TITLES': (boolean, True),
+    'DEDUPE_ENCODE_SPEED': (positive, 1.0),
+    'ARMPATH': (text, "/home/arm/media/unidentified/"),
+    'RAWPATH': (text, "/home/arm/media/raw/"),
+    'MEDIA_DIR': (text, "/home/arm/media/movies/"),
+    'EXTRAS_SUB': (text, "extras"),
+    'MOVE_CONCURRENCY': (integer, 2),
+    'MOVE_VERIFY': (boolean, True),
+    'SPACE_CHECK': (boolean, True),
+    'SPACE_MARGIN_GB': (number, 5.0),
+    'SPACE_ENCODE_RATIO': (number, 0.3),
+    'SPACE_DOWNGRADE': (boolean, True),
+    'SPACE_WAIT_MINUTES': (number, 60.0),
+    'SPACE_RETRY_INTERVAL': (integer, 60),
+    'INSTALLPATH': (text, "/opt/arm/"),
+    'LOGPATH': (text, "/home/arm/logs/"),
+    'LOGLEVEL': (choice("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"), "INFO"),
+    'LOGLIFE': (integer, 1),
+    'LOG_SINGLE_FILE': (boolean, False),
+    'DBFILE': (text, "/home/arm/arm.db"),
+    'MAX_CONCURRENT_JOBS': (integer, 2),
+    'MAX_JOB_ATTEMPTS': (integer, 3),
+    'WORKER_POLL_INTERVAL': (integer, 5),
+    'ARM_SOCKET': (text, "/run/arm/arm.sock"),
+    'DRIVE_SETTLE_SECONDS': (number, 30.0),
+    'SET_MEDIA_PERMISSIONS': (boolean, False),
+    'CHMOD_VALUE': (octal, 0o777),
+    'SET_MEDIA_OWNER': (boolean, False),
+    'CHOWN_USER': (text, ""),
+    'CHOWN_GROUP': (text, ""),
+    'RIPMETHOD': (choice("backup", "mkv"), "backup"),
+    'MKV_ARGS': (text, ""),
+    'RIP_PIPELINE': (boolean, False),
+    'DRIVE_CACHE': (text, "/home/arm/makemkv_drives.json"),
+    'DELRAWFILES': (boolean, True),
+    'DATA_HASH': (text, "sha256"),
+    'DATA_BLOCK_SIZE': (integer, 4194304),
+    'DATA_RESCUE': (boolean, True),
+    'DATA_RESCUE_RETRIES': (integer, 3),
+    'HASHEDKEYS': (boolean, False),
+    'HB_PRESET_DVD': (text, "High Profile"),
+    'HB_PRESET_BD': (text, "High Profile"),
+    'DEST_EXT': (text, "mkv"),
+    'HANDBRAKE_CLI': (text, "HandBrakeCLI"),
+    'HB_CONCURRENT_JOBS': (integer, 1),
+    'HB_THREADS_PER_JOB': (integer, 0),
+    'HB_CHAPTER_SPLIT': (boolean, False),
+    'HB_CHAPTER_SPLIT_MINLENGTH': (integer, 3600),
+    'FFMPEG_CLI': (text, "ffmpeg"),
+    'FFPROBE_CLI': (text, "ffprobe"),
+    'MAINFEATURE': (boolean, False),
+    'HB_ARGS_DVD': (text, "--subtitle scan -F"),
+    'HB_ARGS_BD': (text, "--subtitle scan -F --subtitle-burned --audio-lang-list eng --all-audio"),
+    'EMBY_REFRESH': (boolean, False),
+    'EMBY_DEBOUNCE_SECONDS': (number, 60.0),
+    'EMBY_MAX_PATHS': (integer, 50),
+    'EMBY_TIMEOUT': (number, 30.0),
+    'EMBY_MEDIA_DIR': (text, ""),
+    'EMBY_SERVER': (text, ""),
+    'EMBY_PORT': (integer, 8096),
+    'EMBY_CLIENT': (text, "ARM"),
+    'EMBY_DEVICE': (text, "ARM"),
+    'EMBY_DEVICEID': (text, "ARM"),
+    'EMBY_USERNAME': (text, ""),
+    'EMBY_USERID': (text, ""),
+    'EMBY_PASSWORD': (text, ""),
+    'EMBY_API_KEY': (text, ""),
+    'NOTIFY_RIP': (boolean, True),
+    'NOTIFY_TRANSCODE': (boolean, True),
+    'PB_KEY': (text, ""),
+    'IFTTT_KEY': (text, ""),
+    'IFTTT_EVENT': (text, "arm_event"),
+    'PO_USER_KEY': (text, ""),
+    'PO_APP_KEY': (text, ""),
+    'NOTIFY_COALESCE_SECONDS': (number, 20.0),
+    'NOTIFY_TIMEOUT': (number, 10.0),
+    'NOTIFY_RETRY_SECONDS': (number, 30.0),
+    'NOTIFY_MAX_ATTEMPTS': (integer, 5),
+    'OMDB_API_KEY': (text, ""),
+}
+
+
+class Config(Mapping):
+    """
+    Immutable snapshot of the ARM config, with every key of FIELDS converted to
+    its type.  Reading a key that isn't in FIELDS raises KeyError.
+
+    Attributes:
+        path: config file the snapshot was loaded from
+        stamp: identity of the file when it was loaded (see stamp())
+        unknown: keys in the file that aren't config keys
+
+    Methods:
+        __init__(self, values, path, stamp, unknown)
+        __getitem__(self, key)
+        __iter__(self)
+        __len__(self)
+    """
+
+    def __init__(self, values, path, stamp, unknown=()):
+        """
+        Constructor; returns a config snapshot
+
+        Parameters:
+            values: dict of every config key to its converted value
+            path: config file
+            stamp: identity of the file
+            unknown: keys in the file that aren't config keys
+
+        Return value: None
+        """
+        self._values = dict(values)
+        self.path = path
+        self.stamp = stamp
+        self.unknown = list(unknown)
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            raise KeyError(str(key) + " is not an ARM config key")
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+
+class LiveConfig(Mapping):
+    """
+    The config of this process, imported everywhere as cfg: the snapshot loaded
+    at startup, replaced by reload().  Only the long-running worker reloads, so
+    a job process keeps the snapshot it started with and editing the config
+    file never changes a running job.
+
+    Methods:
+        __getitem__(self, key)
+        __iter__(self)
+        __len__(self)
+    """
+
+    def __getitem__(self, key):
+        return _current[key]
+
+    def __iter__(self):
+        return iter(_current)
+
+    def __len__(self):
+        return len(_current)
+
+
+def stamp(path):
+    """
+    Identify a version of the config file and of the FIELDS it is compiled with
+
+    Parameters:
+    path: config file
+
+    Return value: list of the path, its modification time and size, and the modification time of this module
+    """
+    st = os.stat(path)
+    return [os.path.abspath(path), st.st_mtime_ns, st.st_size, os.stat(__file__).st_mtime_ns]
+
+
+def cache_file():
+    """ Where the compiled config is cached: ARM_CONFIG_CACHE, or in ~/.cache/arm """
+    return os.environ.get("ARM_CONFIG_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "arm", "config.cache"))
+
+
+def compile_config(raw):
+    """
+    Check and convert the values read from the config file.  Keys the file
+    doesn't set get their default.
+
+    Parameters:
+    raw: dict read from the config file
+
+    Return value: tuple of the dict of every config key to its value and a list of unknown keys
+    Raises ConfigError listing every value that can't be converted
+    """
+    if not isinstance(raw, dict):
+        raise ConfigError("expected key: value lines")
+    values = {}
+    problems = []
+    for key, (convert, default) in FIELDS.items():
+        if key not in raw:
+            values[key] = default
+            continue
+        try:
+            values[key] = convert(raw[key])
+        except (TypeError, ValueError) as convert_error:
+            problems.append(key + ": " + str(convert_error))
+    if problems:
+        raise ConfigError("; ".join(problems))
+    return values, sorted(str(k) for k in raw if k not in FIELDS)
+
+
+def parse(path):
+    """
+    Read and compile the config file
+
+    Parameters:
+    path: config file
+
+    Return value: tuple of the dict of every config key to its value and a list of unknown keys
+    Raises ConfigError if the file can't be parsed or has invalid values
+    """
+    # only needed when the file changed; a cached config is loaded without importing yaml
+    import yaml
+    try:
+        with open(path, "r") as f:
+            raw = yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+    except yaml.YAMLError as yaml_error:
+        raise ConfigError(str(yaml_error))
+    try:
+        return compile_config(raw or {})
+    except ConfigError as config_error:
+        raise ConfigError(path + ": " + str(config_error))
+
+
+def load(path):
+    """
+    Load a config snapshot.  The compiled values are cached (see cache_file)
+    and reused while the file and this module are unchanged, so a process
+    starting with an unchanged config doesn't parse YAML at all.
+
+    Parameters:
+    path: config file
+
+    Return value: Config
+    Raises ConfigError if the file can't be parsed or has invalid values
+    """
+    key = stamp(path)
+    cachefile = cache_file()
+    try:
+        with open(cachefile, "rb") as f:
+            cached = marshal.load(f)
+        if cached['stamp'] != key:
+            cached = None
+    except (OSError, EOFError, ValueError, TypeError, KeyError):
+        cached = None
+
+    if cached is None:
+        values, unknown = parse(path)
+        cached = {'stamp': key, 'values': values, 'unknown': unknown}
+        try:
+            os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+            tmpfile = cachefile + "." + str(os.getpid())
+            with open(tmpfile, "wb") as f:
+                marshal.dump(cached, f)
+            os.replace(tmpfile, cachefile)
+        except OSError:
+            pass
+
+    # a module logger doesn't set up logging before logger.logger does
+    for key_name in cached['unknown']:
+        import difflib
+        close = difflib.get_close_matches(key_name, FIELDS.keys(), 1)
+        logging.getLogger(__name__).warning("Unknown config key " + key_name + " in " + path +
+                                            (", did you mean " + close[0] + "?" if close else ""))
+    return Config(cached['values'], path, key, cached['unknown'])
+
+
+def current():
+    """
+    Get the current config snapshot, for code that needs several values from the same version of the file
+
+    Parameters:
+    None
+
+    Return value: Config
+    """
+    return _current
+
+
+def reload():
+    """
+    Load the config file again if it changed since the current snapshot was
+    loaded.  An invalid file is logged and the current snapshot is kept.
+
+    Parameters:
+    None
+
+    Return value: True if the config changed
+    """
+    global _current, _rejected
+    try:
+        key = stamp(_current.path)
+    except OSError as stat_error:
+        # e.g. the file is being replaced; the error message stands in for its version
+        key = str(stat_error)
+        if key != _rejected:
+            logging.error("Could not reload " + _current.path + ", keeping the current config: " + key)
+            _rejected = key
+        return False
+    if key == _current.stamp or key == _rejected:
+        return False
+    try:
+        snapshot = load(_current.path)
+    except (OSError, ConfigError) as load_error:
+        # logged once per version of the file
+        if key != _rejected:
+            logging.error("Could not reload " + _current.path + ", keeping the current config: " + str(load_error))
+            _rejected = key
+        return False
+    changed = sorted(k for k in FIELDS if snapshot[k] != _current[k])
+    _current = snapshot
+    logging.info("Reloaded " + _current.path + ": " + (", ".join(changed) if changed else "no values") + " changed")
+    return True
+
+
+# ARM_CONFIG points ARM at another config file, e.g. for testing
+yamlfile = os.environ.get("ARM_CONFIG", "/etc/arm/arm.yaml")
+_current = load(yamlfile)
+_rejected = None
+cfg = LiveConfig()
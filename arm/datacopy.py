@@ -0,0 +1,595 @@
+#!/usr/bin/python3
+
+import os
+import time
+import errno
+import hashlib
+import logging
+
+# Read size is rounded to whole optical sectors
+SECTOR = 2048
+
+# Seconds between throughput log lines
+LOG_INTERVAL = 30
+
+# Errors that mean the kernel can't use copy_file_range/sendfile between these two files
+UNSUPPORTED = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF)
+
+# Rescue map states, as used by GNU ddrescue
+NON_TRIED = "?"
+NON_TRIMMED = "*"
+BAD_SECTOR = "-"
+FINISHED = "+"
+
+# Seconds between saves of the rescue map
+MAP_SAVE_INTERVAL = 5
+
+# Largest area skipped after a read error in the first rescue pass
+MAX_SKIP = 67108864
+
+
+class ReadError(Exception):
+    """
+    Raised by copy_image when the source can't be read
+
+    Attributes:
+        offset: bytes copied before the error
+        error: the OSError
+    """
+
+    def __init__(self, offset, error):
+        Exception.__init__(self, "read error after " + str(offset) + " bytes: " + str(error))
+        self.offset = offset
+        self.error = error
+
+
+def copy_image(src, dest, hashes=None, blocksize=4194304, on_progress=None):
+    """
+    Copy a disc or image to a file in one streaming pass.  Without hashes the
+    kernel copies the data (copy_file_range, or sendfile), otherwise it is read
+    in large sector aligned blocks and hashed as it is written, so the image
+    doesn't need a second read to be verified.  Throughput is logged every
+    LOG_INTERVAL seconds.
+
+    Parameters:
+    src: path to the device or image to copy
+    dest: path of the image file to write
+    hashes: optional list of hashlib algorithm names, e.g. ["sha256"]
+    blocksize: bytes per read, rounded down to whole sectors
+    on_progress: optional function called with progress event dicts (see runner.ProgressReporter)
+
+    Return value: dict with bytes (copied), seconds, method and hashes (algorithm to hex digest)
+    Raises ReadError if part of the source can't be read, see rescue_image
+    """
+    blocksize = max(SECTOR, int(blocksize) // SECTOR * SECTOR)
+    hashers = [hashlib.new(name) for name in (hashes or [])]
+    progress = Progress(src, on_progress)
+
+    srcfd = os.open(src, os.O_RDONLY)
+    try:
+        size = os.lseek(srcfd, 0, os.SEEK_END)
+        os.lseek(srcfd, 0, os.SEEK_SET)
+        progress.size = size
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(srcfd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        destfd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            copied = 0
+            method = None
+            try:
+                if not hashers:
+                    copied, method = kernel_copy(srcfd, destfd, size, blocksize, progress)
+                if copied < size or size == 0:
+                    copied = stream_copy(srcfd, destfd, copied, blocksize, hashers, progress)
+                    method = "read/write" if method is None else method + " + read/write"
+            except OSError as copy_error:
+                if copy_error.errno != errno.EIO:
+                    raise
+                raise ReadError(progress.copied, copy_error)
+            os.fsync(destfd)
+        finally:
+            os.close(destfd)
+    finally:
+        os.close(srcfd)
+
+    result = {
+        'bytes': copied,
+        'seconds': progress.elapsed(),
+        'method': method,
+        'hashes': dict((h.name, h.hexdigest()) for h in hashers),
+    }
+    logging.info("Copied " + megabytes(copied) + " MB in " + str(round(result['seconds'], 1)) + " s (" +
+                 megabytes(copied / max(result['seconds'], 0.001)) + " MB/s) using " + method)
+    return result
+
+
+def kernel_copy(srcfd, destfd, size, blocksize, progress):
+    """
+    Copy without passing the data through Python, with copy_file_range where
+    available and sendfile otherwise
+
+    Parameters:
+    srcfd: file descriptor to copy from, at offset 0
+    destfd: file descriptor to copy to
+    size: number of bytes to copy
+    blocksize: bytes per call
+    progress: Progress object
+
+    Return value: tuple of the number of bytes copied and the method used.  Fewer
+                  bytes than size are copied if the kernel doesn't support either call.
+    """
+    copied = 0
+    for method in ["copy_file_range", "sendfile"]:
+        if not hasattr(os, method):
+            continue
+        try:
+            while copied < size:
+                if method == "copy_file_range":
+                    count = os.copy_file_range(srcfd, destfd, min(blocksize, size - copied), copied, copied)
+                else:
+                    os.lseek(destfd, copied, os.SEEK_SET)
+                    count = os.sendfile(destfd, srcfd, copied, min(blocksize, size - copied))
+                if count == 0:
+                    break
+                copied += count
+                progress.update(copied)
+            return copied, method
+        except OSError as copy_error:
+            if copy_error.errno not in UNSUPPORTED:
+                raise
+            logging.debug(method + " is not supported for this copy: " + str(copy_error))
+    return copied, None
+
+
+def stream_copy(srcfd, destfd, offset, blocksize, hashers, progress):
+    """
+    Copy by reading into a reusable buffer, hashing each block as it is written
+
+    Parameters:
+    srcfd: file descriptor to copy from
+    destfd: file descriptor to copy to
+    offset: byte offset to continue from; hashers must be empty if it isn't 0
+    blocksize: bytes per read
+    hashers: list of hashlib objects to update
+    progress: Progress object
+
+    Return value: offset after the last byte copied
+    """
+    buf = bytearray(blocksize)
+    view = memoryview(buf)
+    os.lseek(srcfd, offset, os.SEEK_SET)
+    os.lseek(destfd, offset, os.SEEK_SET)
+    with os.fdopen(os.dup(srcfd), "rb", buffering=0) as reader:
+        while True:
+            count = reader.readinto(buf)
+            if not count:
+                break
+            block = view[:count]
+            written = 0
+            while written < count:
+                written += os.write(destfd, block[written:])
+            for hasher in hashers:
+                hasher.update(block)
+            offset += count
+            progress.update(offset)
+            if hasattr(os, "posix_fadvise"):
+                # the image isn't read again, don't let it push everything else out of the page cache
+                os.posix_fadvise(destfd, offset - count, count, os.POSIX_FADV_DONTNEED)
+    return offset
+
+
+def rescue_image(src, dest, mapfile, hashes=None, blocksize=4194304, retries=3, on_progress=None, copied=0):
+    """
+    Copy a damaged disc, recording which areas were copied in a mapfile in the
+    format of GNU ddrescue, so an interrupted copy can be resumed and the image
+    can be completed later with ddrescue.
+
+    The first pass copies everything that reads with blocksize reads, skipping
+    ahead further after each consecutive error, so the drive doesn't spend
+    its time retrying a scratch.  Failed areas are then read again with half
+    the block size on each pass, down to single sectors, and sectors that still
+    fail are retried up to retries times.  Unreadable sectors are left as zeros.
+
+    Parameters:
+    src: path to the device or image to copy
+    dest: path of the image file, which is continued if the mapfile exists
+    mapfile: path of the mapfile
+    hashes: optional list of hashlib algorithm names.  Only calculated if every sector was read.
+    blocksize: bytes per read in the first pass
+    retries: number of times to retry each bad sector
+    on_progress: optional function called with progress event dicts
+    copied: bytes at the start of dest already copied by copy_image, used without a mapfile
+
+    Return value: dict with bytes (read), bad (bytes unreadable), seconds, method and hashes
+    """
+    blocksize = max(SECTOR, int(blocksize) // SECTOR * SECTOR)
+    progress = Progress(src, on_progress)
+
+    srcfd = os.open(src, os.O_RDONLY)
+    try:
+        size = os.lseek(srcfd, 0, os.SEEK_END)
+        progress.size = size
+        rescue_map = RescueMap.load(mapfile, size)
+        if os.path.exists(mapfile) and os.path.exists(dest) and rescue_map.size == size:
+            logging.info("Continuing the copy of " + src + " from " + mapfile + ": " + megabytes(rescue_map.finished()) +
+                         " MB already copied")
+        else:
+            rescue_map = RescueMap(size)
+            if copied:
+                rescue_map.set(0, min(copied // SECTOR * SECTOR, size), FINISHED)
+
+        destfd = os.open(dest, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(destfd, size)
+            try:
+                rescue_pass(srcfd, destfd, rescue_map, [NON_TRIED], blocksize, True, progress, mapfile)
+                # down to single sectors, also when the first pass already read single sectors
+                trimsize = blocksize
+                while rescue_map.areas(NON_TRIMMED):
+                    trimsize = max(SECTOR, trimsize // 2 // SECTOR * SECTOR)
+                    status = BAD_SECTOR if trimsize == SECTOR else NON_TRIMMED
+                    rescue_pass(srcfd, destfd, rescue_map, [NON_TRIMMED], trimsize, False, progress, mapfile, status)
+                for attempt in range(int(retries)):
+                    if not rescue_map.areas(BAD_SECTOR):
+                        break
+                    logging.info("Retrying " + str(rescue_map.total(BAD_SECTOR) // SECTOR) + " bad sectors, attempt " + str(attempt + 1))
+                    rescue_pass(srcfd, destfd, rescue_map, [BAD_SECTOR], SECTOR, False, progress, mapfile, BAD_SECTOR)
+                os.fsync(destfd)
+            finally:
+                rescue_map.save(mapfile)
+        finally:
+            os.close(destfd)
+    finally:
+        os.close(srcfd)
+
+    # every byte that wasn't copied, whatever state the passes left it in
+    bad = rescue_map.size - rescue_map.finished()
+    digests = {}
+    if hashes and not bad:
+        digests = hash_file(dest, hashes, blocksize)
+    result = {
+        'bytes': rescue_map.finished(),
+        'bad': bad,
+        'seconds': progress.elapsed(),
+        'method': "rescue",
+        'hashes': digests,
+    }
+    if bad:
+        logging.warning("Could not read " + str(bad // SECTOR) + " sectors (" + megabytes(bad) + " MB) of " + src +
+                        ".  They are zeros in the image, see " + mapfile)
+    else:
+        logging.info("Copied every sector of " + src + " in " + str(round(result['seconds'], 1)) + " s")
+    return result
+
+
+def rescue_pass(srcfd, destfd, rescue_map, states, blocksize, skip, progress, mapfile, failed=NON_TRIMMED):
+    """
+    Read the areas of the rescue map in the given states
+
+    Parameters:
+    srcfd: file descriptor to copy from
+    destfd: file descriptor to copy to
+    rescue_map: RescueMap, updated as areas are read
+    states: states of the areas to read
+    blocksize: bytes per read
+    skip: skip ahead after read errors
+    progress: Progress object
+    mapfile: path to save the map to every MAP_SAVE_INTERVAL seconds
+    failed: state given to areas that can't be read
+
+    Return value: None
+    """
+    saved = time.time()
+    for pos, length in rescue_map.areas(*states):
+        end = pos + length
+        skip_size = blocksize
+        while pos < end:
+            count = min(blocksize, end - pos)
+            try:
+                data = read_at(srcfd, count, pos)
+            except OSError as read_error:
+                if read_error.errno != errno.EIO:
+                    raise
+                data = None
+            if data:
+                written = 0
+                while written < len(data):
+                    written += os.pwrite(destfd, data[written:], pos + written)
+                rescue_map.set(pos, len(data), FINISHED)
+                pos += len(data)
+                skip_size = blocksize
+            elif data is None:
+                if skip:
+                    count = min(skip_size, end - pos)
+                    skip_size = min(skip_size * 2, MAX_SKIP)
+                logging.debug("Read error at byte " + str(pos) + ", marking " + str(count) + " bytes " + failed)
+                rescue_map.set(pos, count, failed)
+                pos += count
+            else:
+                # end of the device before the recorded size
+                rescue_map.set(pos, end - pos, failed)
+                break
+            progress.update(rescue_map.finished())
+            if time.time() - saved >= MAP_SAVE_INTERVAL:
+                rescue_map.save(mapfile)
+                saved = time.time()
+
+
+def read_at(fd, count, pos):
+    """
+    Read from an offset of a file descriptor
+
+    Parameters:
+    fd: file descriptor
+    count: bytes to read
+    pos: offset
+
+    Return value: bytes read
+    """
+    return os.pread(fd, count, pos)
+
+
+def hash_file(path, hashes, blocksize=4194304):
+    """
+    Calculate checksums of a file
+
+    Parameters:
+    path: path of the file
+    hashes: list of hashlib algorithm names
+    blocksize: bytes per read
+
+    Return value: dict of algorithm name to hex digest
+    """
+    hashers = [hashlib.new(name) for name in hashes]
+    buf = bytearray(blocksize)
+    view = memoryview(buf)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            count = f.readinto(buf)
+            if not count:
+                break
+            for hasher in hashers:
+                hasher.update(view[:count])
+    return dict((h.name, h.hexdigest()) for h in hashers)
+
+
+def write_hashes(image, hashes):
+    """
+    Write the digests of an image next to it in the format of sha256sum/md5sum
+
+    Parameters:
+    image: path of the image
+    hashes: dict of algorithm name to hex digest
+
+    Return value: list of the files written
+    """
+    files = []
+    for name, digest in sorted(hashes.items()):
+        hashfile = image + "." + name
+        with open(hashfile, "w") as f:
+            f.write(digest + "  " + os.path.basename(image) + "\n")
+        logging.info(name + " of " + os.path.basename(image) + ": " + digest)
+        files.append(hashfile)
+    return files
+
+
+def megabytes(count):
+    """
+    Format a byte count in megabytes
+
+    Parameters:
+    count: number of bytes
+
+    Return value: string with one decimal
+    """
+    return str(round(count / 1048576.0, 1))
+
+
+class Progress(object):
+    """
+    Tracks the progress of a copy, logs the throughput every LOG_INTERVAL
+    seconds and passes progress events on
+
+    Methods:
+        __init__(self, src, on_progress)
+        update(self, copied)
+        elapsed(self)
+    """
+
+    def __init__(self, src, on_progress):
+        """
+        Constructor
+
+        Parameters:
+        src: path being copied, for the log
+        on_progress: optional function called with progress event dicts
+
+        Return value: None
+        """
+        self.src = src
+        self.on_progress = on_progress
+        self.size = 0
+        self.start = time.time()
+        self.last_log = self.start
+        self.last_copied = 0
+        self.copied = 0
+
+    def update(self, copied):
+        """
+        Record the number of bytes copied so far
+
+        Parameters:
+        copied: bytes copied
+
+        Return value: None
+        """
+        now = time.time()
+        self.copied = copied
+        if self.on_progress is not None and self.size:
+            self.on_progress({
+                'tool': "datacopy",
+                'percent': round(copied * 100.0 / self.size, 1),
+                'rate': round((copied / max(now - self.start, 0.001)) / 1048576.0, 1),
+            })
+        if now - self.last_log >= LOG_INTERVAL:
+            rate = (copied - self.last_copied) / (now - self.last_log)
+            logging.info("Copied " + megabytes(copied) + " of " + megabytes(self.size) + " MB from " + self.src +
+                         " (" + megabytes(rate) + " MB/s)")
+            self.last_log = now
+            self.last_copied = copied
+
+    def elapsed(self):
+        """
+        Seconds since the copy started
+
+        Parameters:
+        None
+
+        Return value: seconds
+        """
+        return time.time() - self.start
+
+
+class RescueMap(object):
+    """
+    Areas of a disc and whether they were copied, stored in the mapfile format
+    of GNU ddrescue
+
+    Attributes:
+        size: size of the disc in bytes
+        blocks: sorted list of [position, size, state] covering the whole disc
+
+    Methods:
+        __init__(self, size)
+        load(cls, mapfile, size)
+        save(self, mapfile)
+        set(self, pos, length, state)
+        areas(self, *states)
+        total(self, state)
+        finished(self)
+    """
+
+    def __init__(self, size):
+        """
+        Constructor, for a disc of which nothing was read yet
+
+        Parameters:
+        size: size of the disc in bytes
+
+        Return value: None
+        """
+        self.size = size
+        self.blocks = [[0, size, NON_TRIED]] if size else []
+
+    @classmethod
+    def load(cls, mapfile, size):
+        """
+        Read a mapfile
+
+        Parameters:
+        mapfile: path of the mapfile
+        size: size of the disc, used if the mapfile doesn't exist
+
+        Return value: RescueMap
+        """
+        rescue_map = cls(size)
+        if not os.path.exists(mapfile):
+            return rescue_map
+        blocks = []
+        with open(mapfile) as f:
+            lines = [line.split() for line in f if line.strip() and not line.startswith("#")]
+        # the first line is the current position and pass, the rest are blocks
+        for fields in lines[1:]:
+            blocks.append([int(fields[0], 0), int(fields[1], 0), fields[2]])
+        if blocks:
+            rescue_map.blocks = blocks
+            rescue_map.size = blocks[-1][0] + blocks[-1][1]
+        return rescue_map
+
+    def save(self, mapfile):
+        """
+        Write the mapfile, replacing the previous version atomically
+
+        Parameters:
+        mapfile: path of the mapfile
+
+        Return value: None
+        """
+        tmpfile = mapfile + ".tmp"
+        with open(tmpfile, "w") as f:
+            f.write("# Mapfile. Created by ARM\n")
+            f.write("# current_pos  current_status  current_pass\n")
+            f.write("0x{0:08X}     {1}               1\n".format(0, "+" if not self.areas(NON_TRIED, NON_TRIMMED) else "?"))
+            f.write("#      pos        size  status\n")
+            for pos, length, state in self.blocks:
+                f.write("0x{0:08X}  0x{1:08X}  {2}\n".format(pos, length, state))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpfile, mapfile)
+
+    def set(self, pos, length, state):
+        """
+        Set the state of an area
+
+        Parameters:
+        pos: start of the area in bytes
+        length: length of the area in bytes
+        state: new state
+
+        Return value: None
+        """
+        end = pos + length
+        blocks = []
+        for block_pos, block_size, block_state in self.blocks:
+            block_end = block_pos + block_size
+            if block_end <= pos or block_pos >= end:
+                blocks.append([block_pos, block_size, block_state])
+                continue
+            if block_pos < pos:
+                blocks.append([block_pos, pos - block_pos, block_state])
+            if not blocks or blocks[-1][0] + blocks[-1][1] <= pos:
+                blocks.append([pos, length, state])
+            if block_end > end:
+                blocks.append([end, block_end - end, block_state])
+        # merge neighbours in the same state
+        merged = []
+        for block in blocks:
+            if merged and merged[-1][2] == block[2]:
+                merged[-1][1] += block[1]
+            else:
+                merged.append(block)
+        self.blocks = merged
+
+    def areas(self, *states):
+        """
+        Get the areas in any of the given states
+
+        Parameters:
+        states: states to look for
+
+        Return value: list of (position, size) tuples
+        """
+        return [(pos, length) for pos, length, state in self.blocks if state in states]
+
+    def total(self, state):
+        """
+        Number of bytes in a state
+
+        Parameters:
+        state: state to count
+
+        Return value: bytes
+        """
+        return sum(length for pos, length in self.areas(state))
+
+    def finished(self):
+        """
+        Number of bytes copied
+
+        Parameters:
+        None
+
+        Return value: bytes
+        """
+        return self.total(FINISHED)
@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+
+import os
+import sqlite3
+
+from config import cfg
+
+
+def connect(schema=None):
+    """
+    Open a connection to the ARM database.  The database is shared by every ARM
+    process, so it is opened in WAL mode with a generous busy timeout.
+
+    Parameters:
+    schema: optional SQL script creating the tables the caller needs
+
+    Return value: sqlite3 connection in autocommit mode with rows returned as sqlite3.Row
+    """
+
+    dbdir = os.path.dirname(cfg['DBFILE'])
+    if dbdir and not os.path.exists(dbdir):
+        os.makedirs(dbdir)
+
+    conn = sqlite3.connect(cfg['DBFILE'], timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    if schema:
+        conn.executescript(schema)
+    return conn
+
+
+def add_columns(conn, table, columns):
+    """
+    Add columns that are missing from an existing table
+
+    Parameters:
+    conn: sqlite3 connection
+    table: name of the table
+    columns: list of (name, type) tuples
+
+    Return value: None
+    """
+
+    existing = [row[1] for row in conn.execute("PRAGMA table_info(" + table + ")")]
+    for name, coltype in columns:
+        if name not in existing:
+            try:
+                conn.execute("ALTER TABLE " + table + " ADD COLUMN " + name + " " + coltype)
+            except sqlite3.OperationalError:
+                # added by another process in the meantime
+                pass
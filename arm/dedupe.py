@@ -0,0 +1,185 @@
+#!/usr/bin/python3
+
+import logging
+
+from config import cfg
+
+# Allowed difference, in seconds, between chapter or title lengths that are considered equal.
+# Lengths are rounded to whole seconds by the scanners.
+TOLERANCE = 1
+
+
+def drop_duplicates(titles, keys, disc):
+    """
+    Remove duplicate titles and "play all" titles from a list of titles to
+    process, and log what was skipped with the estimated encoding time saved.
+    Does nothing if DEDUPE_TITLES is off.
+
+    Parameters:
+    titles: dict of title key to title info with duration, chapters (list of chapter
+            lengths or number of chapters) and optionally mainfeature, segments and playlist
+    keys: keys of the titles to process, in processing order
+    disc: disc object
+
+    Return value: tuple of the list of keys to keep and a dict of skipped keys to the reason
+    """
+    if not cfg['DEDUPE_TITLES']:
+        return keys, {}
+
+    skipped = find_duplicates(titles, keys, disc)
+    if skipped:
+        report(titles, skipped)
+    return [k for k in keys if k not in skipped], skipped
+
+
+def find_duplicates(titles, keys, disc):
+    """
+    Find titles that repeat the content of other titles.  Titles with the same
+    length, chapter lengths and segments are duplicates (e.g. copies of the
+    feature or camera angles); the main feature, or else the first title, is
+    kept.  A title whose chapters or segments are the chapters or segments of
+    two or more other titles, one after the other, is a play all title.  The
+    main feature of a movie, or of a disc whose video type is still being
+    looked up, is never dropped as a play all title.
+
+    Parameters:
+    titles: dict of title key to title info (see drop_duplicates)
+    keys: keys of the titles to check
+    disc: disc object
+
+    Return value: dict of skipped title keys to the reason they were skipped
+    """
+    fingerprints = dict((k, fingerprint(titles[k], disc)) for k in keys)
+
+    # keep the main feature when it has duplicates
+    order = sorted(keys, key=lambda k: not titles[k].get('mainfeature', False))
+    skipped = {}
+    kept = []
+    for key in order:
+        for other in kept:
+            if same_content(fingerprints[key], fingerprints[other]):
+                skipped[key] = "duplicate of title " + str(other)
+                break
+        else:
+            kept.append(key)
+
+    for key in kept:
+        if titles[key].get('mainfeature') and disc.videotype in ("movie", ""):
+            continue
+        parts = [k for k in kept if k != key and k not in skipped and fingerprints[k]['duration'] < fingerprints[key]['duration']]
+        played = play_all_parts(fingerprints[key], parts, fingerprints)
+        if played:
+            skipped[key] = "plays titles " + ", ".join(str(k) for k in played)
+
+    return skipped
+
+
+def fingerprint(title, disc):
+    """
+    Get the properties of a title used to compare its content with other titles
+
+    Parameters:
+    title: title info (see drop_duplicates)
+    disc: disc object.  For HandBrake titles the segments are taken from the MakeMKV plan in disc.plan
+
+    Return value: dict with duration, chapters (list of chapter lengths, or None) and segments (list, or None)
+    """
+    chapters = title.get('chapters')
+    segments = title.get('segments')
+    if not segments and title.get('playlist'):
+        for planned in getattr(disc, 'plan', []):
+            if planned.get('source', "").split(".")[0] == title['playlist']:
+                segments = planned['segments']
+
+    return {
+        'duration': title['duration'],
+        'chapters': chapters if isinstance(chapters, list) and chapters else None,
+        'segments': segments or None,
+    }
+
+
+def same_content(a, b):
+    """
+    Check if two titles have the same content
+
+    Parameters:
+    a, b: fingerprints of the titles
+
+    Return value: True if the length and, where known, the chapters and segments match
+    """
+    if abs(a['duration'] - b['duration']) > TOLERANCE:
+        return False
+    if a['segments'] and b['segments'] and a['segments'] != b['segments']:
+        return False
+    if a['chapters'] and b['chapters'] and not same_lengths(a['chapters'], b['chapters']):
+        return False
+    # two titles of the same length alone are not enough to call them duplicates
+    return bool(a['segments'] and b['segments'] or a['chapters'] and b['chapters'])
+
+
+def same_lengths(a, b):
+    """
+    Compare two lists of chapter lengths
+
+    Parameters:
+    a, b: lists of lengths in seconds
+
+    Return value: True if the lists have the same number of chapters with the same lengths
+    """
+    return len(a) == len(b) and all(abs(x - y) <= TOLERANCE for x, y in zip(a, b))
+
+
+def play_all_parts(candidate, parts, fingerprints):
+    """
+    Check if a title plays other titles one after the other, by matching the
+    start of its remaining segments, or else chapters, against the other titles
+
+    Parameters:
+    candidate: fingerprint of the title to check
+    parts: keys of the titles that could be played by the candidate
+    fingerprints: dict of title key to fingerprint
+
+    Return value: list of the keys of the titles played, or an empty list if the candidate isn't a play all title
+    """
+    for field in ['segments', 'chapters']:
+        remaining = candidate[field]
+        if not remaining:
+            continue
+        played = []
+        while remaining:
+            match = None
+            for key in parts:
+                sequence = fingerprints[key][field]
+                if not sequence or len(sequence) > len(remaining):
+                    continue
+                head = remaining[:len(sequence)]
+                equal = head == sequence if field == 'segments' else same_lengths(head, sequence)
+                if equal and (match is None or len(sequence) > len(fingerprints[match][field])):
+                    match = key
+            if match is None:
+                break
+            played.append(match)
+            remaining = remaining[len(fingerprints[match][field]):]
+        if not remaining and len(played) > 1:
+            return played
+    return []
+
+
+def report(titles, skipped):
+    """
+    Log the skipped titles and the encoding time saved by not transcoding them
+
+    Parameters:
+    titles: dict of title key to title info
+    skipped: dict of skipped title keys to the reason
+
+    Return value: None
+    """
+    seconds = 0
+    for key in sorted(skipped, key=str):
+        logging.info("Skipping title " + str(key) + " (" + str(titles[key]['duration']) + " seconds): " + skipped[key])
+        seconds += titles[key]['duration']
+
+    speed = cfg['DEDUPE_ENCODE_SPEED']
+    logging.info("Skipped " + str(len(skipped)) + " duplicate title(s) with " + str(round(seconds / 60.0)) +
+                 " minutes of video.  Estimated encoding time saved: " + str(round(seconds / speed / 60.0)) + " minutes")
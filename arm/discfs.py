@@ -0,0 +1,529 @@
+#!/usr/bin/python3
+
+import struct
+import logging
+import calendar
+import datetime
+
+SECTOR = 2048
+
+# UDF descriptor tag identifiers (ECMA-167)
+TAG_PVD = 1
+TAG_AVDP = 2
+TAG_PD = 5
+TAG_LVD = 6
+TAG_TD = 8
+TAG_FSD = 256
+TAG_FID = 257
+TAG_FE = 261
+TAG_EFE = 266
+
+# File Identifier Descriptor characteristics
+FID_DIRECTORY = 0x02
+FID_DELETED = 0x04
+FID_PARENT = 0x08
+
+# Most sectors searched for volume descriptors; real discs use a handful
+MAX_DESCRIPTORS = 64
+
+# What parsing malformed structures raises, e.g. a record running past the end of its sector
+MALFORMED = (struct.error, IndexError, KeyError)
+
+
+class DiscFSError(Exception):
+    """The disc or image doesn't contain a file system discfs can read"""
+
+
+class Entry(object):
+    """
+    A file or directory on the disc
+
+    Attributes:
+        name
+        is_dir
+        size: size in bytes (UDF: only known after stat)
+        mtime: modification time in seconds since the epoch (UDF: only known after stat)
+    """
+
+    def __init__(self, name, is_dir, location, size=None, mtime=None):
+        self.name = name
+        self.is_dir = is_dir
+        self.location = location
+        self.size = size
+        self.mtime = mtime
+
+    def __repr__(self):
+        return "Entry(" + self.name + ("/" if self.is_dir else "") + ")"
+
+
+class DiscFS(object):
+    """
+    Reads the UDF or ISO9660 file system of a video or data disc straight from
+    the device or an image file, without mounting it.  Only the sectors needed
+    are read: the volume descriptors, the directories along a path and the
+    files asked for.  UDF is preferred over ISO9660 on bridge discs, because
+    Blurays only have UDF.  UDF 2.50+ metadata partitions are supported.
+
+    Attributes:
+        path
+        fstype: "udf" or "iso9660"
+        label: volume label
+
+    Methods:
+        __init__(self, path)
+        listdir(self, path)
+        stat(self, path)
+        read(self, path, size)
+        close(self)
+    """
+
+    def __init__(self, path):
+        """
+        Constructor; opens the device or image and reads the volume descriptors
+
+        Parameters:
+        path: path to the device or image file
+
+        Return value: None
+        """
+        self.path = path
+        self.f = open(path, "rb")
+        self.fstype = None
+        self.label = ""
+        try:
+            if self._has_udf():
+                self._open_udf()
+            else:
+                self._open_iso9660()
+        except Exception:
+            self.f.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Close the device or image
+
+        Parameters:
+        None
+
+        Return value: None
+        """
+        self.f.close()
+
+    def _read(self, sector, count=1):
+        self.f.seek(sector * SECTOR)
+        data = self.f.read(count * SECTOR)
+        if len(data) < count * SECTOR:
+            raise DiscFSError("Short read at sector " + str(sector) + " of " + self.path)
+        return data
+
+    # ---- common ----
+
+    def listdir(self, path="/"):
+        """
+        List a directory
+
+        Parameters:
+        path: path of the directory on the disc; names are matched case insensitively
+
+        Return value: list of Entry objects
+        """
+        entry = self._lookup(path)
+        if not entry.is_dir:
+            raise DiscFSError(path + " is not a directory")
+        return self._listdir(entry)
+
+    def stat(self, path):
+        """
+        Get a file or directory including its size and modification time
+
+        Parameters:
+        path: path on the disc
+
+        Return value: Entry object
+        """
+        entry = self._lookup(path)
+        if self.fstype == "udf" and entry.size is None:
+            info = self._udf_file_entry(entry.location)
+            entry.size = info['size']
+            entry.mtime = info['mtime']
+        return entry
+
+    def read(self, path, size=None):
+        """
+        Read a file
+
+        Parameters:
+        path: path of the file on the disc
+        size: optional maximum number of bytes to read, e.g. just the header of an IFO file
+
+        Return value: contents of the file as bytes
+        """
+        entry = self._lookup(path)
+        if entry.is_dir:
+            raise DiscFSError(path + " is a directory")
+        if self.fstype == "udf":
+            return self._udf_read(entry.location, size)
+        length = entry.size if size is None else min(size, entry.size)
+        sectors = (length + SECTOR - 1) // SECTOR
+        return self._read(entry.location, sectors)[:length] if sectors else b""
+
+    def _lookup(self, path):
+        entry = self.root
+        for part in [p for p in path.split("/") if p]:
+            for child in self._listdir(entry):
+                if child.name.upper() == part.upper():
+                    entry = child
+                    break
+            else:
+                raise DiscFSError(path + " not found on " + self.path)
+        return entry
+
+    def _listdir(self, entry):
+        if self.fstype == "udf":
+            return self._udf_listdir(entry)
+        return self._iso_listdir(entry)
+
+    # ---- ISO9660 ----
+
+    def _open_iso9660(self):
+        for sector in range(16, 16 + MAX_DESCRIPTORS):
+            data = self._read(sector)
+            if data[1:6] != b"CD001":
+                break
+            if data[0] == 1:
+                self.fstype = "iso9660"
+                self.label = data[40:72].decode("ascii", "replace").strip()
+                self.root = self._iso_record(data[156:190])
+                return
+            if data[0] == 255:
+                break
+        raise DiscFSError("No ISO9660 or UDF file system found on " + self.path)
+
+    def _iso_record(self, record):
+        extent, size = struct.unpack_from("<I4xI", record, 2)
+        flags = record[25]
+        name = record[33:33 + record[32]].decode("ascii", "replace").split(";")[0].rstrip(".")
+        return Entry(name, bool(flags & 0x02), extent, size, iso_time(record[18:25]))
+
+    def _iso_listdir(self, entry):
+        data = self._read(entry.location, (entry.size + SECTOR - 1) // SECTOR)[:entry.size]
+        entries = []
+        pos = 0
+        while pos < len(data):
+            length = data[pos]
+            if length == 0:
+                # records don't cross sector boundaries
+                pos = (pos // SECTOR + 1) * SECTOR
+                continue
+            record = data[pos:pos + length]
+            pos += length
+            if record[32] == 1 and record[33] in (0, 1):
+                continue  # . and ..
+            entries.append(self._iso_record(record))
+        return entries
+
+    # ---- UDF ----
+
+    def _has_udf(self):
+        for sector in range(16, 16 + MAX_DESCRIPTORS):
+            ident = self._read(sector)[1:6]
+            if ident in (b"NSR02", b"NSR03"):
+                return True
+            if ident not in (b"BEA01", b"CD001", b"CDW02", b"BOOT2", b"TEA01"):
+                return False
+        return False
+
+    def _open_udf(self):
+        anchor = self._read(256)
+        if tag_id(anchor) != TAG_AVDP:
+            raise DiscFSError("No UDF anchor at sector 256 of " + self.path)
+        length, location = struct.unpack_from("<II", anchor, 16)
+
+        partitions = {}
+        lvd = None
+        for sector in range(location, location + min(length // SECTOR, MAX_DESCRIPTORS)):
+            data = self._read(sector)
+            tag = tag_id(data)
+            if tag == TAG_PD:
+                number, = struct.unpack_from("<H", data, 22)
+                partitions[number], = struct.unpack_from("<I", data, 188)
+            elif tag == TAG_LVD:
+                lvd = data
+            elif tag == TAG_PVD and not self.label:
+                self.label = dstring(data[24:56])
+            elif tag == TAG_TD:
+                break
+        if lvd is None or not partitions:
+            raise DiscFSError("Incomplete UDF volume descriptors on " + self.path)
+
+        block_size, = struct.unpack_from("<I", lvd, 212)
+        if block_size != SECTOR:
+            raise DiscFSError("Unsupported UDF block size " + str(block_size))
+        self.label = dstring(lvd[84:212]) or self.label
+
+        # partition maps turn (partition reference, block) into sectors
+        self.maps = []
+        count, = struct.unpack_from("<I", lvd, 268)
+        pos = 440
+        for i in range(count):
+            maptype, maplen = lvd[pos], lvd[pos + 1]
+            if maptype == 1:
+                number, = struct.unpack_from("<H", lvd, pos + 4)
+                self.maps.append({'start': partitions[number], 'extents': None})
+            elif maptype == 2:
+                ident = lvd[pos + 5:pos + 28].rstrip(b"\0")
+                number, metafile, mirror = struct.unpack_from("<HII", lvd, pos + 38)
+                if ident == b"*UDF Metadata Partition":
+                    self.maps.append({'start': partitions[number], 'extents': None, 'metadata': (metafile, mirror)})
+                elif ident == b"*UDF Sparable Partition":
+                    self.maps.append({'start': partitions[number], 'extents': None})
+                else:
+                    raise DiscFSError("Unsupported UDF partition type " + ident.decode("ascii", "replace"))
+            else:
+                raise DiscFSError("Unknown UDF partition map type " + str(maptype))
+            pos += maplen
+
+        # the metadata partition is stored in a file on the physical partition
+        for partmap in self.maps:
+            if 'metadata' in partmap:
+                partmap['extents'] = self._metadata_extents(partmap)
+
+        fsd_lbn, fsd_ref = struct.unpack_from("<IH", lvd, 252)
+        fsd = self._read(self._sector(fsd_ref, fsd_lbn))
+        if tag_id(fsd) != TAG_FSD:
+            raise DiscFSError("No UDF file set descriptor on " + self.path)
+        self.fstype = "udf"
+        root_lbn, root_ref = struct.unpack_from("<IH", fsd, 404)
+        self.root = Entry("", True, (root_ref, root_lbn))
+
+    def _metadata_extents(self, partmap):
+        # try the mirror copy if the metadata file is unreadable
+        for lbn in partmap['metadata']:
+            try:
+                data = self._read(partmap['start'] + lbn)
+                info = self._udf_parse_entry(data, None)
+            except DiscFSError:
+                continue
+            extents = []
+            block = 0
+            for length, ref, pos, recorded in info['ads']:
+                blocks = (length + SECTOR - 1) // SECTOR
+                extents.append((block, blocks, pos))
+                block += blocks
+            return extents
+        raise DiscFSError("Unreadable UDF metadata file on " + self.path)
+
+    def _sector(self, ref, lbn):
+        partmap = self.maps[ref]
+        if partmap['extents'] is None:
+            return partmap['start'] + lbn
+        for block, blocks, pos in partmap['extents']:
+            if block <= lbn < block + blocks:
+                return partmap['start'] + pos + lbn - block
+        raise DiscFSError("Block " + str(lbn) + " is outside the UDF metadata partition")
+
+    def _udf_file_entry(self, location):
+        ref, lbn = location
+        return self._udf_parse_entry(self._read(self._sector(ref, lbn)), ref)
+
+    def _udf_parse_entry(self, data, ref):
+        tag = tag_id(data)
+        if tag == TAG_FE:
+            timestamp, l_ea_offset = 84, 168
+        elif tag == TAG_EFE:
+            timestamp, l_ea_offset = 92, 208
+        else:
+            raise DiscFSError("Expected a UDF file entry, found tag " + str(tag))
+
+        flags, = struct.unpack_from("<H", data, 34)
+        size, = struct.unpack_from("<Q", data, 56)
+        l_ea, l_ad = struct.unpack_from("<II", data, l_ea_offset)
+        start = l_ea_offset + 8 + l_ea
+        ads = data[start:start + l_ad]
+
+        info = {'size': size, 'mtime': udf_time(data[timestamp:timestamp + 12]), 'ads': [], 'embedded': None}
+        adtype = flags & 7
+        if adtype == 3:
+            info['embedded'] = ads[:size]
+        elif adtype == 0:
+            for pos in range(0, len(ads) - 7, 8):
+                length, position = struct.unpack_from("<II", ads, pos)
+                if length == 0:
+                    break
+                if length >> 30 == 3:
+                    raise DiscFSError("Continued UDF allocation descriptors are not supported")
+                info['ads'].append((length & 0x3FFFFFFF, ref, position, length >> 30 == 0))
+        elif adtype == 1:
+            for pos in range(0, len(ads) - 15, 16):
+                length, position, adref = struct.unpack_from("<IIH", ads, pos)
+                if length == 0:
+                    break
+                if length >> 30 == 3:
+                    raise DiscFSError("Continued UDF allocation descriptors are not supported")
+                info['ads'].append((length & 0x3FFFFFFF, adref, position, length >> 30 == 0))
+        else:
+            raise DiscFSError("Unsupported UDF allocation descriptor type " + str(adtype))
+        return info
+
+    def _udf_read(self, location, size=None):
+        info = self._udf_file_entry(location)
+        total = info['size'] if size is None else min(size, info['size'])
+        if info['embedded'] is not None:
+            return info['embedded'][:total]
+
+        chunks = []
+        remaining = total
+        for length, ref, pos, recorded in info['ads']:
+            if remaining <= 0:
+                break
+            want = min(length, remaining)
+            sectors = (want + SECTOR - 1) // SECTOR
+            if not recorded:
+                # allocated but unwritten extents read as zeros
+                chunks.append(b"\0" * want)
+            elif self.maps[ref]['extents'] is None:
+                chunks.append(self._read(self._sector(ref, pos), sectors)[:want])
+            else:
+                chunks.append(b"".join(self._read(self._sector(ref, pos + i)) for i in range(sectors))[:want])
+            remaining -= want
+        return b"".join(chunks)
+
+    def _udf_listdir(self, entry):
+        data = self._udf_read(entry.location)
+        entries = []
+        pos = 0
+        while pos + 38 <= len(data):
+            if tag_id(data[pos:]) != TAG_FID:
+                break
+            characteristics, l_fi = data[pos + 18], data[pos + 19]
+            lbn, ref = struct.unpack_from("<IH", data, pos + 24)
+            l_iu, = struct.unpack_from("<H", data, pos + 36)
+            name = data[pos + 38 + l_iu:pos + 38 + l_iu + l_fi]
+            pos += (38 + l_iu + l_fi + 3) // 4 * 4
+            if characteristics & (FID_PARENT | FID_DELETED):
+                continue
+            entries.append(Entry(osta_string(name), bool(characteristics & FID_DIRECTORY), (ref, lbn)))
+        return entries
+
+
+def tag_id(data):
+    """
+    Get the tag identifier of a UDF descriptor
+
+    Parameters:
+    data: bytes starting with the descriptor
+
+    Return value: tag identifier
+    """
+    return struct.unpack_from("<H", data, 0)[0]
+
+
+def osta_string(data):
+    """
+    Decode an OSTA compressed unicode string
+
+    Parameters:
+    data: bytes starting with the compression id (8 or 16)
+
+    Return value: decoded string
+    """
+    if not data:
+        return ""
+    if data[0] == 16:
+        return data[1:].decode("utf-16-be", "replace")
+    return data[1:].decode("latin-1")
+
+
+def dstring(data):
+    """
+    Decode a fixed length UDF dstring, whose last byte holds the length used
+
+    Parameters:
+    data: bytes of the field
+
+    Return value: decoded string
+    """
+    return osta_string(data[:data[-1]]).rstrip("\0 ") if data[-1] else ""
+
+
+def udf_time(data):
+    """
+    Convert a UDF timestamp to seconds since the epoch
+
+    Parameters:
+    data: 12 bytes of the timestamp
+
+    Return value: time in seconds since the epoch or None if the timestamp is invalid
+    """
+    typetz, year, month, day, hour, minute, second = struct.unpack_from("<HhBBBBB", data)
+    offset = typetz & 0xFFF
+    if offset >= 0x800:
+        offset -= 0x1000
+    if offset == -2047:
+        offset = 0  # no time zone specified
+    try:
+        return calendar.timegm(datetime.datetime(year, month, day, hour, minute, second).timetuple()) - offset * 60
+    except ValueError:
+        return None
+
+
+def iso_time(data):
+    """
+    Convert an ISO9660 directory record time to seconds since the epoch
+
+    Parameters:
+    data: 7 bytes of the recording date and time
+
+    Return value: time in seconds since the epoch or None if the time is invalid
+    """
+    year, month, day, hour, minute, second, offset = struct.unpack("<BBBBBBb", data)
+    try:
+        return calendar.timegm(datetime.datetime(1900 + year, month, day, hour, minute, second).timetuple()) - offset * 900
+    except ValueError:
+        return None
+
+
+def layout(path):
+    """
+    Get the top level layout of a disc, e.g. to tell DVDs (VIDEO_TS) from Blurays (BDMV)
+
+    Parameters:
+    path: path to the device or image file
+
+    Return value: dict of top level names to True for directories and False for files,
+                  or None if the file system couldn't be read
+    """
+    try:
+        with DiscFS(path) as fs:
+            logging.debug("Reading " + fs.fstype + " file system of " + path + " (label " + fs.label + ")")
+            return dict((e.name, e.is_dir) for e in fs.listdir("/"))
+    except (OSError, DiscFSError) + MALFORMED as fs_error:
+        logging.debug("Could not read the file system of " + path + ": " + str(fs_error))
+        return None
+
+
+def read_file(path, filename, size=None):
+    """
+    Read a small file from a disc, such as bdmt_eng.xml or an IFO header
+
+    Parameters:
+    path: path to the device or image file
+    filename: path of the file on the disc
+    size: optional maximum number of bytes to read
+
+    Return value: tuple of the contents and the modification time of the file
+    Raises OSError if the disc can't be read, DiscFSError if its file system can't be parsed
+    """
+    try:
+        with DiscFS(path) as fs:
+            entry = fs.stat(filename)
+            return fs.read(filename, size), entry.mtime
+    except MALFORMED as parse_error:
+        raise DiscFSError("malformed file system: " + repr(parse_error))
@@ -0,0 +1,293 @@
+#!/usr/bin/python3
+
+import os
+import time
+import fcntl
+import socket
+import select
+import logging
+import jobs
+
+from config import cfg
+
+# CDROM_DRIVE_STATUS ioctl and its results (linux/cdrom.h)
+CDROM_DRIVE_STATUS = 0x5326
+CDS_NO_INFO = 0
+CDS_NO_DISC = 1
+CDS_TRAY_OPEN = 2
+CDS_DRIVE_NOT_READY = 3
+CDS_DISC_OK = 4
+
+STATUS_NAMES = {
+    CDS_NO_INFO: "no info",
+    CDS_NO_DISC: "no disc",
+    CDS_TRAY_OPEN: "tray open",
+    CDS_DRIVE_NOT_READY: "not ready",
+    CDS_DISC_OK: "disc ok",
+}
+
+# Seconds between checks of a drive that is still loading a disc
+SETTLE_INTERVAL = 1
+
+# Largest event message accepted on the socket
+MAX_MESSAGE = 4096
+
+
+def drive_status(devpath):
+    """
+    Get the status of an optical drive without waiting for it
+
+    Parameters:
+    devpath: path to the drive
+
+    Return value: one of the CDS_* values, CDS_NO_INFO if the drive can't be read
+    """
+    try:
+        fd = os.open(devpath, os.O_RDONLY | os.O_NONBLOCK)
+    except OSError as open_error:
+        logging.debug("Failed to open device " + devpath + " to check status: " + str(open_error))
+        return CDS_NO_INFO
+    try:
+        return fcntl.ioctl(fd, CDROM_DRIVE_STATUS, 0)
+    except OSError:
+        return CDS_NO_INFO
+    finally:
+        os.close(fd)
+
+
+class Drive(object):
+    """
+    Tray state of an optical drive, so each inserted disc queues one job no
+    matter how many events the kernel and udev send for it
+
+    Attributes:
+        devpath
+        status: last drive status (CDS_* value)
+        settle_until: time until which a drive that is loading a disc is checked again, or None
+
+    Methods:
+        __init__(self, devpath)
+        update(self)
+    """
+
+    def __init__(self, devpath):
+        """
+        Constructor; reads the current status of the drive, so a disc that is
+        already in the drive doesn't count as inserted
+
+        Parameters:
+            devpath: path to the drive
+
+        Return value: None
+        """
+        self.devpath = devpath
+        self.status = drive_status(devpath)
+        self.settle_until = None
+
+    def update(self):
+        """
+        Read the drive status after an event.  A drive that is still loading a
+        disc is checked again every SETTLE_INTERVAL for up to
+        DRIVE_SETTLE_SECONDS, because it doesn't always send another event.
+
+        Parameters:
+            None
+
+        Return value: True if a disc was inserted, i.e. the drive has a disc and didn't before
+        """
+        previous = self.status
+        self.status = drive_status(self.devpath)
+        if self.status != previous:
+            logging.debug(self.devpath + ": " + STATUS_NAMES.get(previous, str(previous)) + " -> " +
+                          STATUS_NAMES.get(self.status, str(self.status)))
+
+        if self.status == CDS_DRIVE_NOT_READY:
+            if self.settle_until is None:
+                self.settle_until = time.time() + cfg['DRIVE_SETTLE_SECONDS']
+            elif time.time() > self.settle_until:
+                logging.info(self.devpath + " didn't become ready within " + str(cfg['DRIVE_SETTLE_SECONDS']) + " seconds")
+                self.settle_until = None
+            return False
+
+        self.settle_until = None
+        return self.status == CDS_DISC_OK and previous != CDS_DISC_OK
+
+
+class DriveMonitor(object):
+    """
+    Watches the optical drives and queues a job for every inserted disc.
+    Events come from udev (pyudev.Monitor) and from arm_wrapper.sh through the
+    ARM_SOCKET unix socket.  Both go through the same per-drive tray state, so
+    an event seen twice or a change event without a new disc queues nothing.
+
+    Attributes:
+        drives: dict of device path to Drive
+        context: pyudev context, or None if udev isn't available
+        monitor: pyudev monitor, or None
+        sock: event socket, or None
+
+    Methods:
+        __init__(self)
+        open_socket(self, path)
+        is_optical(self, devpath)
+        wait(self, timeout)
+        handle(self, action, devpath)
+        settle(self)
+    """
+
+    def __init__(self):
+        """
+        Constructor; starts listening for udev events and on ARM_SOCKET
+
+        Parameters:
+            None
+
+        Return value: None
+        """
+        self.drives = {}
+        self.context = None
+        self.monitor = None
+        try:
+            # without pyudev the worker still gets the events of arm_wrapper.sh
+            import pyudev
+            self.context = pyudev.Context()
+            for device in self.context.list_devices(subsystem="block", ID_CDROM="1"):
+                self.drives[device.device_node] = Drive(device.device_node)
+            self.monitor = pyudev.Monitor.from_netlink(self.context)
+            self.monitor.filter_by("block")
+            self.monitor.start()
+        except (OSError, ImportError) as udev_error:
+            logging.error("Could not listen for udev events, relying on arm_wrapper.sh: " + str(udev_error))
+            self.monitor = None
+        self.sock = self.open_socket(cfg['ARM_SOCKET'])
+        logging.info("Watching optical drives " + ", ".join(sorted(self.drives)))
+
+    def open_socket(self, path):
+        """
+        Create the socket arm_wrapper.sh sends events to
+
+        Parameters:
+            path: path of the unix socket, or empty for none
+
+        Return value: socket, or None if it couldn't be created
+        """
+        if not path:
+            return None
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.bind(path)
+            sock.setblocking(False)
+            os.chmod(path, 0o660)
+            return sock
+        except OSError as socket_error:
+            logging.error("Could not create event socket " + path + ": " + str(socket_error))
+            return None
+
+    def is_optical(self, devpath):
+        """
+        Check whether a device reported by arm_wrapper.sh is an optical drive
+
+        Parameters:
+            devpath: path to the device
+
+        Return value: True for an optical drive
+        """
+        if devpath in self.drives:
+            return True
+        if self.context is None:
+            return drive_status(devpath) != CDS_NO_INFO
+        import pyudev
+        try:
+            return pyudev.Devices.from_device_file(self.context, devpath).get("ID_CDROM") == "1"
+        except (pyudev.DeviceNotFoundError, ValueError):
+            return False
+
+    def wait(self, timeout):
+        """
+        Handle drive events for up to timeout seconds
+
+        Parameters:
+            timeout: seconds to wait
+
+        Return value: True as soon as a job was queued, False if none was queued in time
+        """
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            if any(d.settle_until is not None for d in self.drives.values()):
+                remaining = min(remaining, SETTLE_INTERVAL)
+
+            sources = [s for s in (self.monitor, self.sock) if s is not None]
+            if sources:
+                readable = select.select(sources, [], [], remaining)[0]
+            else:
+                time.sleep(remaining)
+                readable = []
+
+            queued = False
+            if self.monitor in readable:
+                for device in iter(lambda: self.monitor.poll(timeout=0), None):
+                    if device.device_node and device.get("ID_CDROM") == "1":
+                        queued = self.handle(device.action, device.device_node) or queued
+            if self.sock in readable:
+                while True:
+                    try:
+                        message = self.sock.recv(MAX_MESSAGE).decode("utf-8", "replace").split()
+                    except BlockingIOError:
+                        break
+                    if len(message) == 2 and self.is_optical(jobs.normalize_devpath(message[1])):
+                        queued = self.handle(message[0], jobs.normalize_devpath(message[1])) or queued
+            queued = self.settle() or queued
+            if queued:
+                return True
+
+    def handle(self, action, devpath):
+        """
+        Update the state of a drive after an event and queue a job for a new disc
+
+        Parameters:
+            action: udev action, "change", "add" or "remove"
+            devpath: path to the drive
+
+        Return value: True if a job was queued
+        """
+        if action in ("add", "remove"):
+            logging.info("Optical drive " + devpath + " " + action + ", forgetting MakeMKV drive numbers")
+            import makemkv
+            makemkv.invalidate_drive_cache()
+            if action == "remove":
+                self.drives.pop(devpath, None)
+            else:
+                self.drives[devpath] = Drive(devpath)
+            return False
+
+        drive = self.drives.get(devpath)
+        if drive is None:
+            drive = self.drives[devpath] = Drive(devpath)
+            drive.status = CDS_NO_INFO
+        if not drive.update():
+            return False
+        logging.info("Disc inserted in " + devpath)
+        jobs.enqueue(devpath)
+        return True
+
+    def settle(self):
+        """
+        Check the drives that were still loading a disc
+
+        Parameters:
+            None
+
+        Return value: True if a job was queued
+        """
+        queued = False
+        for devpath, drive in list(self.drives.items()):
+            if drive.settle_until is not None and drive.update():
+                logging.info("Disc inserted in " + devpath)
+                jobs.enqueue(devpath)
+                queued = True
+        return queued
@@ -0,0 +1,179 @@
+#!/usr/bin/python3
+
+import os
+import time
+import logging
+import db
+import utils
+
+from config import cfg
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS emby_updates (
+    path TEXT PRIMARY KEY,
+    created REAL
+);
+"""
+
+# Path recorded when a job doesn't know where its files went, asking for a full library refresh
+FULL_REFRESH = ""
+
+
+def queue(paths=None):
+    """
+    Ask for Emby to pick up new files.  The paths of every job are collected in
+    the ARM database and sent by the worker (see dispatch), or by a job run
+    without the worker when it exits (see flush), once no job has added one for
+    EMBY_DEBOUNCE_SECONDS, so drives finishing close together cause a single
+    update.
+
+    Parameters:
+    paths: list of files or directories written, or None if they aren't known and the whole library has to be refreshed
+
+    Return value: None
+    """
+    if not cfg['EMBY_REFRESH']:
+        logging.info("EMBY_REFRESH config parameter is false.  Skipping emby scan.")
+        return
+
+    paths = [FULL_REFRESH] if paths is None else [p for p in paths if p]
+    if not paths:
+        return
+    now = time.time()
+    conn = db.connect(SCHEMA)
+    conn.execute("BEGIN")
+    for path in paths:
+        conn.execute("INSERT OR REPLACE INTO emby_updates (path, created) VALUES (?, ?)", (path, now))
+    conn.execute("COMMIT")
+    conn.close()
+    logging.info("Queued Emby library update for " + ", ".join(p or "the whole library" for p in paths))
+
+
+def server_path(path):
+    """
+    Translate a path under MEDIA_DIR to where the Emby server sees it (EMBY_MEDIA_DIR)
+
+    Parameters:
+    path: local path
+
+    Return value: path on the Emby server
+    """
+    if not cfg['EMBY_MEDIA_DIR']:
+        return path
+    relpath = os.path.relpath(path, cfg['MEDIA_DIR'])
+    if relpath.startswith(os.pardir):
+        return path
+    return os.path.join(cfg['EMBY_MEDIA_DIR'], relpath)
+
+
+def base_url():
+    """ URL of the Emby server """
+    return "http://" + cfg['EMBY_SERVER'] + ":" + str(cfg['EMBY_PORT'])
+
+
+def refresh():
+    """
+    Refresh the whole Emby library
+
+    Parameters:
+    None
+
+    Return value: None.  Raises requests.exceptions.RequestException if the request failed.
+    """
+    logging.info("Sending Emby library scan request")
+    response = utils.http_session().post(base_url() + "/Library/Refresh", params={'api_key': cfg['EMBY_API_KEY']},
+                                         timeout=cfg['EMBY_TIMEOUT'])
+    response.raise_for_status()
+    logging.info("Emby Library Scan request successful")
+
+
+def media_updated(paths):
+    """
+    Tell Emby about new files, so it only scans the folders they are in
+
+    Parameters:
+    paths: list of local paths
+
+    Return value: None.  Raises requests.exceptions.RequestException if the request failed.
+    """
+    logging.info("Sending Emby media update for " + str(len(paths)) + " path(s)")
+    updates = [{'Path': server_path(p), 'UpdateType': "Created"} for p in paths]
+    response = utils.http_session().post(base_url() + "/Library/Media/Updated", params={'api_key': cfg['EMBY_API_KEY']},
+                                         json={'Updates': updates}, timeout=cfg['EMBY_TIMEOUT'])
+    response.raise_for_status()
+    logging.info("Emby media update request successful")
+
+
+def dispatch(debounce=0):
+    """
+    Send the queued updates once none has been added for debounce seconds.
+    Paths are sent with one targeted media update.  The whole library is
+    refreshed instead when a job asked for it, when there are more than
+    EMBY_MAX_PATHS paths, or when the server doesn't accept the targeted
+    update.  Failed requests are kept and tried again on the next call.
+
+    Parameters:
+    debounce: seconds the queue must have been quiet
+
+    Return value: True if an update was sent
+    """
+    try:
+        conn = db.connect(SCHEMA)
+        rows = conn.execute("SELECT path, created FROM emby_updates").fetchall()
+    except Exception as queue_error:
+        logging.error("Could not read the Emby update queue: " + str(queue_error))
+        return False
+    if not rows or max(r['created'] for r in rows) > time.time() - debounce:
+        conn.close()
+        return False
+
+    import requests
+    paths = sorted(r['path'] for r in rows)
+    try:
+        if FULL_REFRESH in paths or len(paths) > cfg['EMBY_MAX_PATHS']:
+            refresh()
+        else:
+            try:
+                media_updated(paths)
+            except requests.exceptions.RequestException as update_error:
+                logging.warning("Emby media update failed, refreshing the whole library instead: " + str(update_error))
+                refresh()
+    except requests.exceptions.RequestException as refresh_error:
+        logging.error("Emby Library Scan request failed: " + str(refresh_error))
+        conn.close()
+        return False
+
+    # only remove what was sent; a job may have queued more in the meantime
+    conn.execute("BEGIN")
+    for row in rows:
+        conn.execute("DELETE FROM emby_updates WHERE path = ? AND created = ?", (row['path'], row['created']))
+    conn.execute("COMMIT")
+    conn.close()
+    return True
+
+
+def flush():
+    """
+    Send the queued updates before a job run without the worker exits.  Waits
+    until the newest one is EMBY_DEBOUNCE_SECONDS old, so jobs finishing close
+    together still cause a single update.  Nothing is sent if another job
+    queued more in the meantime; that job or the worker sends them.
+
+    Parameters:
+    None
+
+    Return value: None
+    """
+    try:
+        conn = db.connect(SCHEMA)
+        newest = conn.execute("SELECT MAX(created) FROM emby_updates").fetchone()[0]
+        conn.close()
+    except Exception as queue_error:
+        logging.error("Could not read the Emby update queue: " + str(queue_error))
+        return
+    if newest is None:
+        return
+    wait = newest + cfg['EMBY_DEBOUNCE_SECONDS'] - time.time()
+    if wait > 0:
+        time.sleep(wait)
+    dispatch(cfg['EMBY_DEBOUNCE_SECONDS'])
@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+
+import os
+import time
+import fcntl
+import errno
+import shutil
+import logging
+import datacopy
+import concurrent.futures
+
+from config import cfg
+
+# ioctl cloning a whole file (linux/fs.h), supported by btrfs, xfs and other reflink capable file systems
+FICLONE = 0x40049409
+
+# Bytes copied or compared at a time
+CHUNK = 67108864
+
+# Errors meaning a file can't be cloned or renamed to its destination, so it has to be copied
+NO_CLONE = (errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY, errno.EBADF, errno.ENOSYS, errno.EPERM)
+
+# Suffix of a partly copied file
+PARTIAL = ".armpart"
+
+
+class VerifyError(OSError):
+    """
+    Raised when a copied file doesn't match its source.  The source is kept.
+    """
+
+
+def move(src, dest, on_progress=None):
+    """
+    Move a file, using the cheapest method that works between the two
+    directories: a rename on the same file system, a reflink clone on file
+    systems that share extents (btrfs, xfs), or else a copy with
+    copy_file_range.  Clones and copies are written to a temporary file next to
+    the destination, synced, checked against the source (MOVE_VERIFY) and only
+    then renamed into place, before the source is removed.  A failed move
+    leaves the source as it was.
+
+    Parameters:
+    src: path of the file to move
+    dest: destination path, or a directory to move the file into
+    on_progress: optional function called with progress event dicts while copying
+
+    Return value: method used, "rename", "reflink" or "copy"
+    """
+    if os.path.isdir(dest):
+        dest = os.path.join(dest, os.path.basename(src))
+    if os.path.isdir(src):
+        shutil.move(src, dest)
+        return "rename"
+
+    try:
+        os.rename(src, dest)
+        return "rename"
+    except OSError as rename_error:
+        if rename_error.errno != errno.EXDEV:
+            raise
+
+    tmpfile = dest + PARTIAL
+    start = time.time()
+    try:
+        method = clone_or_copy(src, tmpfile, on_progress)
+        shutil.copystat(src, tmpfile)
+        if method == "copy" and cfg['MOVE_VERIFY']:
+            verify(src, tmpfile)
+        elif os.path.getsize(src) != os.path.getsize(tmpfile):
+            raise VerifyError(errno.EIO, "Copy of " + src + " is incomplete")
+        os.rename(tmpfile, dest)
+        sync_dir(os.path.dirname(dest))
+    except BaseException:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+    os.remove(src)
+
+    seconds = time.time() - start
+    logging.info("Moved " + src + " to " + dest + " by " + method + " (" + datacopy.megabytes(os.path.getsize(dest)) +
+                 " MB in " + str(round(seconds, 1)) + " s)")
+    return method
+
+
+def clone_or_copy(src, dest, on_progress=None):
+    """
+    Write a copy of a file, cloning it where the file system supports it
+
+    Parameters:
+    src: path of the file to copy
+    dest: path of the new file
+    on_progress: optional function called with progress event dicts while copying
+
+    Return value: "reflink" or "copy"
+    """
+    srcfd = os.open(src, os.O_RDONLY)
+    try:
+        destfd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            try:
+                fcntl.ioctl(destfd, FICLONE, srcfd)
+                method = "reflink"
+            except OSError as clone_error:
+                if clone_error.errno not in NO_CLONE:
+                    raise
+                method = "copy"
+                size = os.fstat(srcfd).st_size
+                progress = datacopy.Progress(src, on_progress)
+                progress.size = size
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(srcfd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                copied = datacopy.kernel_copy(srcfd, destfd, size, CHUNK, progress)[0]
+                if copied < size:
+                    datacopy.stream_copy(srcfd, destfd, copied, CHUNK, [], progress)
+            os.fsync(destfd)
+        finally:
+            os.close(destfd)
+    finally:
+        os.close(srcfd)
+    return method
+
+
+def verify(src, copy):
+    """
+    Compare a copy with its source.  The copy is dropped from the page cache
+    first, so it is read back from the disk it was written to.
+
+    Parameters:
+    src: path of the source
+    copy: path of the copy
+
+    Return value: None.  Raises VerifyError if the files differ.
+    """
+    with open(src, "rb", buffering=0) as a, open(copy, "rb", buffering=0) as b:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(b.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            os.posix_fadvise(a.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(b.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        offset = 0
+        while True:
+            block = a.read(CHUNK)
+            if block != b.read(len(block) or 1):
+                raise VerifyError(errno.EIO, "Copy of " + src + " differs from the source at byte " + str(offset))
+            if not block:
+                return
+            offset += len(block)
+
+
+def sync_dir(path):
+    """
+    Flush a directory, so a file renamed into it survives a crash
+
+    Parameters:
+    path: path of the directory
+
+    Return value: None
+    """
+    fd = os.open(path or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def move_all(moves):
+    """
+    Move independent files concurrently, MOVE_CONCURRENCY at a time.  Failed
+    moves are logged and don't stop the others.
+
+    Parameters:
+    moves: list of (source, destination) tuples
+
+    Return value: dict of source path to the method used, or None if the move failed
+    """
+    results = {}
+    if not moves:
+        return results
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, cfg['MOVE_CONCURRENCY'])) as executor:
+        futures = dict((executor.submit(move, src, dest), src) for src, dest in moves)
+        for future in concurrent.futures.as_completed(futures):
+            src = futures[future]
+            try:
+                results[src] = future.result()
+            except (OSError, shutil.Error) as move_error:
+                logging.error("Unable to move '" + src + "': " + str(move_error))
+                results[src] = None
+    return results
@@ -1,17 +1,19 @@
 #!/usr/bin/python3
 
 import argparse
-import urllib
 import os
 import datetime
-import pydvdid
 import unicodedata
-import xmltodict
 import sys # noqa # pylint: disable=unused-import
 import re
 import logging
 import logger # noqa # pylint: disable=unused-import
 import classes # noqa # pylint: disable=unused-import
+import metacache
+import utils
+import discfs
+
+from config import cfg
 
 
 def entry():
@@ -25,43 +27,70 @@ def entry():
 def getdvdtitle(disc):
     """ Calculates CRC64 for the DVD and calls Windows Media
         Metaservices and returns the Title and year of DVD """
+    import pydvdid
     logging.debug(str(disc))
 
     crc64 = pydvdid.compute(str(disc.mountpoint))
     # crc64 = pydvdid.compute("/mnt/dev/sr1")
     logging.info("DVD CRC64 hash is: " + str(crc64))
+
+    cached, result = metacache.lookup("dvd_crc64", str(crc64))
+    if cached:
+        if result is None:
+            logging.info("DVD is cached as not in the Windows Media database")
+            return[None, None]
+        logging.info("Using cached Windows Media result for DVD")
+        return[result[0], result[1]]
+
     urlstring = "http://metaservices.windowsmedia.com/pas_dvd_B/template/GetMDRDVDByCRC.xml?CRC={0}".format(str(crc64))
     logging.debug(urlstring)
 
     try:
-        dvd_info_xml = urllib.request.urlopen(
-            "http://metaservices.windowsmedia.com/pas_dvd_B/template/GetMDRDVDByCRC.xml?CRC={0}".
-            format(crc64)).read()
+        response = utils.http_session().get(urlstring, timeout=cfg['METADATA_TIMEOUT'])
+        response.raise_for_status()
     except OSError as e:
-        logging.error("Failed to reach windowsmedia web service")
+        logging.error("Failed to reach windowsmedia web service: " + str(e))
         return[None, None]
 
+    import xmltodict
+    from xml.parsers.expat import ExpatError
+    try:
+        doc = xmltodict.parse(response.content)
+    except ExpatError as e:
+        # e.g. an error page; not cached, the next try may get an answer
+        logging.error("Windows Media request returned an invalid document: " + str(e))
+        return[None, None]
     try:
-        doc = xmltodict.parse(dvd_info_xml)
         dvd_title = doc['METADATA']['MDR-DVD']['dvdTitle']
         dvd_release_date = doc['METADATA']['MDR-DVD']['releaseDate']
         dvd_title = dvd_title.strip()
         dvd_release_date = dvd_release_date.split()[0]
-    except KeyError:
+    except (KeyError, TypeError, AttributeError, IndexError):
         logging.error("Windows Media request returned no result.  Likely the DVD is not in their database.")
+        # only a metadata document without the DVD is an answer worth remembering
+        if isinstance(doc, dict) and isinstance(doc.get('METADATA'), dict) and 'MDR-DVD' not in doc['METADATA']:
+            metacache.store("dvd_crc64", str(crc64), None)
         return[None, None]
 
+    metacache.store("dvd_crc64", str(crc64), [dvd_title, dvd_release_date])
     return[dvd_title, dvd_release_date]
 
 
 def getbluraytitle(disc):
-    """ Get's Blu-Ray title by parsing XML in bdmt_eng.xml """
+    """ Get's Blu-Ray title by parsing XML in bdmt_eng.xml, read straight from the disc """
     try:
-        with open(disc.mountpoint + '/BDMV/META/DL/bdmt_eng.xml', "rb") as xml_file:
-            doc = xmltodict.parse(xml_file.read())
-    except OSError as e:
-        logging.error("Disc is a bluray, but bdmt_eng.xml could not be found.  Disc cannot be identified.")
-        return[None, None]
+        xml, bluray_modified_timestamp = discfs.read_file(disc.devpath, '/BDMV/META/DL/bdmt_eng.xml')
+    except (OSError, discfs.DiscFSError):
+        # fall back to the mounted disc
+        try:
+            with open(disc.mountpoint + '/BDMV/META/DL/bdmt_eng.xml', "rb") as xml_file:
+                xml = xml_file.read()
+            bluray_modified_timestamp = os.path.getmtime(disc.mountpoint + '/BDMV/META/DL/bdmt_eng.xml')
+        except OSError as e:
+            logging.error("Disc is a bluray, but bdmt_eng.xml could not be found.  Disc cannot be identified.")
+            return[None, None]
+    import xmltodict
+    doc = xmltodict.parse(xml)
 
     try:
         bluray_title = doc['disclib']['di:discinfo']['di:title']['di:name']
@@ -69,8 +98,10 @@ def getbluraytitle(disc):
         logging.error("Could not parse title from bdmt_eng.xml file.  Disc cannot be identified.")
         return[None, None]
 
-    bluray_modified_timestamp = os.path.getmtime(disc.mountpoint + '/BDMV/META/DL/bdmt_eng.xml')
-    bluray_year = (datetime.datetime.fromtimestamp(bluray_modified_timestamp).strftime('%Y'))
+    if bluray_modified_timestamp is None:
+        bluray_year = "0000"
+    else:
+        bluray_year = (datetime.datetime.fromtimestamp(bluray_modified_timestamp).strftime('%Y'))
 
     bluray_title = unicodedata.normalize('NFKD', bluray_title).encode('ascii', 'ignore').decode()
 
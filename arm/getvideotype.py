@@ -2,12 +2,14 @@
 
 import sys # noqa # pylint: disable=unused-import
 import argparse
-import urllib
 import os # noqa # pylint: disable=unused-import
-import xmltodict # noqa # pylint: disable=unused-import
 import logging
 import json
 import re
+import time
+import concurrent.futures
+import metacache
+import utils
 
 from config import cfg
 
@@ -23,40 +25,68 @@ def entry():
 
 def getdvdtype(disc):
     """ Queries OMDbapi.org for title information and parses if it's a movie
-        or a tv series """
+        or a tv series.  All candidate titles (see candidates) are queried at
+        once; the first candidate that is found wins.  Candidates without an
+        answer within METADATA_TIMEOUT seconds count as not found; queries that
+        haven't started by then are cancelled and answers arriving later are
+        not cached. """
 
     dvd_title = disc.videotitle
     # needs_new_year = False
     omdb_api_key = cfg['OMDB_API_KEY']
+    timeout = cfg['METADATA_TIMEOUT']
 
     logging.debug("Title: " + dvd_title)
 
-    dvd_title_clean = cleanupstring(dvd_title)
+    queries = candidates(dvd_title)
+    logging.debug("Calling webservice with titles: " + ", ".join(queries))
+
+    deadline = time.time() + timeout
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(len(queries), utils.HTTP_POOL_SIZE))
+    futures = [executor.submit(callwebservice, omdb_api_key, query, "", timeout, deadline) for query in queries]
+    # don't wait for lower priority queries once a match is found
+    executor.shutdown(wait=False)
 
-    logging.debug("Calling webservice with title: " + dvd_title_clean)
-    dvd_type, dvd_year = callwebservice(omdb_api_key, dvd_title_clean, "")
-    logging.debug("dvd_type: " + dvd_type)
+    try:
+        for query, future in zip(queries, futures):
+            try:
+                dvd_type, dvd_year = future.result(timeout=max(0, deadline - time.time()))
+            except concurrent.futures.TimeoutError:
+                logging.warning("Webservice didn't answer in time for title: " + query)
+                continue
+            logging.debug("dvd_type for " + query + ": " + dvd_type)
+            if dvd_type != "fail":
+                return (dvd_type, dvd_year)
+    finally:
+        # queries still waiting for a thread are not sent at all
+        for future in futures:
+            future.cancel()
+
+    return ("fail", None)
+
+
+def candidates(dvd_title):
+    """ Returns the titles to try for a disc title, best first: the whole
+        title, the part before a hyphen, then the title with words removed
+        from the end one at a time """
 
-    # handle failures
-    # this is a little kludgy, but it kind of works...
-    if (dvd_type == "fail"):
+    dvd_title_clean = cleanupstring(dvd_title)
+    queries = [dvd_title_clean]
 
-        # second see if there is a hyphen and split it
-        if dvd_title.find("-") > -1:
-            dvd_title_slice = dvd_title[:dvd_title.find("-")]
-            dvd_title_slice = cleanupstring(dvd_title_slice)
-            logging.debug("Trying title: " + dvd_title_slice)
-            dvd_type, dvd_year = callwebservice(omdb_api_key, dvd_title_slice)
-            logging.debug("dvd_type: " + dvd_type)
+    # second see if there is a hyphen and split it
+    if dvd_title.find("-") > -1:
+        queries.append(cleanupstring(dvd_title[:dvd_title.find("-")]))
 
-        # if still failing, then try slicing off the last word in a loop
-        while dvd_type == "fail" and dvd_title_clean.count('+') > 0:
-            dvd_title_clean = dvd_title_clean.rsplit('+', 1)[0]
-            logging.debug("Trying title: " + dvd_title_clean)
-            dvd_type, dvd_year = callwebservice(omdb_api_key, dvd_title_clean)
-            logging.debug("dvd_type: " + dvd_type)
+    # then try slicing off the last word
+    while dvd_title_clean.count('+') > 0:
+        dvd_title_clean = dvd_title_clean.rsplit('+', 1)[0]
+        queries.append(dvd_title_clean)
 
-    return (dvd_type, dvd_year)
+    unique = []
+    for query in queries:
+        if query and query not in unique:
+            unique.append(query)
+    return unique
 
 
 def cleanupstring(string):
@@ -65,27 +95,52 @@ def cleanupstring(string):
     return re.sub('[_ ]', "+", string)
 
 
-def callwebservice(omdb_api_key, dvd_title, year=""):
+def callwebservice(omdb_api_key, dvd_title, year="", timeout=None, deadline=None):
     """ Queries OMDbapi.org for title information and parses if it's a movie
-        or a tv series """
+        or a tv series.  timeout defaults to METADATA_TIMEOUT seconds.  An
+        answer arriving after deadline (a time.time() value), when the caller
+        has stopped waiting for it, is not cached. """
 
     logging.debug("***Calling webservice with Title: " + dvd_title + " and Year: " + year)
+
+    # OMDb misses are cached too, so the title trimming in getdvdtype doesn't repeat the same failed queries
+    key = metacache.normalize(dvd_title) + "|" + year
+    cached, result = metacache.lookup("omdb", key)
+    if cached:
+        if result is None:
+            logging.debug("Webservice failed (cached)")
+            return "fail", None
+        logging.debug("Webservice successful (cached)")
+        return (result[0], result[1])
+
     try:
         strurl = "http://www.omdbapi.com/?t={1}&y={2}&plot=short&r=json&apikey={0}".format(omdb_api_key, dvd_title, year)
         logging.debug("http://www.omdbapi.com/?t={1}&y={2}&plot=short&r=json&apikey={0}".format("key_hidden", dvd_title, year))
-        dvd_title_info_json = urllib.request.urlopen(strurl).read()
-    except Exception:
-        logging.debug("Webservice failed")
+        response = utils.http_session().get(strurl, timeout=timeout or cfg['METADATA_TIMEOUT'])
+        # requests doesn't raise for error statuses; an error page isn't an answer either
+        response.raise_for_status()
+        doc = json.loads(response.content.decode())
+        if not isinstance(doc, dict) or 'Response' not in doc or doc['Response'] != "False" and not ('Type' in doc and 'Year' in doc):
+            raise ValueError("unexpected document " + repr(doc)[:100])
+    except Exception as service_error:
+        logging.debug("Webservice failed: " + str(service_error))
         return "fail", None
     else:
-        doc = json.loads(dvd_title_info_json.decode())
+        late = deadline is not None and time.time() > deadline
+        if late:
+            logging.debug("Webservice answered after the deadline, not caching the answer for " + dvd_title)
         if doc['Response'] == "False":
-            logging.debug("Webservice failed with error: " + doc['Error'])
+            logging.debug("Webservice failed with error: " + doc.get('Error', ""))
+            # only a miss is an answer; errors like "Request limit reached!" may not happen next time
+            if doc.get('Error') in ("Movie not found!", "Series not found!") and not late:
+                metacache.store("omdb", key, None)
             return "fail", None
         else:
             media_type = doc['Type']
             year = re.sub(r'[^\x00-\x7f]',r'', doc['Year'])
             logging.debug("Webservice successful.  Document returned is: " + json.dumps(doc))
+            if not late:
+                metacache.store("omdb", key, [media_type, year])
             return (media_type, year)
 
 
@@ -1,32 +1,45 @@
 #!/usr/bin/python3
 
-import sys
 import os
 import logging
 import subprocess
 import re
 import shlex
+import json
+import shutil
+import concurrent.futures
 import utils
+import jobs
+import runner
+import dedupe
+import fileops
 
 from config import cfg
 
+# Allowed difference, in seconds, between the length of an encode and its source before the
+# raw file is deleted.  Longer titles may differ by up to 1%.
+ENCODE_TOLERANCE = 5
+
+# Whether FFPROBE_CLI was found, None until it is looked for (see ffprobe_available)
+_ffprobe = None
+
 
 def handbrake_mainfeature(srcpath, basepath, logfile, disc):
     """
-    Rips DVD main feature only
+    Rips DVD main feature only, or transcodes the main feature ripped from a Bluray
 
     Parameters:
-    srcpath: Path to source for HB (dvd or files)
+    srcpath: Path to source for HB (dvd, or the mkv file of a Bluray main feature)
     basepath: Path where HB will save trancoded files
     logfile: Logfile for HB to redirect output to
     disc: Disc object
 
     Return value: True for successful operation, False otherwise
     """
-    logging.info("Starting DVD Movie Mainfeature processing")
+    logging.info("Starting " + disc.disctype.upper() + " Movie Mainfeature processing")
 
-    filename = os.path.join(basepath, disc.videotitle + ".mkv")
-    filepathname = os.path.join(basepath, filename)
+    # the file is named after the title once the encode is done, the title may still be looked up
+    filepathname = os.path.join(basepath, "mainfeature_" + str(os.getpid()) + ".mkv")
 
     logging.info("Ripping title Mainfeature to " + shlex.quote(filepathname))
 
@@ -37,33 +50,30 @@ def handbrake_mainfeature(srcpath, basepath, logfile, disc):
         hb_args = cfg['HB_ARGS_BD']
         hb_preset = cfg['HB_PRESET_BD']
 
-    cmd = 'nice {0} -i {1} -o {2} --main-feature --preset "{3}" {4} >> {5} 2>&1'.format(
-        cfg['HANDBRAKE_CLI'],
-        shlex.quote(srcpath),
-        shlex.quote(filepathname),
-        hb_preset,
-        hb_args,
-        logfile
-        )
+    main_title = None
+    if cfg['HB_CHAPTER_SPLIT']:
+        titles = scan_titles(srcpath, disc)
+        for title in sorted(titles):
+            if titles[title]['mainfeature'] and should_split(titles[title]):
+                main_title = titles[title]
 
-    logging.debug("Sending command: %s", (cmd))
+    if main_title is not None:
+        if not encode_split(srcpath, main_title, filepathname, hb_preset, hb_args, logfile, disc):
+            return False
+    else:
+        cmd = ["nice", cfg['HANDBRAKE_CLI'], "-i", srcpath, "-o", filepathname, "--main-feature", "--preset", hb_preset] + shlex.split(hb_args)
 
-    try:
-        subprocess.check_output(
-            cmd,
-            shell=True
-        ).decode("utf-8")
-        logging.info("Handbrake call successful")
-    except subprocess.CalledProcessError as hb_error:
-        err = "Call to handbrake failed with code: " + str(hb_error.returncode) + "(" + str(hb_error.output) + ")"
-        logging.error(err)
-#        sys.exit(err)
-        return False
+        if not run_handbrake("title Mainfeature", cmd, logfile, disc):
+            return False
 
     logging.info("Handbrake processing complete")
+    disc.wait_identified()
+    filename = disc.videotitle + ".mkv"
+    os.rename(filepathname, os.path.join(basepath, filename))
     logging.debug(str(disc))
-    utils.move_files(basepath, filename, disc.hasnicetitle, disc.videotitle + " (" + disc.videoyear + ")", True)
-    utils.scan_emby()
+    target = utils.move_files(basepath, filename, disc.hasnicetitle, disc.videotitle + " (" + disc.videoyear + ")", True)
+    if target is not None:
+        utils.scan_emby([target])
 
     try:
         os.rmdir(basepath)
@@ -87,54 +97,20 @@ def handbrake_all(srcpath, basepath, logfile, disc):
     """
     logging.info("Starting BluRay/DVD transcoding - All titles")
 
-    # get number of titles
+    # get all titles with a single scan
     logging.info("Getting total number of titles on disc.  This will take a minute or two...")
-    cmd = '{0} -i {1} -t 0 --scan'.format(
-        cfg['HANDBRAKE_CLI'],
-        shlex.quote(srcpath)
-        )
+    titles = scan_titles(srcpath, disc)
 
-    logging.debug("Sending command: %s", (cmd))
+    if not titles:
+        raise ValueError("Couldn't get total number of tracks", "handbrake_all")
 
-    try:
-        hb = subprocess.run(
-            cmd,
-            stderr=subprocess.PIPE,
-            shell=True
-        )
-    except subprocess.CalledProcessError as hb_error:
-        err = "Call to handbrake failed with code: " + str(hb_error.returncode) + "(" + str(hb_error.output) + ")"
-        logging.error(err)
-        sys.exit(err)
+    logging.info("Found " + str(len(titles)) + " titles")
 
-    titles = 0
     mt_track = 0
-    prevline = ""
-    for line in hb.stderr.decode(errors='ignore').splitlines(True):
-        # get number of titles on disc
-        # pattern = re.compile(r'\bscan\:.*\btitle\(s\)')
-
-        if disc.disctype == "bluray":
-            result = re.search('scan: BD has (.*) title\(s\)', line)
-        else:
-            result = re.search('scan: DVD has (.*) title\(s\)', line)
-
-        if result:
-            titles = result.group(1)
-            titles = titles.strip()
-            logging.debug("Line found is: " + line)
-            logging.info("Found " + titles + " titles")
-
-        # get main feature title number
-        if(re.search("Main Feature", line)) is not None:
-            t = prevline.split()
-            mt_track = re.sub('[:]', '', (t[2]))
-            logging.debug("Lines found are: 1) " + line.rstrip() + " | 2)" + prevline)
-            logging.info("Main Feature is title #" + mt_track)
-        prevline = line
-
-    if titles == 0:
-        raise ValueError("Couldn't get total number of tracks", "handbrake_all")
+    for title in sorted(titles):
+        if titles[title]['mainfeature']:
+            mt_track = title
+            logging.info("Main Feature is title #" + str(mt_track))
 
     mt_track = str(mt_track).strip()
 
@@ -145,65 +121,82 @@ def handbrake_all(srcpath, basepath, logfile, disc):
         hb_args = cfg['HB_ARGS_BD']
         hb_preset = cfg['HB_PRESET_BD']
 
-    for title in range(1, int(titles) + 1):
+    minlength = cfg['MINLENGTH']
+    maxlength = cfg['MAXLENGTH']
+
+    selected = []
+    for title in sorted(titles):
 
         # get length
-        tlength = get_title_length(title, srcpath)
+        tlength = titles[title]['duration']
 
-        if tlength < int(cfg['MINLENGTH']):
+        if tlength < minlength:
             # too short
-            logging.info("Track #" + str(title) + " of " + str(titles) + ". Length (" + str(tlength) +
-                         ") is less than minimum length (" + cfg['MINLENGTH'] + ").  Skipping")
-        elif tlength > int(cfg['MAXLENGTH']):
+            logging.info("Track #" + str(title) + " of " + str(len(titles)) + ". Length (" + str(tlength) +
+                         ") is less than minimum length (" + str(cfg['MINLENGTH']) + ").  Skipping")
+        elif tlength > maxlength:
             # too long
-            logging.info("Track #" + str(title) + " of " + str(titles) + ". Length (" + str(tlength) +
-                         ") is greater than maximum length (" + cfg['MAXLENGTH'] + ").  Skipping")
+            logging.info("Track #" + str(title) + " of " + str(len(titles)) + ". Length (" + str(tlength) +
+                         ") is greater than maximum length (" + str(cfg['MAXLENGTH']) + ").  Skipping")
+        elif jobs.title_done(disc, title):
+            # finished by an earlier run of this job
+            logging.info("Track #" + str(title) + " of " + str(len(titles)) + " was already transcoded.  Skipping")
         else:
             # just right
-            logging.info("Processing track #" + str(title) + " of " + str(titles) + ". Length is " + str(tlength) + " seconds.")
-
-            filename = "title_" + str.zfill(str(title), 2) + "." + cfg['DEST_EXT']
-            filepathname = os.path.join(basepath, filename)
-
-            logging.info("Transcoding title " + str(title) + " to " + shlex.quote(filepathname))
-
-            cmd = 'nice {0} -i {1} -o {2} --preset "{3}" -t {4} {5}>> {6} 2>&1'.format(
-                cfg['HANDBRAKE_CLI'],
-                shlex.quote(srcpath),
-                shlex.quote(filepathname),
-                hb_preset,
-                str(title),
-                hb_args,
-                logfile
-                )
-
-            logging.debug("Sending command: %s", (cmd))
-
-            try:
-                hb = subprocess.check_output(
-                    cmd,
-                    shell=True
-                ).decode("utf-8")
-                logging.debug("Handbrake exit code: " + hb)
-            except subprocess.CalledProcessError as hb_error:
-                err = "Handbrake encoding of title " + str(title) + " failed with code: " + str(hb_error.returncode) + "(" + str(hb_error.output) + ")"
-                logging.error(err)
-                disc.errors.append(str(title))
-                return False
-                # sys.exit(err)
-
-            # move file
-            if disc.videotype == "movie":
-                logging.debug("mt_track: " + mt_track + " List track: " + str(title))
-                if mt_track == str(title):
-                    utils.move_files(basepath, filename, disc.hasnicetitle, disc.videotitle + " (" + disc.videoyear + ")", True)
-                else:
-                    utils.move_files(basepath, filename, disc.hasnicetitle, disc.videotitle + " (" + disc.videoyear + ")", False)
+            logging.info("Processing track #" + str(title) + " of " + str(len(titles)) + ". Length is " + str(tlength) + " seconds.")
+            selected.append(title)
+
+    # drop copies of other titles and play all titles before anything is encoded
+    selected, skipped = dedupe.drop_duplicates(titles, selected, disc)
+
+    # long titles are split into chapter ranges that use the whole pool, so they are encoded first
+    results = {}
+    for title in [t for t in selected if should_split(titles[t])]:
+        filepathname = os.path.join(basepath, "title_" + str.zfill(str(title), 2) + "." + cfg['DEST_EXT'])
+        logging.info("Transcoding title " + str(title) + " to " + shlex.quote(filepathname))
+        results[title] = encode_split(srcpath, titles[title], filepathname, hb_preset, hb_args, logfile, disc)
+
+    pool = TranscodePool(logfile, disc)
+    for title in [t for t in selected if t not in results]:
+        filepathname = os.path.join(basepath, "title_" + str.zfill(str(title), 2) + "." + cfg['DEST_EXT'])
+        logging.info("Transcoding title " + str(title) + " to " + shlex.quote(filepathname))
+
+        cmd = ["nice", cfg['HANDBRAKE_CLI'], "-i", srcpath, "-o", filepathname, "--preset", hb_preset,
+               "-t", str(title)] + shlex.split(hb_args) + thread_args()
+
+        pool.submit(title, "title " + str(title), cmd)
+    results.update(pool.results())
+
+    # collect results in title order and move the files, concurrently
+    moves = []
+    done = []
+    for title in sorted(results):
+        success = results[title]
+        if not success:
+            disc.errors.append(str(title))
+            jobs.set_title(disc, title, "failed")
+            continue
+
+        filename = "title_" + str.zfill(str(title), 2) + "." + cfg['DEST_EXT']
+        if disc.videotype == "movie":
+            logging.debug("mt_track: " + mt_track + " List track: " + str(title))
+            target = utils.move_target(basepath, filename, disc.hasnicetitle, disc.videotitle + " (" + disc.videoyear + ")",
+                                       mt_track == str(title))
+            if target is not None:
+                moves.append((os.path.join(basepath, filename), target))
+        done.append(title)
+    moved = fileops.move_all(moves)
+    for title in done:
+        jobs.set_title(disc, title, "done")
+
+    if disc.errors:
+        logging.error("Handbrake processing completed with errors")
+        return False
 
     logging.info("Handbrake processing complete")
     logging.debug(str(disc))
     if disc.videotype == "movie" and disc.hasnicetitle:
-        utils.scan_emby()
+        utils.scan_emby([dest for src, dest in moves if moved.get(src)])
         try:
             os.rmdir(basepath)
         except OSError:
@@ -224,6 +217,27 @@ def handbrake_mkv(srcpath, basepath, logfile, disc):
     Return value: True for successful operation, False otherwise
     """
 
+    pool = TranscodePool(logfile, disc)
+    for f in sorted(os.listdir(srcpath)):
+        queue_mkv(pool, os.path.join(srcpath, f), basepath, logfile, disc)
+
+    return collect_mkv(pool, disc)
+
+
+def queue_mkv(pool, srcpathname, basepath, logfile, disc):
+    """
+    Queues the transcode of a single mkv file
+
+    Parameters:
+    pool: TranscodePool to run the encode in
+    srcpathname: Path to the mkv file
+    basepath: Path where HB will save trancoded files
+    logfile: Logfile for HB to redirect output to
+    disc: Disc object
+
+    Return value: None
+    """
+
     if disc.disctype == "dvd":
         hb_args = cfg['HB_ARGS_DVD']
         hb_preset = cfg['HB_PRESET_DVD']
@@ -231,78 +245,542 @@ def handbrake_mkv(srcpath, basepath, logfile, disc):
         hb_args = cfg['HB_ARGS_BD']
         hb_preset = cfg['HB_PRESET_BD']
 
-    for f in os.listdir(srcpath):
-        srcpathname = os.path.join(srcpath, f)
-        destfile = os.path.splitext(f)[0]
-        filename = os.path.join(basepath, destfile + "." + cfg['DEST_EXT'])
-        filepathname = os.path.join(basepath, filename)
+    f = os.path.basename(srcpathname)
+    if jobs.title_done(disc, f):
+        logging.info("File " + shlex.quote(f) + " was already transcoded.  Skipping")
+        return
+
+    destfile = os.path.splitext(f)[0]
+    filename = os.path.join(basepath, destfile + "." + cfg['DEST_EXT'])
+    filepathname = os.path.join(basepath, filename)
 
-        logging.info("Transcoding file " + shlex.quote(f) + " to " + shlex.quote(filepathname))
+    logging.info("Transcoding file " + shlex.quote(f) + " to " + shlex.quote(filepathname))
 
-        cmd = 'nice {0} -i {1} -o {2} --preset "{3}" {4}>> {5} 2>&1'.format(
-            cfg['HANDBRAKE_CLI'],
-            shlex.quote(srcpathname),
-            shlex.quote(filepathname),
-            hb_preset,
-            hb_args,
-            logfile
-            )
+    cmd = ["nice", cfg['HANDBRAKE_CLI'], "-i", srcpathname, "-o", filepathname, "--preset", hb_preset] + shlex.split(hb_args) + thread_args()
 
-        logging.debug("Sending command: %s", (cmd))
+    # free the scratch space of each title as soon as it is encoded, not when the whole disc is done
+    on_success = (lambda: reclaim_raw(srcpathname, filepathname, disc)) if cfg['DELRAWFILES'] and ffprobe_available() else None
+    pool.submit(f, "file " + shlex.quote(f), cmd, on_success)
 
-        try:
-            hb = subprocess.check_output(
-                cmd,
-                shell=True
-            ).decode("utf-8")
-            logging.debug("Handbrake exit code: " + hb)
-        except subprocess.CalledProcessError as hb_error:
-            err = "Handbrake encoding of file " + shlex.quote(f) + " failed with code: " + str(hb_error.returncode) + "(" + str(hb_error.output) + ")"
-            logging.error(err)
+
+def ffprobe_available():
+    """
+    Check once whether FFPROBE_CLI is installed, which is needed to verify an
+    encode before its raw file is removed
+
+    Parameters:
+    None
+
+    Return value: True if ffprobe can be run
+    """
+    global _ffprobe
+    if _ffprobe is None:
+        _ffprobe = shutil.which(cfg['FFPROBE_CLI']) is not None
+        if not _ffprobe:
+            logging.warning(cfg['FFPROBE_CLI'] + " was not found.  Raw files are removed when the job is done instead of after each transcode")
+    return _ffprobe
+
+
+def reclaim_raw(srcpathname, filepathname, disc):
+    """
+    Delete a raw mkv file once its encode is complete and has the length of the source
+
+    Parameters:
+    srcpathname: path of the raw mkv file
+    filepathname: path of the encoded file
+    disc: Disc object, the scratch space used is recorded in its job
+
+    Return value: True if the raw file was deleted
+    """
+
+    if not verify_encode(srcpathname, filepathname):
+        logging.warning("Could not verify the encode of " + os.path.basename(srcpathname) + ".  Keeping the raw file until the job is done")
+        return False
+
+    try:
+        size = os.path.getsize(srcpathname)
+        jobs.record_scratch(disc, utils.dir_size(os.path.dirname(srcpathname)))
+        os.remove(srcpathname)
+    except OSError as remove_error:
+        logging.warning("Could not remove raw file " + srcpathname + ": " + str(remove_error))
+        return False
+    logging.info("Removed raw file " + os.path.basename(srcpathname) + " (" + str(size // 1048576) + " MB) after its encode was verified")
+    return True
+
+
+def verify_encode(srcpathname, filepathname):
+    """
+    Check that an encode is complete by comparing its length with the source
+
+    Parameters:
+    srcpathname: path of the source file
+    filepathname: path of the encoded file
+
+    Return value: True if the encoded file has the length of the source, within ENCODE_TOLERANCE
+    """
+
+    if not os.path.isfile(filepathname) or os.path.getsize(filepathname) == 0:
+        return False
+    source = probe(srcpathname)
+    encoded = probe(filepathname)
+    try:
+        source = float(source['format']['duration'])
+        encoded = float(encoded['format']['duration'])
+    except (KeyError, TypeError, ValueError):
+        return False
+    return abs(source - encoded) <= max(ENCODE_TOLERANCE, source / 100.0)
+
+
+def collect_mkv(pool, disc):
+    """
+    Waits for the mkv transcodes queued with queue_mkv and records failed files in disc.errors
+
+    Parameters:
+    pool: TranscodePool the encodes were queued in
+    disc: Disc object
+
+    Return value: True for successful operation, False otherwise
+    """
+
+    for f, success in pool.results():
+        if not success:
             disc.errors.append(f)
-            return False
+        jobs.set_title(disc, f, "done" if success else "failed")
+
+    if disc.errors:
+        logging.error("Handbrake processing completed with errors")
+        return False
 
     logging.info("Handbrake processing complete")
     logging.debug(str(disc))
     return True
 
 
-def get_title_length(title, srcpath):
+class TranscodePool(object):
+    """
+    Runs HandBrake commands HB_CONCURRENT_JOBS at a time and collects the
+    results in the order the commands were submitted, independent of which
+    encode finishes first
+
+    Methods:
+        __init__(self, logfile, disc)
+        submit(self, key, description, cmd, on_success=None)
+        results(self)
+    """
+
+    def __init__(self, logfile, disc):
+        """
+        Constructor; starts the worker pool
+
+        Parameters:
+        logfile: Logfile for HB to redirect output to
+        disc: Disc object
+
+        Return value: None
+        """
+        workers = max(1, cfg['HB_CONCURRENT_JOBS'])
+        logging.debug("Starting transcode pool with " + str(workers) + " concurrent job(s)")
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.jobs = []
+        self.logfile = logfile
+        self.disc = disc
+
+    def submit(self, key, description, cmd, on_success=None):
+        """
+        Queue a HandBrake command
+
+        Parameters:
+        key: identifier returned with the result, e.g. the title number
+        description: text used in log messages
+        cmd: HandBrake command as a list of arguments
+        on_success: optional function called in the worker thread when the encode succeeded
+
+        Return value: None
+        """
+        self.jobs.append((key, self.executor.submit(run_handbrake, description, cmd, self.logfile, self.disc, on_success)))
+
+    def results(self):
+        """
+        Wait for every queued command to finish
+
+        Parameters:
+        None
+
+        Return value: list of (key, success) tuples in submission order
+        """
+        results = [(key, job.result()) for key, job in self.jobs]
+        self.executor.shutdown()
+        self.jobs = []
+        return results
+
+
+def run_handbrake(description, cmd, logfile, disc, on_success=None):
     """
-    Use HandBrake to get the title length
+    Run a single HandBrake encode
 
     Parameters:
-    title: title to scan
-    srcpath: location of the dvd or decrypted bluray
+    description: text used in log messages, e.g. "title 3"
+    cmd: HandBrake command as a list of arguments
+    logfile: Logfile for HB to redirect output to
+    disc: Disc object, the encode progress is recorded in its job
+    on_success: optional function called after a successful encode
 
-    Return value: duration of the title in seconds or -1 if the length could not be determinied
+    Return value: True for successful operation, False otherwise
     """
-    logging.debug("Getting length from " + srcpath + " on title: " + str(title))
 
-    cmd = '{0} -i {1} -t {2} --scan'.format(
-        cfg['HANDBRAKE_CLI'],
-        shlex.quote(srcpath),
-        title
-        )
+    try:
+        runner.run(cmd, logfile, runner.handbrake_progress, runner.ProgressReporter(disc, description))
+    except subprocess.CalledProcessError as hb_error:
+        err = "Handbrake encoding of " + description + " failed with code: " + str(hb_error.returncode)
+        logging.error(err)
+        return False
+    except OSError as hb_error:
+        logging.error("Handbrake encoding of " + description + " failed: " + str(hb_error))
+        return False
+
+    logging.info("Handbrake encoding of " + description + " complete")
+    if on_success is not None:
+        on_success()
+    return True
 
-    logging.debug("Sending command: %s", (cmd))
 
+def thread_args():
+    """
+    Build the HandBrake arguments limiting the threads used by a single encode
+
+    Parameters:
+    None
+
+    Return value: list of arguments, empty when HB_THREADS_PER_JOB is 0
+    """
+    threads = cfg['HB_THREADS_PER_JOB']
+    if threads > 0:
+        return ["--encopts", "threads=" + str(threads)]
+    return []
+
+
+def should_split(title):
+    """
+    Check if a title should be encoded as chapter ranges in parallel (HB_CHAPTER_SPLIT)
+
+    Parameters:
+    title: title info from the title table
+
+    Return value: True if the title is long enough and has enough chapters to split
+    """
+    return bool(cfg['HB_CHAPTER_SPLIT']) and cfg['HB_CONCURRENT_JOBS'] > 1 and \
+        title['duration'] >= cfg['HB_CHAPTER_SPLIT_MINLENGTH'] and len(title['chapters']) > 1
+
+
+def split_chapters(chapters, segments):
+    """
+    Split a title's chapters into ranges of about equal length
+
+    Parameters:
+    chapters: list of chapter lengths in seconds
+    segments: number of ranges wanted
+
+    Return value: list of (first, last) chapter numbers, starting at 1
+    """
+    segments = max(1, min(segments, len(chapters)))
+    total = sum(chapters)
+    ranges = []
+    first = 1
+    elapsed = 0
+    for chapter, length in enumerate(chapters, 1):
+        elapsed += length
+        remaining_chapters = len(chapters) - chapter
+        remaining_ranges = segments - len(ranges) - 1
+        # close the range once it reaches its share, keeping a chapter for every remaining range
+        if remaining_ranges > 0 and (elapsed >= total * (len(ranges) + 1) / segments or remaining_chapters == remaining_ranges):
+            ranges.append((first, chapter))
+            first = chapter + 1
+    ranges.append((first, len(chapters)))
+    return ranges
+
+
+def encode_split(srcpath, title, filepathname, hb_preset, hb_args, logfile, disc):
+    """
+    Encode a long title as chapter ranges running in parallel in a TranscodePool
+    and join the segments without re-encoding.  The chapter markers of the
+    segments are carried over to the joined file.
+
+    Parameters:
+    srcpath: Path to source for HB (dvd or files)
+    title: title info from the title table
+    filepathname: path of the final file
+    hb_preset: HandBrake preset
+    hb_args: additional HandBrake arguments
+    logfile: Logfile for HB to redirect output to
+    disc: Disc object
+
+    Return value: True for successful operation, False otherwise
+    """
+    ranges = split_chapters(title['chapters'], cfg['HB_CONCURRENT_JOBS'])
+    logging.info("Encoding title " + str(title['title']) + " as " + str(len(ranges)) + " chapter ranges: " +
+                 ", ".join(str(a) + "-" + str(b) for a, b in ranges))
+
+    partdir = utils.make_dir(filepathname + ".parts")
+    parts = []
+    pool = TranscodePool(logfile, disc)
+    for first, last in ranges:
+        part = os.path.join(partdir, "part_" + str.zfill(str(first), 3) + "." + cfg['DEST_EXT'])
+        parts.append(part)
+        cmd = ["nice", cfg['HANDBRAKE_CLI'], "-i", srcpath, "-o", part, "--preset", hb_preset, "-t", str(title['title']),
+               "--chapters", str(first) + "-" + str(last), "--markers"] + shlex.split(hb_args) + thread_args()
+        pool.submit(first, "title " + str(title['title']) + " chapters " + str(first) + "-" + str(last), cmd)
+
+    success = all(result for key, result in pool.results())
+    if success:
+        success = join_parts(parts, filepathname, logfile)
+
+    shutil.rmtree(partdir, ignore_errors=True)
+    return success
+
+
+def join_parts(parts, filepathname, logfile):
+    """
+    Join encoded segments into one file with ffmpeg, copying the streams and
+    rebuilding the chapter list from the chapters of each segment
+
+    Parameters:
+    parts: list of segment files in playback order
+    filepathname: path of the joined file
+    logfile: Logfile for ffmpeg to redirect output to
+
+    Return value: True for successful operation, False otherwise
+    """
+    partdir = os.path.dirname(parts[0])
+    listfile = os.path.join(partdir, "parts.txt")
+    metafile = os.path.join(partdir, "chapters.txt")
+
+    with open(listfile, "w") as f:
+        for part in parts:
+            f.write("file '" + part.replace("'", "'\\''") + "'\n")
+
+    offset = 0.0
+    number = 0
+    with open(metafile, "w") as f:
+        f.write(";FFMETADATA1\n")
+        for part in parts:
+            info = probe(part)
+            for chapter in info.get('chapters', []):
+                number += 1
+                name = chapter.get('tags', {}).get('title', "")
+                if not name or re.match(r'^Chapter \d+$', name):
+                    name = "Chapter " + str(number)
+                f.write("[CHAPTER]\nTIMEBASE=1/1000\nSTART=" + str(int((offset + float(chapter['start_time'])) * 1000)) +
+                        "\nEND=" + str(int((offset + float(chapter['end_time'])) * 1000)) + "\ntitle=" + name + "\n")
+            offset += float(info.get('format', {}).get('duration', 0))
+
+    cmd = [cfg['FFMPEG_CLI'], "-y", "-nostdin", "-f", "concat", "-safe", "0", "-i", listfile, "-i", metafile,
+           "-map", "0", "-map_metadata", "0", "-map_chapters", "1", "-c", "copy", filepathname]
     try:
-        hb = subprocess.check_output(
-            cmd,
-            stderr=subprocess.STDOUT,
-            shell=True
-        ).decode("utf-8").splitlines()
-    except subprocess.CalledProcessError as hb_error:
-        # err = "Call to handbrake failed with code: " + str(hb_error.returncode) + "(" + str(hb_error.output) + ")"
-        logging.debug("Couldn't find a valid track.  Try running the command manually to see more specific errors.")
-        return(-1)
-        # sys.exit(err)
-
-    pattern = re.compile(r'.*duration\:.*')
-    for line in hb:
-        if(re.search(pattern, line)) is not None:
-            t = line.split()
-            h, m, s = t[2].split(':')
-            seconds = int(h) * 3600 + int(m) * 60 + int(s)
-            return(seconds)
+        runner.run(cmd, logfile)
+    except (subprocess.CalledProcessError, OSError) as ff_error:
+        logging.error("Joining the encoded segments of " + filepathname + " failed: " + str(ff_error))
+        return False
+
+    logging.info("Joined " + str(len(parts)) + " segments into " + filepathname + " with " + str(number) + " chapters")
+    return True
+
+
+def probe(filepathname):
+    """
+    Read the duration and chapters of a media file with ffprobe
+
+    Parameters:
+    filepathname: path of the file
+
+    Return value: ffprobe's JSON output as a dict, empty if it could not be read
+    """
+    lines = []
+    cmd = [cfg['FFPROBE_CLI'], "-v", "error", "-show_chapters", "-show_entries", "format=duration", "-of", "json", filepathname]
+    try:
+        runner.run(cmd, on_line=lambda line, stream: lines.append(line) if stream == "stdout" else None)
+        return json.loads("\n".join(lines))
+    except (subprocess.CalledProcessError, OSError, ValueError):
+        logging.error("Could not read " + filepathname + " with ffprobe")
+        return {}
+
+
+def scan_titles(srcpath, disc):
+    """
+    Scan every title on the source with a single HandBrake scan and build the
+    title table for the job.  HandBrake's JSON scan output is used when it is
+    available, otherwise the text output of the scan is parsed.
+
+    Parameters:
+    srcpath: Path to source for HB (dvd or files)
+    disc: Disc object.  The title table is stored in disc.titles
+
+    Return value: dict of title number to title info (see parse_scan_json), empty if the scan failed
+    """
+
+    cmd = [cfg['HANDBRAKE_CLI'], "--json", "-i", srcpath, "-t", "0", "--scan"]
+
+    # keep only the JSON title set from stdout and the title lines from stderr
+    json_lines = []
+    text_lines = []
+
+    def collect(line, stream):
+        if stream == "stdout":
+            if json_lines or line.startswith("JSON Title Set:"):
+                json_lines.append(line)
+        elif line.lstrip().startswith("+ "):
+            text_lines.append(line)
+
+    try:
+        runner.run(cmd, on_line=collect, check=False)
+    except OSError as hb_error:
+        logging.error("Call to handbrake failed: " + str(hb_error))
+        return {}
+
+    titles = parse_scan_json("\n".join(json_lines))
+    if titles:
+        logging.debug("Title table built from HandBrake JSON scan output")
+    else:
+        logging.debug("No JSON title set found in scan output.  Falling back to the text scan output")
+        titles = parse_scan_text(text_lines)
+
+    for title in sorted(titles):
+        logging.debug("Title #" + str(title) + ": " + str(titles[title]))
+
+    disc.titles = titles
+    return titles
+
+
+def parse_scan_json(output):
+    """
+    Parse the "JSON Title Set" from the output of HandBrakeCLI --json --scan
+
+    Parameters:
+    output: stdout of the HandBrake scan
+
+    Return value: dict of title number to a dict with the keys
+        title: title number
+        duration: length of the title in seconds
+        chapters: list of chapter lengths in seconds
+        audio: list of audio track descriptions
+        subtitles: list of subtitle track descriptions
+        resolution: WIDTHxHEIGHT of the video
+        playlist: Blu-ray playlist number or None
+        mainfeature: True if HandBrake identified the title as the main feature
+    """
+
+    marker = output.find("JSON Title Set:")
+    if marker == -1:
+        return {}
+
+    start = output.find("{", marker)
+    try:
+        doc = json.JSONDecoder().raw_decode(output, start)[0]
+    except ValueError:
+        logging.debug("Could not decode JSON title set")
+        return {}
+
+    titles = {}
+    for t in doc.get('TitleList', []):
+        title = int(t['Index'])
+        playlist = t.get('Playlist', -1)
+        titles[title] = {
+            'title': title,
+            'duration': json_duration(t.get('Duration', {})),
+            'chapters': [json_duration(c.get('Duration', {})) for c in t.get('ChapterList', [])],
+            'audio': [a.get('Description', a.get('Language', "")) for a in t.get('AudioList', [])],
+            'subtitles': [s.get('Language', "") for s in t.get('SubtitleList', [])],
+            'resolution': str(t.get('Geometry', {}).get('Width', 0)) + "x" + str(t.get('Geometry', {}).get('Height', 0)),
+            'playlist': "{0:05d}".format(playlist) if playlist is not None and playlist >= 0 else None,
+            'mainfeature': title == doc.get('MainFeature'),
+        }
+    return titles
+
+
+def json_duration(duration):
+    """
+    Convert a HandBrake JSON duration object to seconds
+
+    Parameters:
+    duration: dict with Hours, Minutes and Seconds keys
+
+    Return value: duration in seconds
+    """
+    return int(duration.get('Hours', 0)) * 3600 + int(duration.get('Minutes', 0)) * 60 + int(duration.get('Seconds', 0))
+
+
+def parse_scan_text(lines):
+    """
+    Parse the text scan output HandBrake writes to stderr
+
+    Parameters:
+    lines: iterable of lines from the HandBrake scan
+
+    Return value: dict of title number to title info (see parse_scan_json)
+    """
+
+    titles = {}
+    current = None
+    section = None
+    for line in lines:
+        stripped = line.strip()
+        if not stripped.startswith("+ "):
+            continue
+        item = stripped[2:]
+        indent = len(line) - len(line.lstrip())
+
+        result = re.match(r'title (\d+):', item)
+        if result and indent == 0:
+            current = {
+                'title': int(result.group(1)),
+                'duration': 0,
+                'chapters': [],
+                'audio': [],
+                'subtitles': [],
+                'resolution': "",
+                'playlist': None,
+                'mainfeature': False,
+            }
+            titles[current['title']] = current
+            section = None
+            continue
+
+        if current is None:
+            continue
+
+        if indent <= 2:
+            section = None
+            if item == "Main Feature":
+                current['mainfeature'] = True
+            elif item.startswith("duration:"):
+                current['duration'] = text_duration(item.split()[1])
+            elif item.startswith("size:"):
+                current['resolution'] = item.split()[1].rstrip(",")
+            elif item.startswith("playlist:"):
+                current['playlist'] = item.split()[1].split(".")[0]
+            elif item == "chapters:":
+                section = 'chapters'
+            elif item == "audio tracks:":
+                section = 'audio'
+            elif item == "subtitle tracks:":
+                section = 'subtitles'
+        elif section == 'chapters':
+            result = re.search(r'duration (\d+:\d+:\d+)', item)
+            if result:
+                current['chapters'].append(text_duration(result.group(1)))
+        elif section in ['audio', 'subtitles']:
+            current[section].append(item.split(", ", 1)[-1])
+
+    return titles
+
+
+def text_duration(duration):
+    """
+    Convert a HH:MM:SS duration to seconds
+
+    Parameters:
+    duration: string in the form HH:MM:SS
+
+    Return value: duration in seconds
+    """
+    h, m, s = duration.split(':')
+    return int(h) * 3600 + int(m) * 60 + int(s)
@@ -2,11 +2,14 @@
 
 import os
 import sys # noqa # pylint: disable=unused-import
+import copy
 import logging
+import threading
 import classes # noqa # pylint: disable=unused-import
 import getmovietitle
 import getvideotype
 import utils
+import discfs
 
 from config import cfg
 
@@ -14,40 +17,71 @@ from config import cfg
 def identify(disc, logfile):
     """Identify disc attributes"""
 
+    mounted = identify_type(disc)
+    if disc.disctype in ["dvd", "bluray"]:
+        mounted = identify_title(disc, mounted)
+
+    if mounted:
+        os.system("umount " + disc.devpath)
+
+
+def identify_async(disc, logfile):
+    """Identify the disc type, then look up the title of video discs in the
+    background (see Identification), so the rip can start right away"""
+
+    mounted = identify_type(disc)
+    if disc.disctype in ["dvd", "bluray"]:
+        disc.identification = Identification(disc, mounted)
+    elif mounted:
+        os.system("umount " + disc.devpath)
+
+
+def identify_type(disc):
+    """Identify the disc type from its top level directories.  Returns True if
+    the disc had to be mounted for that"""
+
     logging.info("Starting disc dentification: " + str(disc))
 
     # If UDF CHeck is on
     # if cfg['ARM_CHECK_UDF']:
 
-    logging.info("Mounting disc to: " + str(disc.mountpoint))
-
-    if not os.path.exists(str(disc.mountpoint)):
-        os.makedirs(str(disc.mountpoint))
-
-    os.system("mount " + disc.devpath)
+    # read the root directory straight from the disc; mount only if that fails
+    mounted = False
+    root = {}
+    if disc.disctype != "music":
+        root = discfs.layout(disc.devpath)
+        if root is None:
+            mount(disc)
+            mounted = True
+            root = dict((f, os.path.isdir(os.path.join(disc.mountpoint, f))) for f in os.listdir(disc.mountpoint))
+    dirs = [name.upper() for name, isdir in root.items() if isdir]
 
     # Check to make sure it's not a data disc
     if disc.disctype == "music":
         logging.debug("Disc is music.  Skipping identification")
-    elif os.path.isdir(disc.mountpoint + "/VIDEO_TS"):
-        logging.debug("Found: " + disc.mountpoint + "/VIDEO_TS")
-        disc.disctype = "dvd"
-    elif os.path.isdir(disc.mountpoint + "/video_ts"):
-        logging.debug("Found: " + disc.mountpoint + "/video_ts")
+    elif "VIDEO_TS" in dirs:
+        logging.debug("Found: VIDEO_TS")
         disc.disctype = "dvd"
-    elif os.path.isdir(disc.mountpoint + "/BDMV"):
-        logging.debug("Found: " + disc.mountpoint + "/BDMV")
+    elif "BDMV" in dirs:
+        logging.debug("Found: BDMV")
         disc.disctype = "bluray"
-    elif os.path.isdir(disc.mountpoint + "/HVDVD_TS"):
-        logging.debug("Found: " + disc.mountpoint + "/HVDVD_TS")
+    elif "HVDVD_TS" in dirs:
+        logging.debug("Found: HVDVD_TS")
         # do something here
-    elif utils.find_file("HVDVD_TS", disc.mountpoint):
+    elif mounted and utils.find_file("HVDVD_TS", disc.mountpoint):
         logging.debug("Found file: HVDVD_TS")
         # do something here too
     else:
         logging.debug("Did not find valid dvd/bd files. Changing disctype to 'data'")
         disc.disctype = "data"
 
+    return mounted
+
+
+def identify_title(disc, mounted):
+    """Get the title, year and video type of a video disc.  Returns True if the
+    disc is mounted"""
+
     if disc.disctype in ["dvd", "bluray"]:
 
         logging.info("Disc identified as video")
@@ -60,6 +94,11 @@ def identify(disc, logfile):
 		
         elif cfg["GET_VIDEO_TITLE"]:
 
+            # the DVD id is calculated from the files of the mounted disc
+            if disc.disctype == "dvd" and not mounted:
+                mount(disc)
+                mounted = True
+
             logging.info("Getting movie title...")
             disc.videotitle, disc.videoyear = getmovietitle.main(disc)
 
@@ -77,4 +116,91 @@ def identify(disc, logfile):
             logging.info("Disc title: " + str(disc.videotitle) + " : " + str(disc.videoyear) + " : " + str(disc.videotype))
             logging.debug("Identification complete: " + str(disc))
 
-    os.system("umount " + disc.devpath)
+    return mounted
+
+
+def mount(disc):
+    """
+    Mount the disc at its mountpoint
+
+    Parameters:
+    disc: disc object
+
+    Return value: None
+    """
+    logging.info("Mounting disc to: " + str(disc.mountpoint))
+
+    if not os.path.exists(str(disc.mountpoint)):
+        os.makedirs(str(disc.mountpoint))
+
+    os.system("mount " + disc.devpath)
+
+
+class Identification(object):
+    """
+    Looks up the title, year and video type of a video disc in a background
+    thread while the disc is being ripped.  The lookup works on a copy of the
+    disc object; the result is applied to the disc by wait(), which is called
+    through Disc.wait_identified() before anything needs the title.
+
+    Methods:
+        __init__(self, disc, mounted)
+        run(self)
+        wait(self, disc)
+    """
+
+    def __init__(self, disc, mounted):
+        """
+        Constructor; starts the lookup
+
+        Parameters:
+        disc: disc object
+        mounted: True if the disc is already mounted
+
+        Return value: None
+        """
+        logging.info("Looking up the disc title in the background")
+        self.result = copy.copy(disc)
+        self.mounted = mounted
+        self.failed = False
+        self.thread = threading.Thread(target=self.run, name="identify")
+        self.thread.start()
+
+    def run(self):
+        """
+        Run the lookup; called in the background thread
+
+        Parameters:
+        None
+
+        Return value: None
+        """
+        try:
+            if identify_title(self.result, self.mounted):
+                os.system("umount " + self.result.devpath)
+        except Exception:
+            logging.exception("Looking up the disc title failed")
+            self.failed = True
+
+    def wait(self, disc):
+        """
+        Wait for the lookup and apply the result to the disc
+
+        Parameters:
+        disc: disc object
+
+        Return value: None
+        """
+        if self.thread.is_alive():
+            logging.info("Waiting for the disc title lookup to finish")
+        self.thread.join()
+
+        if self.failed:
+            self.result.videotitle = "title_unknown"
+            self.result.hasnicetitle = False
+        for attr in ["videotitle", "videoyear", "videotype", "hasnicetitle"]:
+            setattr(disc, attr, getattr(self.result, attr))
+        logging.info("Disc title: " + str(disc.videotitle) + " : " + str(disc.videoyear) + " : " + str(disc.videotype))
+
+        if disc.job is not None:
+            disc.job.set_stage("identified", disc)
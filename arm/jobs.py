@@ -0,0 +1,462 @@
+#!/usr/bin/python3
+
+import os
+import json
+import time
+import logging
+import db
+import space
+
+# Stages a job passes through, in order.  A job's stage is the last stage it completed.
+STAGES = ["new", "identified", "ripped", "transcoded", "complete"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    devpath TEXT NOT NULL,
+    status TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    disc TEXT,
+    titles TEXT,
+    rawpath TEXT,
+    logfile TEXT,
+    pid INTEGER,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created REAL,
+    started REAL,
+    updated REAL,
+    finished REAL
+);
+CREATE TABLE IF NOT EXISTS job_titles (
+    job_id INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    status TEXT NOT NULL,
+    updated REAL,
+    PRIMARY KEY (job_id, title)
+);
+"""
+
+
+# Columns added after the first version of the jobs table
+COLUMNS = [("progress", "TEXT"), ("peak_scratch", "INTEGER")]
+
+
+def connect():
+    """
+    Open the ARM database with the jobs tables
+
+    Parameters:
+    None
+
+    Return value: sqlite3 connection
+    """
+    conn = db.connect(SCHEMA)
+    db.add_columns(conn, "jobs", COLUMNS)
+    return conn
+
+
+class Job(object):
+    """
+    A class representing a job in the ARM job store
+
+    Attributes:
+        job_id
+        devpath
+        status
+        stage
+        disc
+        titles
+        rawpath
+        logfile
+        attempts
+        created
+        peak_scratch
+
+    Methods:
+        __init__(self, row)
+        reached(self, stage)
+        set_stage(self, stage, disc, **fields)
+        set_titles(self, titles)
+        set_title(self, title, status)
+        title_status(self, title)
+        finish(self, status)
+        record_scratch(self, used)
+    """
+
+    def __init__(self, row):
+        """
+        Constructor; returns a job object
+
+        Parameters:
+            row: row of the jobs table
+
+        Return value: None
+        """
+        self.job_id = row['job_id']
+        self.devpath = row['devpath']
+        self.status = row['status']
+        self.stage = row['stage']
+        self.disc = json.loads(row['disc']) if row['disc'] else {}
+        self.titles = json.loads(row['titles']) if row['titles'] else []
+        self.rawpath = row['rawpath']
+        self.logfile = row['logfile']
+        self.attempts = row['attempts']
+        self.created = row['created']
+        self.peak_scratch = row['peak_scratch']
+
+    def reached(self, stage):
+        """
+        Check if the job has already completed a stage
+
+        Parameters:
+        stage: name of the stage (see STAGES)
+
+        Return value: True if the job has completed the stage
+        """
+        return STAGES.index(self.stage) >= STAGES.index(stage)
+
+    def set_stage(self, stage, disc=None, **fields):
+        """
+        Record a completed stage together with the state needed to resume after it
+
+        Parameters:
+        stage: name of the completed stage (see STAGES)
+        disc: optional disc object to save with the job
+        fields: other columns of the jobs table to update, e.g. rawpath
+
+        Return value: None
+        """
+        logging.debug("Job " + str(self.job_id) + " completed stage: " + stage)
+        self.stage = stage
+        fields['stage'] = stage
+        if disc is not None:
+            self.disc = disc.dump()
+            fields['disc'] = json.dumps(self.disc)
+        for key, value in fields.items():
+            if key != 'disc' and key != 'stage':
+                setattr(self, key, value)
+        update(self.job_id, **fields)
+        space.release(self.job_id, STAGES[:STAGES.index(stage) + 1])
+
+    def set_titles(self, titles):
+        """
+        Save the plan of titles to rip, so a resumed job doesn't have to scan the disc again
+
+        Parameters:
+        titles: list of title dicts
+
+        Return value: None
+        """
+        self.titles = titles
+        update(self.job_id, titles=json.dumps(titles))
+
+    def set_title(self, title, status):
+        """
+        Record the status of a single title
+
+        Parameters:
+        title: title number or file name
+        status: status of the title, e.g. "done" or "failed"
+
+        Return value: None
+        """
+        conn = connect()
+        conn.execute("INSERT OR REPLACE INTO job_titles (job_id, title, status, updated) VALUES (?, ?, ?, ?)",
+                     (self.job_id, str(title), status, time.time()))
+        conn.close()
+
+    def title_status(self, title):
+        """
+        Get the recorded status of a single title
+
+        Parameters:
+        title: title number or file name
+
+        Return value: status of the title or None if it hasn't been processed yet
+        """
+        conn = connect()
+        row = conn.execute("SELECT status FROM job_titles WHERE job_id = ? AND title = ?",
+                           (self.job_id, str(title))).fetchone()
+        conn.close()
+        return row['status'] if row else None
+
+    def finish(self, status):
+        """
+        Mark the job as finished
+
+        Parameters:
+        status: final status, "done" or "failed"
+
+        Return value: None
+        """
+        self.status = status
+        update(self.job_id, status=status, finished=time.time())
+        space.release(self.job_id)
+
+    def record_scratch(self, used):
+        """
+        Record the space used by the raw files of the job, keeping the highest value
+
+        Parameters:
+        used: bytes used in RAWPATH
+
+        Return value: None
+        """
+        self.peak_scratch = max(self.peak_scratch or 0, used)
+        conn = connect()
+        conn.execute("UPDATE jobs SET peak_scratch = MAX(COALESCE(peak_scratch, 0), ?) WHERE job_id = ?", (used, self.job_id))
+        conn.close()
+
+
+def update(job_id, **fields):
+    """
+    Update columns of a job
+
+    Parameters:
+    job_id: id of the job
+    fields: columns to update
+
+    Return value: None
+    """
+    fields['updated'] = time.time()
+    columns = sorted(fields)
+    conn = connect()
+    conn.execute("UPDATE jobs SET " + ", ".join(c + " = ?" for c in columns) + " WHERE job_id = ?",
+                 [fields[c] for c in columns] + [job_id])
+    conn.close()
+
+
+def normalize_devpath(devpath):
+    """
+    Turn a kernel device name such as sr0 into a device path
+
+    Parameters:
+    devpath: device name or path
+
+    Return value: path to the device
+    """
+    if not devpath.startswith("/"):
+        devpath = os.path.join("/dev", devpath)
+    return devpath
+
+
+def enqueue(devpath):
+    """
+    Add a job for a newly inserted disc.  A drive that already has a job waiting
+    to start doesn't get a second one.
+
+    Parameters:
+    devpath: path to the drive
+
+    Return value: id of the queued job
+    """
+    devpath = normalize_devpath(devpath)
+    now = time.time()
+    conn = connect()
+    conn.execute("BEGIN IMMEDIATE")
+    row = conn.execute("SELECT job_id FROM jobs WHERE devpath = ? AND status = 'queued' AND stage = 'new'", (devpath,)).fetchone()
+    if row:
+        job_id = row['job_id']
+        logging.info("Job " + str(job_id) + " is already queued for " + devpath)
+    else:
+        cur = conn.execute("INSERT INTO jobs (devpath, status, stage, created, updated) VALUES (?, 'queued', 'new', ?, ?)",
+                           (devpath, now, now))
+        job_id = cur.lastrowid
+        logging.info("Queued job " + str(job_id) + " for " + devpath)
+    conn.execute("COMMIT")
+    conn.close()
+    return job_id
+
+
+def create(devpath, logfile):
+    """
+    Create a running job for a disc that is processed directly instead of through the queue
+
+    Parameters:
+    devpath: path to the drive
+    logfile: path to the job's logfile
+
+    Return value: Job object
+    """
+    now = time.time()
+    conn = connect()
+    cur = conn.execute("INSERT INTO jobs (devpath, status, stage, logfile, pid, attempts, created, started, updated) "
+                       "VALUES (?, 'running', 'new', ?, ?, 1, ?, ?, ?)",
+                       (normalize_devpath(devpath), logfile, os.getpid(), now, now, now))
+    job_id = cur.lastrowid
+    conn.close()
+    return get(job_id)
+
+
+def get(job_id):
+    """
+    Load a job
+
+    Parameters:
+    job_id: id of the job
+
+    Return value: Job object or None if there is no such job
+    """
+    conn = connect()
+    row = conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+    conn.close()
+    return Job(row) if row else None
+
+
+def claim(max_running):
+    """
+    Claim the oldest queued job if fewer than max_running jobs are running
+
+    Parameters:
+    max_running: maximum number of jobs allowed to run at once
+
+    Return value: claimed Job object or None
+    """
+    now = time.time()
+    conn = connect()
+    conn.execute("BEGIN IMMEDIATE")
+    running = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'running'").fetchone()[0]
+    row = None
+    if running < max_running:
+        # one job per drive at a time, unless the earlier job is past ripping
+        row = conn.execute("SELECT * FROM jobs WHERE status = 'queued' AND devpath NOT IN "
+                           "(SELECT devpath FROM jobs WHERE status = 'running' AND stage IN ('new', 'identified')) "
+                           "ORDER BY job_id LIMIT 1").fetchone()
+        if row:
+            conn.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, started = ?, updated = ? WHERE job_id = ?",
+                         (now, now, row['job_id']))
+    conn.execute("COMMIT")
+    conn.close()
+    return get(row['job_id']) if row else None
+
+
+def recover(max_attempts, ignore=()):
+    """
+    Requeue jobs left running by a crashed worker or a reboot, so they resume at
+    their last completed stage.  Jobs that have already been tried max_attempts
+    times are marked failed instead.  A job whose process is still alive is left
+    alone; the worker calls this on every poll, so the job is requeued once that
+    process exits without finishing it.
+
+    Parameters:
+    max_attempts: number of times a job may be started
+    ignore: ids of the jobs the caller runs itself and reaps through their process
+
+    Return value: list of requeued job ids
+    """
+    boot_time = get_boot_time()
+    requeued = []
+    conn = connect()
+    for row in conn.execute("SELECT * FROM jobs WHERE status = 'running'").fetchall():
+        if row['job_id'] in ignore:
+            continue
+        if (row['started'] or 0) > boot_time and pid_alive(row['pid']):
+            continue
+        if row['attempts'] >= max_attempts:
+            logging.error("Job " + str(row['job_id']) + " was interrupted " + str(row['attempts']) + " times.  Marking it failed")
+            conn.execute("UPDATE jobs SET status = 'failed', finished = ?, updated = ? WHERE job_id = ?",
+                         (time.time(), time.time(), row['job_id']))
+        else:
+            logging.info("Requeueing interrupted job " + str(row['job_id']) + " at stage " + row['stage'])
+            conn.execute("UPDATE jobs SET status = 'queued', pid = NULL, updated = ? WHERE job_id = ?", (time.time(), row['job_id']))
+            requeued.append(row['job_id'])
+    conn.close()
+    return requeued
+
+
+def list_jobs(limit=50):
+    """
+    List the most recent jobs
+
+    Parameters:
+    limit: maximum number of jobs to return
+
+    Return value: list of Job objects, newest first
+    """
+    conn = connect()
+    rows = conn.execute("SELECT * FROM jobs ORDER BY job_id DESC LIMIT ?", (limit,)).fetchall()
+    conn.close()
+    return [Job(row) for row in rows]
+
+
+def title_done(disc, title):
+    """
+    Check if a title was already processed successfully by an earlier run of the disc's job
+
+    Parameters:
+    disc: disc object
+    title: title number or file name
+
+    Return value: True if the title is done
+    """
+    if disc.job is None:
+        return False
+    return disc.job.title_status(title) == "done"
+
+
+def set_title(disc, title, status):
+    """
+    Record the status of a title in the disc's job, if the disc has one
+
+    Parameters:
+    disc: disc object
+    title: title number or file name
+    status: status of the title, e.g. "done" or "failed"
+
+    Return value: None
+    """
+    if disc.job is not None:
+        disc.job.set_title(title, status)
+
+
+def record_scratch(disc, used):
+    """
+    Record the space used by the raw files of the disc's job, if the disc has one
+
+    Parameters:
+    disc: disc object
+    used: bytes used in RAWPATH
+
+    Return value: None
+    """
+    if disc.job is not None:
+        disc.job.record_scratch(used)
+
+
+def pid_alive(pid):
+    """
+    Check if a process is still running
+
+    Parameters:
+    pid: process id
+
+    Return value: True if the process exists
+    """
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def get_boot_time():
+    """
+    Get the time the system booted, so processes from before a reboot aren't mistaken for running ones
+
+    Parameters:
+    None
+
+    Return value: boot time in seconds since the epoch
+    """
+    try:
+        with open("/proc/stat") as stat:
+            for line in stat:
+                if line.startswith("btime"):
+                    return float(line.split()[1])
+    except OSError:
+        pass
+    return 0
@@ -41,7 +41,8 @@ def disclogging(disc, oldlog):
             logname = "empty.log"
     else:
         if disc.disctype in ["dvd", "bluray"]:
-            logname = slugify(disc.videotitle) + ".log"
+            # the title isn't known yet while it is looked up in the background
+            logname = slugify(disc.videotitle or disc.label) + ".log"
         else:
             logname = slugify(disc.label) + ".log"
 
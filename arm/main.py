@@ -1,24 +1,26 @@
 #!/usr/bin/python3
 
 import sys
+import atexit
 import argparse
 import os
 import logging
 import datetime
 import logger
 import utils
-import identify
+import jobs
+import space
+import emby
 
 from config import cfg
 from classes import Disc
-from getkeys import grabkeys
-from ripper import Ripper
 
 
 def entry():
     """ Entry to program, parses arguments"""
     parser = argparse.ArgumentParser(description='Process disc using ARM')
     parser.add_argument('-d', '--devpath', help='Devpath', required=True)
+    parser.add_argument('-j', '--job', help='Id of the queued job to process', type=int)
 
     return parser.parse_args()
 
@@ -26,21 +28,37 @@ def entry():
 def main(disc, logfile):
 
     """main dvd processing function"""
+    # imported here, so a run that finds the drive empty exits without loading the identification and ripping code
+    import identify
+    from ripper import Ripper
+
     logging.info("Entering main function")
 
-    identify.identify(disc, logfile)
+    if disc.job.reached("identified"):
+        logging.info("Resuming job " + str(disc.job.job_id) + " after stage: " + disc.job.stage)
+        disc.restore(disc.job.disc)
+    elif cfg['ASYNC_IDENTIFY']:
+        # the job reaches the identified stage once the title lookup is applied
+        identify.identify_async(disc, logfile)
+    else:
+        identify.identify(disc, logfile)
+        disc.job.set_stage("identified", disc)
 
     # Move logging to a disc-specific log file and rename the old file
     logfile = logger.disclogging(disc, logfile)
     logging.info("Log file: " + logfile)
+    jobs.update(disc.job.job_id, logfile=logfile)
 
     log_arm_params(disc)
 
     if cfg['HASHEDKEYS']:
         logging.info("Getting MakeMKV hashed keys for UHD rips")
+        from getkeys import grabkeys
         grabkeys()
 
     ripper = Ripper(disc, logfile)
+    disc.job.set_stage("complete", disc)
+    disc.job.finish("done")
     logging.info("ARM processing complete")
 
 
@@ -61,8 +79,8 @@ def log_arm_params(disc):
     logging.info("**** Logging config parameters ****")
     logging.info("skip_transcode: " + str(cfg['SKIP_TRANSCODE']))
     logging.info("mainfeature: " + str(cfg['MAINFEATURE']))
-    logging.info("minlength: " + cfg['MINLENGTH'])
-    logging.info("maxlength: " + cfg['MAXLENGTH'])
+    logging.info("minlength: " + str(cfg['MINLENGTH']))
+    logging.info("maxlength: " + str(cfg['MAXLENGTH']))
     logging.info("videotype: " + cfg['VIDEOTYPE'])
     logging.info("ripmethod: " + cfg['RIPMETHOD'])
     logging.info("mkv_args: " + cfg['MKV_ARGS'])
@@ -78,7 +96,7 @@ def log_arm_params(disc):
     logging.info("extras_sub: " + cfg['EXTRAS_SUB'])
     logging.info("emby_refresh: " + str(cfg['EMBY_REFRESH']))
     logging.info("emby_server: " + cfg['EMBY_SERVER'])
-    logging.info("emby_port: " + cfg['EMBY_PORT'])
+    logging.info("emby_port: " + str(cfg['EMBY_PORT']))
     logging.info("notify_rip: " + str(cfg['NOTIFY_RIP']))
     logging.info("notify_transcode " + str(cfg['NOTIFY_TRANSCODE']))
     logging.info("**** End of config parameters ****")
@@ -97,18 +115,35 @@ if __name__ == "__main__":
     logger.cleanuplogs(cfg['LOGPATH'], cfg['LOGLIFE'])
 
     args = entry()
-    devpath = args.devpath
+    devpath = jobs.normalize_devpath(args.devpath)
     logging.info("DEVPATH provided: " + devpath)
 
-    disc = Disc(devpath)
-    logging.info("Disc label: " + disc.label)
-
-    if utils.get_cdrom_status(devpath) != 4:
+    if args.job:
+        job = jobs.get(args.job)
+        jobs.update(job.job_id, logfile=logfile)
+    else:
+        job = jobs.create(devpath, logfile)
+        # no worker sends the Emby updates of a job started by hand
+        atexit.register(emby.flush)
+    logging.info("Job id: " + str(job.job_id))
+
+    # a job resumed after the rip doesn't need the disc anymore
+    if not job.reached("ripped") and utils.get_cdrom_status(devpath) != 4:
         logging.info("Drive appears to be empty or is not ready.  Exiting ARM.")
+        job.finish("skipped")
         sys.exit()
 
+    disc = Disc(devpath)
+    disc.job = job
+    logging.info("Disc label: " + disc.label)
+
     try:
         main(disc, logfile)
+    except space.NoSpaceError as space_error:
+        logging.error(str(space_error) + ".  Exiting ARM.")
+        utils.notify("ARM notification", str(space_error))
+        job.finish("failed")
     except Exception:
         logging.exception("A fatal error has occured and ARM is exiting.  See traceback below for details.")
         utils.notify("ARM notification", "ARM encountered a fatal error processing " + str(disc.videotitle) + ". Check the logs for more details")
+        job.finish("failed")
@@ -1,32 +1,52 @@
 #!/usr/bin/python3
 
 import os
+import time
+import json
 import logging
 import subprocess
 import shlex
 import utils
+import runner
+import dedupe
+import space
 
 from config import cfg
 
+# MakeMKV robot mode attribute ids (apdefs.h)
+AP_ITEM_TYPE = 1
+AP_NAME = 2
+AP_LANG_CODE = 3
+AP_CHAPTER_COUNT = 8
+AP_DURATION = 9
+AP_DISK_SIZE_BYTES = 11
+AP_SOURCE_FILE_NAME = 16
+AP_SEGMENTS_MAP = 26
+AP_OUTPUT_FILE_NAME = 27
 
-def makemkv(logfile, disc):
+
+def makemkv(logfile, disc, on_title=None, mainfeature=False):
     """
     Rip Blurays with MakeMKV
 
     Parameters:
     logfile: location of logfile to redirect MakeMKV logs to
     disc: disc object
+    on_title: optional function called with the path of each title file as soon
+              as MakeMKV has finished writing it (mkv rips only)
+    mainfeature: rip only the main feature to an mkv file, even if RIPMETHOD is backup
 
     Return value: path to ripped files or None if the operation fails
     """
 
     logging.info("Starting MakeMKV rip. Method is " + cfg['RIPMETHOD'])
 
-    rawpath = utils.make_dir(os.path.join(cfg['RAWPATH'], disc.videotitle + " (" + disc.videoyear + ")"))
+    rawpath = utils.make_dir(os.path.join(cfg['RAWPATH'], utils.output_name(disc)))
     logging.info("Destination is " + rawpath)
+    space.track(disc, "raw", rawpath)
 
     try:
-        rip_disc(disc, rawpath, logfile)
+        rip_disc(disc, rawpath, logfile, on_title, mainfeature)
     except:
         err = "Call to makemkv failed."
         logging.error(err)
@@ -35,13 +55,15 @@ def makemkv(logfile, disc):
     logging.info("Exiting MakeMKV processing with return value of: " + rawpath)
     return(rawpath)
 
-def rip_disc(disc, output_dir, logfile):
+def rip_disc(disc, output_dir, logfile, on_title=None, mainfeature=False):
     """
     Rips disc using MakeMKV
 
     Parameters:
     output_dir: path to output directory
     logfile: path to intended logfile
+    on_title: optional function called with the path of each completed title file
+    mainfeature: rip only the main feature to an mkv file, even if RIPMETHOD is backup
 
     Return value: True on successful run or False otherwise
     """
@@ -50,43 +72,438 @@ def rip_disc(disc, output_dir, logfile):
     except:
         return False
 
-    if cfg['RIPMETHOD'] == "backup" and disc.disctype == "bluray":
-        cmd = 'makemkvcon backup --decrypt {0} -r --noscan disc:{1} {2}>> {3}'.format(
-            cfg['MKV_ARGS'],
-            mdisc.strip(),
-            shlex.quote(output_dir),
-            logfile
-        )
+    if cfg['RIPMETHOD'] == "backup" and disc.disctype == "bluray" and not mainfeature:
+        cmd = ["makemkvcon", "backup", "--decrypt"] + shlex.split(cfg['MKV_ARGS']) + ["-r", "--noscan", "disc:" + mdisc.strip(), output_dir]
         logging.info("Backup disc")
-        logging.debug("Backing up with the following command: " + cmd)
-    elif cfg['RIPMETHOD'] == "mkv" or disc.disctype == "dvd":
-        cmd = 'makemkvcon mkv {0} -r --noscan dev:{1} all {2} --minlength={3}>> {4}'.format(
-            cfg['MKV_ARGS'],
-            disc.devpath,
-            shlex.quote(output_dir),
-            cfg['MINLENGTH'],
-            logfile
-        )
-        logging.info("Ripping disc")
-        logging.debug("Ripping with the following command: " + cmd)
+        logging.debug("Backing up with the following command: " + " ".join(cmd))
+    elif cfg['RIPMETHOD'] == "mkv" or disc.disctype == "dvd" or mainfeature:
+        plan = get_plan(disc, logfile)
+        if mainfeature:
+            plan = main_feature_plan(plan)
+        return rip_titles(disc, plan, output_dir, logfile, on_title)
     else:
         logging.info("I'm confused what to do....  Passing on MakeMKV")
 
     try:
-        mkv = subprocess.run(
-            cmd,
-            shell=True
-        )
-        logging.debug("The exit code for MakeMKV is: " + str(mkv.returncode))
-    except subprocess.CalledProcessError as mkv_error:
-        err = "Call to MakeMKV failed with code: " + str(mkv_error.returncode) + "(" + str(mkv_error.output) + ")"
-        logging.error(err)
+        returncode = runner.run(cmd, logfile, runner.makemkv_progress, runner.ProgressReporter(disc, "rip"), check=False)
+        logging.debug("The exit code for MakeMKV is: " + str(returncode))
+    except OSError as mkv_error:
+        logging.error("Call to MakeMKV failed: " + str(mkv_error))
         return False
     return True
 
+
+def rip_titles(disc, plan, output_dir, logfile, on_title=None):
+    """
+    Rips the titles selected in the plan to mkv files.  When every title is
+    selected, or there is no plan, the whole disc is ripped with a single
+    MakeMKV run.  Otherwise the selected titles are ripped one at a time.
+
+    Parameters:
+    disc: disc object
+    plan: list of titles from get_plan
+    output_dir: path to output directory
+    logfile: path to intended logfile
+    on_title: optional function called with the path of each completed title file
+
+    Return value: True if all MakeMKV runs were successful or False otherwise
+    """
+    selected = [str(t['id']) for t in plan if t['selected']]
+    if plan and not selected:
+        logging.warning("No titles were selected for ripping")
+        return False
+    if not plan or len(selected) == len(plan):
+        selected = ["all"]
+
+    completed = []
+    success = True
+    for title in selected:
+        cmd = ["makemkvcon", "mkv"] + shlex.split(cfg['MKV_ARGS']) + ["-r", "--noscan", "dev:" + disc.devpath, title, output_dir]
+        cmd.append("--minlength=" + str(cfg['MINLENGTH']))
+        if title == "all":
+            logging.info("Ripping disc")
+        else:
+            logging.info("Ripping title " + title)
+        logging.debug("Ripping with the following command: " + " ".join(cmd))
+
+        if on_title is not None:
+            returncode = rip_pipelined(cmd, output_dir, logfile, disc, on_title, completed)
+        else:
+            try:
+                returncode = runner.run(cmd, logfile, runner.makemkv_progress, runner.ProgressReporter(disc, "rip"), check=False)
+            except OSError as mkv_error:
+                logging.error("Call to MakeMKV failed: " + str(mkv_error))
+                return False
+            logging.debug("The exit code for MakeMKV is: " + str(returncode))
+
+        if returncode != 0:
+            logging.error("MakeMKV exited with code " + str(returncode) + " ripping " + title)
+            success = False
+    return success
+
+
+def main_feature_plan(plan):
+    """
+    Restrict a plan to its main feature.  The saved plan selects every title
+    when MAINFEATURE is off, but a job can still be limited to the main
+    feature, e.g. when it was downgraded for lack of space (see Ripper.admit).
+
+    Parameters:
+    plan: list of titles from get_plan
+
+    Return value: copy of the plan with only the main feature selected
+    """
+    restricted = []
+    for title in plan:
+        title = dict(title)
+        if title['selected'] and not title.get('mainfeature'):
+            title['selected'] = False
+            title['reason'] = "not the main feature"
+        restricted.append(title)
+    return restricted
+
+
+def get_plan(disc, logfile):
+    """
+    Gets the list of titles on the disc from MakeMKV and selects the ones to rip
+    (see select_titles).  The plan is saved with the disc's job, so a resumed
+    job reuses it instead of scanning the disc again.
+
+    Parameters:
+    disc: disc object.  The plan is stored in disc.plan
+    logfile: path to intended logfile
+
+    Return value: list of title dicts, empty if MakeMKV couldn't read the disc
+    """
+    if disc.job is not None and disc.job.titles:
+        logging.info("Using the title plan saved with job " + str(disc.job.job_id))
+        disc.plan = disc.job.titles
+        return disc.plan
+
+    cmd = ["makemkvcon", "-r", "--noscan", "--minlength=" + str(cfg['MINLENGTH']), "info", "dev:" + disc.devpath]
+    logging.info("Getting the list of titles from MakeMKV")
+
+    lines = []
+    try:
+        returncode = runner.run(cmd, logfile, runner.makemkv_progress, runner.ProgressReporter(disc, "scan"),
+                                lambda line, stream: lines.append(line) if stream == "stdout" else None, check=False)
+    except OSError as mkv_error:
+        logging.error("Call to MakeMKV failed: " + str(mkv_error))
+        returncode = None
+    plan = parse_info(lines)
+    if not plan:
+        logging.warning("MakeMKV didn't list any titles (exit code " + str(returncode) + ").  Ripping all titles")
+        return []
+
+    # the rip doesn't wait for the title lookup; titles a movie doesn't keep are removed after it (see drop_unkept)
+    select_titles(plan, disc)
+    for title in plan:
+        logging.info("Title " + str(title['id']) + " (" + title['source'] + "): " + str(title['duration']) + " seconds, " +
+                     str(title['chapters']) + " chapters.  " + ("Ripping" if title['selected'] else "Skipping") +
+                     (", " + title['reason'] if title['reason'] else ""))
+
+    disc.plan = plan
+    if disc.job is not None:
+        disc.job.set_titles(plan)
+    return plan
+
+
+def parse_info(lines):
+    """
+    Parse the title and stream information of MakeMKV robot mode info output
+    TINFO:title,attribute,code,"value"
+    SINFO:title,stream,attribute,code,"value"
+
+    Parameters:
+    lines: lines of MakeMKV output
+
+    Return value: list of title dicts, ordered by title id, with
+        id: MakeMKV title id
+        name: title name
+        duration: length in seconds
+        chapters: number of chapters
+        size: size in bytes
+        source: playlist or title set on the disc, e.g. 00800.mpls
+        segments: list of segment numbers the title is built from
+        file: name of the mkv file MakeMKV writes the title to
+        audio: list of audio track languages
+        subtitles: list of subtitle track languages
+    """
+    titles = {}
+    streams = {}
+    for line in lines:
+        if line.startswith("TINFO:"):
+            fields = line[6:].split(",", 3)
+            if len(fields) < 4:
+                continue
+            attr = int(fields[1])
+            value = fields[3].strip().strip('"')
+            title = titles.setdefault(int(fields[0]), {
+                'id': int(fields[0]),
+                'name': "",
+                'duration': 0,
+                'chapters': 0,
+                'size': 0,
+                'source': "",
+                'segments': [],
+                'file': "",
+                'audio': [],
+                'subtitles': [],
+            })
+            if attr == AP_NAME:
+                title['name'] = value
+            elif attr == AP_CHAPTER_COUNT:
+                title['chapters'] = int(value or 0)
+            elif attr == AP_DURATION:
+                title['duration'] = info_duration(value)
+            elif attr == AP_DISK_SIZE_BYTES:
+                title['size'] = int(value or 0)
+            elif attr == AP_SOURCE_FILE_NAME:
+                title['source'] = value
+            elif attr == AP_SEGMENTS_MAP:
+                title['segments'] = segment_list(value)
+            elif attr == AP_OUTPUT_FILE_NAME:
+                title['file'] = value
+        elif line.startswith("SINFO:"):
+            fields = line[6:].split(",", 4)
+            if len(fields) < 5:
+                continue
+            stream = streams.setdefault((int(fields[0]), int(fields[1])), {'type': "", 'lang': ""})
+            if int(fields[2]) == AP_ITEM_TYPE:
+                stream['type'] = fields[4].strip().strip('"')
+            elif int(fields[2]) == AP_LANG_CODE:
+                stream['lang'] = fields[4].strip().strip('"')
+
+    for (title, stream), info in sorted(streams.items()):
+        if title not in titles:
+            continue
+        if info['type'] == "Audio":
+            titles[title]['audio'].append(info['lang'])
+        elif info['type'] == "Subtitles":
+            titles[title]['subtitles'].append(info['lang'])
+
+    return [titles[t] for t in sorted(titles)]
+
+
+def info_duration(value):
+    """
+    Convert a MakeMKV duration such as 1:52:31 to seconds
+
+    Parameters:
+    value: duration as h:mm:ss
+
+    Return value: duration in seconds
+    """
+    seconds = 0
+    for part in value.split(":"):
+        try:
+            seconds = seconds * 60 + int(part)
+        except ValueError:
+            return 0
+    return seconds
+
+
+def segment_list(value):
+    """
+    Convert a MakeMKV segment map such as 1-3,5 to a list of segment numbers
+
+    Parameters:
+    value: segment map
+
+    Return value: list of segment numbers
+    """
+    segments = []
+    for part in value.split(","):
+        start, sep, end = part.strip().partition("-")
+        try:
+            if sep:
+                segments.extend(range(int(start), int(end) + 1))
+            elif start:
+                segments.append(int(start))
+        except ValueError:
+            pass
+    return segments
+
+
+def select_titles(plan, disc):
+    """
+    Select the titles to rip.  Titles outside MINLENGTH and MAXLENGTH are
+    skipped.  The longest title is marked as the main feature; for movies, when
+    MAINFEATURE is set or when extras wouldn't be kept because EXTRAS_SUB is
+    "None", only the main feature is ripped.  Otherwise duplicate and play all
+    titles are skipped (see dedupe).  The movie rules only apply if the video
+    type is already known; while it is looked up every title is ripped.
+
+    Parameters:
+    plan: list of title dicts from parse_info; updated in place with selected, reason and mainfeature
+    disc: disc object
+
+    Return value: None
+    """
+    minlength = cfg['MINLENGTH']
+    maxlength = cfg['MAXLENGTH']
+
+    main = None
+    for title in plan:
+        title['mainfeature'] = False
+        title['selected'] = False
+        if title['duration'] < minlength:
+            title['reason'] = "shorter than MINLENGTH"
+        elif title['duration'] > maxlength:
+            title['reason'] = "longer than MAXLENGTH"
+        else:
+            title['selected'] = True
+            title['reason'] = ""
+            if main is None or (title['duration'], title['size']) > (main['duration'], main['size']):
+                main = title
+
+    if main is None:
+        return
+    main['mainfeature'] = True
+    main['reason'] = "main feature"
+
+    reason = unkept_reason(disc)
+    if reason:
+        for title in plan:
+            if title['selected'] and title is not main:
+                title['selected'] = False
+                title['reason'] = reason
+        return
+
+    kept, skipped = dedupe.drop_duplicates(dict((t['id'], t) for t in plan), [t['id'] for t in plan if t['selected']], disc)
+    for title in plan:
+        if title['id'] in skipped:
+            title['selected'] = False
+            title['reason'] = skipped[title['id']]
+
+
+def unkept_reason(disc):
+    """
+    Check whether only the main feature of a disc is kept
+
+    Parameters:
+    disc: disc object
+
+    Return value: why the other titles are skipped, or None if they are kept
+    """
+    if disc.videotype == "movie" and cfg['MAINFEATURE']:
+        return "not the main feature (MAINFEATURE)"
+    if disc.videotype == "movie" and str(cfg['EXTRAS_SUB']).lower() == "none":
+        return "extras are not kept (EXTRAS_SUB is None)"
+    return None
+
+
+def drop_unkept(disc, output_dir, encode_dir=None):
+    """
+    Remove the titles that turn out not to be kept once the video type is
+    known (see unkept_reason).  The rip doesn't wait for the title lookup, so
+    the extras of a movie may have been ripped, and encoded, before it was
+    known to be a movie.
+
+    Parameters:
+    disc: disc object, identified.  The titles are deselected in disc.plan.
+    output_dir: directory the titles were ripped to
+    encode_dir: optional directory with encodes of the titles to remove as well
+
+    Return value: list of the titles removed
+    """
+    reason = unkept_reason(disc)
+    if reason is None:
+        return []
+
+    dropped = []
+    for title in disc.plan:
+        if not title['selected'] or title.get('mainfeature'):
+            continue
+        title['selected'] = False
+        title['reason'] = reason
+        dropped.append(title)
+        if not title.get('file'):
+            continue
+        paths = [os.path.join(output_dir, title['file'])]
+        if encode_dir is not None:
+            paths.append(os.path.join(encode_dir, os.path.splitext(title['file'])[0] + "." + cfg['DEST_EXT']))
+        for path in paths:
+            try:
+                os.remove(path)
+                logging.info("Removed " + path + ": " + reason)
+            except FileNotFoundError:
+                pass
+            except OSError as remove_error:
+                logging.warning("Could not remove " + path + ": " + str(remove_error))
+
+    if dropped and disc.job is not None:
+        disc.job.set_titles(disc.plan)
+    return dropped
+
+
+def rip_pipelined(cmd, output_dir, logfile, disc, on_title, completed=None):
+    """
+    Runs a MakeMKV mkv rip and hands each title file to on_title as soon as
+    MakeMKV has moved on to the next one, so transcoding can overlap the rip.
+    MakeMKV writes titles one at a time, so a title is complete once a newer
+    title file shows up in output_dir or MakeMKV exits.
+
+    Parameters:
+    cmd: MakeMKV command as a list of arguments
+    output_dir: path MakeMKV writes the title files to
+    logfile: path to intended logfile
+    disc: disc object
+    on_title: function called with the path of each completed title file
+    completed: optional list of title files already handed over by earlier runs; updated in place
+
+    Return value: exit code of MakeMKV
+    """
+    logging.info("Pipelining rip and transcode.  Titles are transcoded as soon as they are ripped")
+
+    if completed is None:
+        completed = []
+    last_check = [0]
+
+    def check_titles(line, stream):
+        # robot mode progress (PRG*) and messages mark the start of new titles
+        if line[:3] in ["PRG", "MSG"] and time.time() - last_check[0] >= 1:
+            last_check[0] = time.time()
+            for f in finished_titles(output_dir, completed, False):
+                on_title(f)
+
+    returncode = runner.run(cmd, logfile, runner.makemkv_progress, runner.ProgressReporter(disc, "rip"), check_titles, check=False)
+
+    logging.debug("The exit code for MakeMKV is: " + str(returncode))
+    for f in finished_titles(output_dir, completed, True):
+        on_title(f)
+    return returncode
+
+
+def finished_titles(output_dir, completed, rip_done):
+    """
+    Find title files MakeMKV has finished writing that haven't been reported yet
+
+    Parameters:
+    output_dir: path MakeMKV writes the title files to
+    completed: list of title files already reported; updated in place
+    rip_done: True once MakeMKV has exited, so the newest file is complete too
+
+    Return value: list of paths of newly completed title files, in rip order
+    """
+    files = [os.path.join(output_dir, f) for f in os.listdir(output_dir) if f.endswith(".mkv")]
+    files.sort(key=os.path.getmtime)
+    if not rip_done:
+        # the newest file is still being written
+        files = files[:-1]
+
+    new = [f for f in files if f not in completed]
+    for f in new:
+        logging.info("MakeMKV finished writing " + f)
+        completed.append(f)
+    return new
+
+
 def get_disc_num(disc):
     """
-    Gets the disc number as determined by makemkvcon
+    Gets the disc number as determined by makemkvcon.  The drive list is
+    cached (see read_drive_cache), so makemkvcon only probes the drives when
+    drives have been added or removed since the last probe.
 
     Parameters:
     disc: disc object
@@ -94,17 +511,111 @@ def get_disc_num(disc):
     Return value: the MakeMKV disc number
     """
     logging.debug("Getting MakeMKV disc number")
-    cmd = 'makemkvcon -r --noscan info disc:9999  |grep {0} |grep -oP \'(?<=:).*?(?=,)\''.format(
-                disc.devpath
-    )
+
+    drives = read_drive_cache()
+    if disc.devpath in drives:
+        mdisc = drives[disc.devpath]
+        logging.info("MakeMKV disc number: " + mdisc + " (cached)")
+        return mdisc
 
     try:
-        mdisc = subprocess.check_output(
-            cmd,
-            shell=True
-        ).decode("utf-8")
-        logging.info("MakeMKV disc number: " + mdisc.strip())
+        drives = probe_drives()
+        if disc.devpath not in drives:
+            raise subprocess.CalledProcessError(1, "makemkvcon", "Drive " + disc.devpath + " not found")
+        mdisc = drives[disc.devpath]
+        logging.info("MakeMKV disc number: " + mdisc)
         return mdisc
     except subprocess.CalledProcessError as mdisc_error:
         err = "Call to makemkv failed with code: " + str(mdisc_error.returncode) + "(" + str(mdisc_error.output) + ")"
         logging.error(err)
+
+
+def probe_drives():
+    """
+    Ask makemkvcon for the disc number of every drive and save them in the drive cache
+
+    Parameters:
+    None
+
+    Return value: dict of device path to MakeMKV disc number
+    """
+    cmd = ["makemkvcon", "-r", "--noscan", "info", "disc:9999"]
+
+    # drive lines look like DRV:0,2,999,1,"BD-RE HL-DT-ST BD-RE","LABEL","/dev/sr0"
+    drives = {}
+
+    def collect(line, stream):
+        if line.startswith("DRV:"):
+            fields = line[4:].rstrip().split(",")
+            devpath = fields[-1].strip('"')
+            if devpath:
+                drives[devpath] = fields[0]
+
+    # info disc:9999 is expected to fail after listing the drives
+    runner.run(cmd, on_line=collect, check=False)
+    logging.debug("MakeMKV drives: " + str(drives))
+
+    cache = {'devices': optical_devices(), 'drives': drives, 'updated': time.time()}
+    tmpfile = cfg['DRIVE_CACHE'] + "." + str(os.getpid())
+    try:
+        with open(tmpfile, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmpfile, cfg['DRIVE_CACHE'])
+    except OSError as cache_error:
+        logging.warning("Could not save MakeMKV drive cache: " + str(cache_error))
+    return drives
+
+
+def read_drive_cache():
+    """
+    Read the cached MakeMKV disc numbers.  The cache is stale, and ignored, when
+    the set of optical drives differs from when it was written or when it was
+    removed by invalidate_drive_cache after udev reported a drive being added or
+    removed.
+
+    Parameters:
+    None
+
+    Return value: dict of device path to MakeMKV disc number, empty if there is no valid cache
+    """
+    try:
+        with open(cfg['DRIVE_CACHE']) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    if cache.get('devices') != optical_devices():
+        logging.debug("MakeMKV drive cache is stale")
+        return {}
+    return cache.get('drives', {})
+
+
+def invalidate_drive_cache():
+    """
+    Remove the MakeMKV drive cache, so the next rip probes the drives again
+
+    Parameters:
+    None
+
+    Return value: None
+    """
+    try:
+        os.remove(cfg['DRIVE_CACHE'])
+        logging.info("Removed MakeMKV drive cache")
+    except OSError:
+        pass
+
+
+def optical_devices():
+    """
+    List the optical drives known to the kernel
+
+    Parameters:
+    None
+
+    Return value: sorted list of device names, e.g. ["sr0", "sr1"]
+    """
+    try:
+        return sorted(d for d in os.listdir("/sys/block") if d.startswith("sr"))
+    except OSError:
+        return []
@@ -0,0 +1,199 @@
+#!/usr/bin/python3
+
+import re
+import sys
+import json
+import time
+import argparse
+import logging
+import db
+
+from config import cfg
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata_cache (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT,
+    created REAL,
+    expires REAL,
+    PRIMARY KEY (kind, key)
+);
+"""
+
+DAY = 86400
+
+
+def entry():
+    """ Entry to program, parses arguments"""
+    parser = argparse.ArgumentParser(description='Manage the ARM metadata lookup cache')
+    subparsers = parser.add_subparsers(dest='command')
+    export = subparsers.add_parser('export', help='Write the cached lookups as JSON lines')
+    export.add_argument('file', help='File to write to, - for stdout', nargs='?', default="-")
+    imp = subparsers.add_parser('import', help='Add lookups from a file written by export')
+    imp.add_argument('file', help='File to read from, - for stdin')
+    subparsers.add_parser('purge', help='Remove expired lookups')
+
+    return parser.parse_args()
+
+
+def normalize(query):
+    """
+    Normalize a lookup key, so the same title written differently uses the same cache entry
+
+    Parameters:
+    query: title or query string
+
+    Return value: lowercase key with words separated by single spaces
+    """
+    return " ".join(re.split(r'[\W_]+', query.lower())).strip()
+
+
+def lookup(kind, key):
+    """
+    Get a cached lookup result
+
+    Parameters:
+    kind: kind of lookup, e.g. "dvd_crc64" or "omdb"
+    key: lookup key
+
+    Return value: tuple (cached, value).  cached is False if there is no unexpired
+                  entry.  value is None for a cached miss.
+    """
+    if not cfg['METADATA_CACHE']:
+        return False, None
+
+    try:
+        conn = db.connect(SCHEMA)
+        row = conn.execute("SELECT value FROM metadata_cache WHERE kind = ? AND key = ? AND expires > ?",
+                           (kind, key, time.time())).fetchone()
+        conn.close()
+    except Exception as cache_error:
+        logging.warning("Could not read the metadata cache: " + str(cache_error))
+        return False, None
+
+    if row is None:
+        return False, None
+    logging.debug("Metadata cache hit for " + kind + " " + key)
+    return True, json.loads(row['value']) if row['value'] is not None else None
+
+
+def store(kind, key, value):
+    """
+    Save a lookup result.  Results are kept for METADATA_CACHE_DAYS, misses
+    (value None) for METADATA_CACHE_MISS_DAYS, so discs that weren't found are
+    looked up again once the web services may have learned about them.
+
+    Parameters:
+    kind: kind of lookup, e.g. "dvd_crc64" or "omdb"
+    key: lookup key
+    value: JSON serializable result, or None if the lookup found nothing
+
+    Return value: None
+    """
+    if not cfg['METADATA_CACHE']:
+        return
+
+    now = time.time()
+    ttl = (cfg['METADATA_CACHE_DAYS'] if value is not None else cfg['METADATA_CACHE_MISS_DAYS']) * DAY
+    try:
+        conn = db.connect(SCHEMA)
+        conn.execute("INSERT OR REPLACE INTO metadata_cache (kind, key, value, created, expires) VALUES (?, ?, ?, ?, ?)",
+                     (kind, key, json.dumps(value) if value is not None else None, now, now + ttl))
+        conn.close()
+    except Exception as cache_error:
+        logging.warning("Could not write the metadata cache: " + str(cache_error))
+
+
+def export_entries(out):
+    """
+    Write all unexpired cache entries, one JSON object per line
+
+    Parameters:
+    out: file object to write to
+
+    Return value: number of entries written
+    """
+    conn = db.connect(SCHEMA)
+    count = 0
+    for row in conn.execute("SELECT * FROM metadata_cache WHERE expires > ? ORDER BY kind, key", (time.time(),)):
+        out.write(json.dumps({
+            'kind': row['kind'],
+            'key': row['key'],
+            'value': json.loads(row['value']) if row['value'] is not None else None,
+            'created': row['created'],
+            'expires': row['expires'],
+        }, sort_keys=True) + "\n")
+        count += 1
+    conn.close()
+    return count
+
+
+def import_entries(lines):
+    """
+    Add cache entries written by export_entries.  Entries without an expiry
+    time get the configured TTL, expired entries are skipped.
+
+    Parameters:
+    lines: iterable of JSON lines
+
+    Return value: number of entries imported
+    """
+    now = time.time()
+    conn = db.connect(SCHEMA)
+    conn.execute("BEGIN")
+    count = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        entry = json.loads(line)
+        value = entry.get('value')
+        expires = entry.get('expires')
+        if expires is None:
+            expires = now + (cfg['METADATA_CACHE_DAYS'] if value is not None else cfg['METADATA_CACHE_MISS_DAYS']) * DAY
+        if expires <= now:
+            continue
+        conn.execute("INSERT OR REPLACE INTO metadata_cache (kind, key, value, created, expires) VALUES (?, ?, ?, ?, ?)",
+                     (entry['kind'], entry['key'], json.dumps(value) if value is not None else None, entry.get('created', now), expires))
+        count += 1
+    conn.execute("COMMIT")
+    conn.close()
+    return count
+
+
+def purge():
+    """
+    Remove expired cache entries
+
+    Parameters:
+    None
+
+    Return value: number of entries removed
+    """
+    conn = db.connect(SCHEMA)
+    count = conn.execute("DELETE FROM metadata_cache WHERE expires <= ?", (time.time(),)).rowcount
+    conn.close()
+    return count
+
+
+if __name__ == "__main__":
+    args = entry()
+
+    if args.command == "export":
+        if args.file == "-":
+            count = export_entries(sys.stdout)
+        else:
+            with open(args.file, "w") as f:
+                count = export_entries(f)
+        print("Exported " + str(count) + " entries", file=sys.stderr)
+    elif args.command == "import":
+        if args.file == "-":
+            count = import_entries(sys.stdin)
+        else:
+            with open(args.file) as f:
+                count = import_entries(f)
+        print("Imported " + str(count) + " entries", file=sys.stderr)
+    elif args.command == "purge":
+        print("Removed " + str(purge()) + " expired entries", file=sys.stderr)
+    else:
+        sys.exit("Usage: metacache.py {export,import,purge}")
@@ -0,0 +1,267 @@
+#!/usr/bin/python3
+
+import time
+import atexit
+import logging
+import threading
+import db
+import utils
+
+from config import cfg
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS notifications (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    provider TEXT NOT NULL,
+    title TEXT,
+    body TEXT,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created REAL,
+    next_attempt REAL,
+    claimed REAL,
+    last_error TEXT
+);
+"""
+
+# Seconds after which a notification claimed by a process that died is sent again
+STALE_CLAIM = 600
+
+_wake = threading.Event()
+# held while sending, so the dispatcher thread and flush don't send at the same time
+_lock = threading.Lock()
+_start_lock = threading.Lock()
+_thread = None
+
+
+def send_pushbullet(title, body, timeout):
+    """ Send a note with Pushbullet """
+    response = utils.http_session().post("https://api.pushbullet.com/v2/pushes", headers={'Access-Token': cfg['PB_KEY']},
+                                         json={'type': "note", 'title': title, 'body': body}, timeout=timeout)
+    response.raise_for_status()
+
+
+def send_ifttt(title, body, timeout):
+    """ Trigger the IFTTT_EVENT webhook with the title and body as value1 and value2 """
+    response = utils.http_session().post("https://maker.ifttt.com/trigger/" + cfg['IFTTT_EVENT'] + "/with/key/" + cfg['IFTTT_KEY'],
+                                         json={'value1': title, 'value2': body}, timeout=timeout)
+    response.raise_for_status()
+
+
+def send_pushover(title, body, timeout):
+    """ Send a message with Pushover """
+    response = utils.http_session().post("https://api.pushover.net/1/messages.json",
+                                         data={'token': cfg['PO_APP_KEY'], 'user': cfg['PO_USER_KEY'], 'title': title, 'message': body},
+                                         timeout=timeout)
+    response.raise_for_status()
+
+
+# Notification services, the config key that enables each one and the function sending to it
+PROVIDERS = [
+    ("pushbullet", 'PB_KEY', send_pushbullet),
+    ("ifttt", 'IFTTT_KEY', send_ifttt),
+    ("pushover", 'PO_USER_KEY', send_pushover),
+]
+
+
+def enabled():
+    """
+    Get the notification services that have a key configured
+
+    Parameters:
+    None
+
+    Return value: list of provider names
+    """
+    return [name for name, key, send in PROVIDERS if cfg[key]]
+
+
+def enqueue(title, body):
+    """
+    Add a notification to the outbox in the ARM database for every enabled
+    service and wake the dispatcher.  Notifications are sent in the
+    background, so a slow or unreachable service doesn't hold up the job, and
+    survive a crash because they are only removed once they were sent.
+
+    Parameters:
+    title: title of the notification
+    body: text of the notification
+
+    Return value: None
+    """
+    providers = enabled()
+    if not providers:
+        return
+
+    now = time.time()
+    try:
+        conn = db.connect(SCHEMA)
+        conn.execute("BEGIN")
+        for provider in providers:
+            conn.execute("INSERT INTO notifications (provider, title, body, status, created, next_attempt) VALUES (?, ?, ?, 'pending', ?, ?)",
+                         (provider, title, body, now, now))
+        conn.execute("COMMIT")
+        conn.close()
+    except Exception as outbox_error:
+        logging.error("Could not queue notification, sending it now: " + str(outbox_error))
+        for name, key, send in PROVIDERS:
+            if name in providers:
+                try:
+                    send(title, body, cfg['NOTIFY_TIMEOUT'])
+                except Exception as send_error:
+                    logging.error("Failed sending " + name + " notification: " + str(send_error))
+        return
+
+    start()
+    _wake.set()
+
+
+def claim(min_age=0):
+    """
+    Take the notifications that are due from the outbox, so no other process sends them too
+
+    Parameters:
+    min_age: only claim notifications queued at least this many seconds ago
+
+    Return value: list of claimed rows, oldest first
+    """
+    now = time.time()
+    conn = db.connect(SCHEMA)
+    conn.execute("BEGIN IMMEDIATE")
+    conn.execute("UPDATE notifications SET status = 'pending' WHERE status = 'sending' AND claimed < ?", (now - STALE_CLAIM,))
+    rows = conn.execute("SELECT * FROM notifications WHERE status = 'pending' AND next_attempt <= ? AND created <= ? ORDER BY id",
+                        (now, now - min_age)).fetchall()
+    if rows:
+        conn.execute("UPDATE notifications SET status = 'sending', claimed = ? WHERE id IN (" + ", ".join("?" for r in rows) + ")",
+                     [now] + [r['id'] for r in rows])
+    conn.execute("COMMIT")
+    conn.close()
+    return rows
+
+
+def digest(rows):
+    """
+    Merge notifications sent to the same service at the same time into one
+
+    Parameters:
+    rows: notification rows, oldest first
+
+    Return value: tuple of title and body
+    """
+    if len(rows) == 1:
+        return rows[0]['title'], rows[0]['body']
+    return "ARM: " + str(len(rows)) + " notifications", "\n".join(r['title'] + ": " + r['body'] for r in rows)
+
+
+def dispatch(min_age=0):
+    """
+    Send the notifications that are due, one digest per service.  Failed
+    sends are retried with exponential backoff (NOTIFY_RETRY_SECONDS, doubled
+    after each attempt) until NOTIFY_MAX_ATTEMPTS.
+
+    Parameters:
+    min_age: only send notifications queued at least this many seconds ago, so bursts are merged
+
+    Return value: number of notifications sent
+    """
+    try:
+        rows = claim(min_age)
+    except Exception as outbox_error:
+        logging.error("Could not read the notification outbox: " + str(outbox_error))
+        return 0
+
+    sent = 0
+    for name, key, send in PROVIDERS:
+        batch = [r for r in rows if r['provider'] == name]
+        if not batch:
+            continue
+        title, body = digest(batch)
+        ids = [r['id'] for r in batch]
+        placeholders = ", ".join("?" for i in ids)
+        try:
+            send(title, body, cfg['NOTIFY_TIMEOUT'])
+        except Exception as send_error:
+            logging.warning("Failed sending " + name + " notification: " + str(send_error))
+            attempts = max(r['attempts'] for r in batch) + 1
+            conn = db.connect(SCHEMA)
+            if attempts >= cfg['NOTIFY_MAX_ATTEMPTS']:
+                logging.error("Giving up on " + str(len(batch)) + " " + name + " notification(s) after " + str(attempts) + " attempts")
+                conn.execute("UPDATE notifications SET status = 'failed', attempts = ?, last_error = ? WHERE id IN (" + placeholders + ")",
+                             [attempts, str(send_error)] + ids)
+            else:
+                retry = time.time() + cfg['NOTIFY_RETRY_SECONDS'] * 2 ** (attempts - 1)
+                conn.execute("UPDATE notifications SET status = 'pending', attempts = ?, next_attempt = ?, last_error = ? "
+                             "WHERE id IN (" + placeholders + ")", [attempts, retry, str(send_error)] + ids)
+            conn.close()
+            continue
+
+        conn = db.connect(SCHEMA)
+        conn.execute("DELETE FROM notifications WHERE id IN (" + placeholders + ")", ids)
+        conn.close()
+        logging.debug("Sent " + name + " notification: " + title)
+        sent += len(batch)
+    return sent
+
+
+def run():
+    """
+    Dispatcher thread: waits for new notifications, gives other drives
+    NOTIFY_COALESCE_SECONDS to add theirs, and sends them.  Wakes up every
+    NOTIFY_RETRY_SECONDS to retry failed notifications.
+
+    Parameters:
+    None
+
+    Return value: None
+    """
+    while True:
+        _wake.wait(cfg['NOTIFY_RETRY_SECONDS'])
+        if _wake.is_set():
+            _wake.clear()
+            time.sleep(cfg['NOTIFY_COALESCE_SECONDS'])
+        with _lock:
+            dispatch()
+
+
+def start():
+    """
+    Start the dispatcher thread of this process, if it isn't running yet
+
+    Parameters:
+    None
+
+    Return value: None
+    """
+    global _thread
+    with _start_lock:
+        if _thread is None:
+            _thread = threading.Thread(target=run, name="notifier", daemon=True)
+            _thread.start()
+            atexit.register(flush)
+
+
+def flush():
+    """
+    Send what is left in the outbox before the process exits.  Waits until the
+    newest notification is NOTIFY_COALESCE_SECONDS old, so notifications of
+    drives finishing at the same time still go out as one digest.
+
+    Parameters:
+    None
+
+    Return value: None
+    """
+    try:
+        conn = db.connect(SCHEMA)
+        newest = conn.execute("SELECT MAX(created) FROM notifications WHERE status = 'pending'").fetchone()[0]
+        conn.close()
+    except Exception as outbox_error:
+        logging.error("Could not read the notification outbox: " + str(outbox_error))
+        return
+    if newest is None:
+        return
+    wait = newest + cfg['NOTIFY_COALESCE_SECONDS'] - time.time()
+    if wait > 0:
+        time.sleep(wait)
+    with _lock:
+        dispatch()
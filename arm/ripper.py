@@ -1,9 +1,16 @@
 import sys
 import os
+import time
 import subprocess
 import logging
+import shutil
+import space
+import datacopy
+import fileops
 import handbrake
+import jobs
 import makemkv
+import runner
 import utils
 
 from config import cfg
@@ -20,14 +27,17 @@ class Ripper(object):
         __init__(disc, logfile)
         disc_notify(disc)
         rip_dvd(disc, logfile, dest_dir)
+        rip_bluray_mainfeature(disc, logfile, dest_dir)
         rip_and_transcode(disc, logfile, dest_dir)
+        report_errors(disc)
         create_output_dirs(disc)
-        makemkv_rip(disc, logfile)
-        move_raw(mkvoutpath, dest_dir)
+        finish_output_dir(disc, dest_dir)
+        makemkv_rip(disc, logfile, on_title, mainfeature)
+        move_raw(disc, mkvoutpath, dest_dir)
         delete_raw(mkvoutpath)
         rip_music(disc, logfile)
         rip_data(disc, datapath, logfile)
-        set_permissions(dest_dir)
+        set_permissions(disc, dest_dir)
     """
 
     def __init__(self, disc, logfile=""):
@@ -36,21 +46,71 @@ class Ripper(object):
         if disc.disctype=="music":
             self.rip_music(disc, logfile)
         elif disc.disctype in ["bluray", "dvd", "data"]:
+            if disc.disctype == "bluray" and cfg['MAINFEATURE']:
+                # main feature mode depends on the video type
+                disc.wait_identified()
+            mainfeature = self.admit(disc, logfile)
             dest_dir = self.create_output_dirs(disc)
             logging.info("Processing files to: " + dest_dir)
+            space.track(disc, "data" if disc.disctype == "data" else "output", dest_dir)
 
-            if disc.disctype=="bluray" or disc.disctype=="dvd" and not cfg['MAINFEATURE']:
+            if disc.disctype=="bluray" and mainfeature and disc.videotype == "movie":
+                self.rip_bluray_mainfeature(disc, logfile, dest_dir)
+            elif disc.disctype=="bluray" or disc.disctype=="dvd" and not mainfeature:
                 self.rip_and_transcode(disc, logfile, dest_dir)
-            elif disc.disctype=="dvd" and cfg['MAINFEATURE']:
+            elif disc.disctype=="dvd" and mainfeature:
                 self.rip_dvd(disc, logfile, dest_dir)
             elif disc.disctype=="data":
                 self.rip_data(disc, dest_dir, logfile)
-            self.set_permissions(dest_dir)
+            if disc.disctype in ["bluray", "dvd"]:
+                dest_dir = self.finish_output_dir(disc, dest_dir)
+            self.set_permissions(disc, dest_dir)
         else:
             logging.info("Couldn't identify the disc type. Exiting without any action.")
 
         utils.notify("ARM notification", str(disc.label) + " processing complete.")
 
+    def admit(self, disc, logfile):
+        """
+        Check that RAWPATH and MEDIA_DIR have space for the job before anything
+        is written (see space.admit).  A job that doesn't fit is downgraded to
+        the main feature of a movie, or waits for other jobs to free space.
+        The decision is kept in disc.mainfeature, which is saved with the job,
+        so a resumed job processes its raw files the way they were ripped.
+
+        Parameters:
+        disc: disc object
+        logfile: path of intended logfile
+
+        Return value: True if only the main feature should be processed
+        """
+
+        if disc.mainfeature is not None:
+            logging.info("Using the decision of the interrupted run: " + ("main feature only" if disc.mainfeature else "all titles"))
+            return disc.mainfeature
+
+        mainfeature = bool(cfg['MAINFEATURE']) and (disc.disctype != "bluray" or disc.videotype == "movie")
+        if cfg['SPACE_CHECK'] and disc.job is not None and not disc.job.reached("ripped"):
+
+            def mainfeature_plan():
+                # only a movie has a main feature to fall back to
+                disc.wait_identified()
+                if disc.videotype != "movie":
+                    return None
+                return makemkv.get_plan(disc, logfile) if disc.disctype == "bluray" else disc.plan
+
+            plan = []
+            downgrade = None
+            if disc.disctype in ["bluray", "dvd"]:
+                if cfg['RIPMETHOD'] == "mkv" and disc.disctype == "bluray" or disc.disctype == "dvd" and not mainfeature:
+                    # the plan is reused for the rip
+                    plan = makemkv.get_plan(disc, logfile)
+                downgrade = mainfeature_plan
+            mainfeature = space.admit(disc, plan, mainfeature, downgrade)
+
+        disc.mainfeature = mainfeature
+        return mainfeature
+
     def disc_notify(self, disc):
         """
         Send job start notifications using IFTTT
@@ -61,7 +121,7 @@ class Ripper(object):
         Return value: None
         """
         if disc.disctype in ["dvd", "bluray"]:
-            utils.notify("ARM notification", "Found disc: " + str(disc.videotitle) + ". Video type is "
+            utils.notify("ARM notification", "Found disc: " + str(disc.videotitle or disc.label) + ". Video type is "
                          + str(disc.videotype) + ". Main Feature is " + str(cfg['MAINFEATURE']) + ".")
         elif disc.disctype == "music":
             utils.notify("ARM notification", "Found music CD: " + disc.label + ". Ripping all tracks.")
@@ -87,6 +147,51 @@ class Ripper(object):
         handbrake.handbrake_mainfeature(hbinpath, dest_dir, logfile, disc)
         disc.eject()
 
+    def rip_bluray_mainfeature(self, disc, logfile, dest_dir):
+        """
+        Rips and transcodes the main feature of a Bluray movie.  MakeMKV rips
+        only the main playlist from the title plan instead of backing up the
+        whole disc, then HandBrake encodes it as the main feature.
+
+        Parameters:
+        disc: disc object
+        logfile: path of intended logfile
+        dest_dir: path to directory of final video files
+
+        Return value: None
+        """
+
+        if disc.job is not None and disc.job.reached("ripped"):
+            mkvoutpath = disc.job.rawpath
+            logging.info("Disc was already ripped by an earlier run of this job.  Resuming with raw files in " + str(mkvoutpath))
+        else:
+            mkvoutpath = self.makemkv_rip(disc, logfile, mainfeature=True)
+            disc.eject()
+
+        files = [f for f in os.listdir(mkvoutpath) if f.endswith(".mkv")]
+        if not files:
+            logging.error("MakeMKV didn't rip the main feature")
+            disc.errors.append("main feature")
+        else:
+            # without a title plan MakeMKV rips every title, so take the biggest
+            mainfile = max(files, key=lambda f: os.path.getsize(os.path.join(mkvoutpath, f)))
+            logging.info("Main feature is " + mainfile)
+            if cfg['SKIP_TRANSCODE']:
+                logging.info("SKIP_TRANSCODE is true.")
+                utils.move_files(mkvoutpath, mainfile, disc.hasnicetitle, disc.videotitle + " (" + disc.videoyear + ")", True)
+            elif not handbrake.handbrake_mainfeature(os.path.join(mkvoutpath, mainfile), dest_dir, logfile, disc):
+                disc.errors.append("main feature")
+
+        if disc.job is not None:
+            disc.job.set_stage("transcoded", disc)
+        self.report_errors(disc)
+
+        # remove raw files, if specified in config
+        if cfg['DELRAWFILES']:
+            self.delete_raw(mkvoutpath)
+        if disc.job is not None and disc.job.peak_scratch:
+            logging.info("Peak space used in RAWPATH by this job: " + str(disc.job.peak_scratch // 1048576) + " MB")
+
     def rip_and_transcode(self, disc, logfile, dest_dir):
         """
         Rips and transcodes video discs
@@ -99,19 +204,51 @@ class Ripper(object):
         Return value: None
         """
 
-        mkvoutpath = self.makemkv_rip(disc, logfile)
-        disc.eject()
-        if cfg['RIPMETHOD'] == "mkv" and cfg['SKIP_TRANSCODE']:
-            logging.info("SKIP_TRANSCODE is true.")
-            self.move_raw(mkvoutpath, dest_dir)
-            self.set_permissions(dest_dir)
-        elif disc.disctype == "dvd":
-            logging.info("RIPMETHOD is backup.")
-            handbrake.handbrake_mkv(mkvoutpath, dest_dir, logfile, disc)
+        resumed = disc.job is not None and disc.job.reached("ripped")
+        if resumed:
+            mkvoutpath = disc.job.rawpath
+            logging.info("Disc was already ripped by an earlier run of this job.  Resuming with raw files in " + str(mkvoutpath))
+
+        if not resumed and cfg['RIP_PIPELINE'] and not cfg['SKIP_TRANSCODE'] and (cfg['RIPMETHOD'] == "mkv" or disc.disctype == "dvd"):
+            # transcode each title as soon as MakeMKV has finished it
+            pool = handbrake.TranscodePool(logfile, disc)
+            mkvoutpath = self.makemkv_rip(disc, logfile, lambda f: handbrake.queue_mkv(pool, f, dest_dir, logfile, disc))
+            disc.eject()
+            handbrake.collect_mkv(pool, disc)
+            makemkv.drop_unkept(disc, mkvoutpath, dest_dir)
         else:
-            handbrake.handbrake_all(mkvoutpath, dest_dir, logfile, disc)
+            if not resumed:
+                mkvoutpath = self.makemkv_rip(disc, logfile)
+                disc.eject()
+            makemkv.drop_unkept(disc, mkvoutpath)
+            if cfg['RIPMETHOD'] == "mkv" and cfg['SKIP_TRANSCODE']:
+                logging.info("SKIP_TRANSCODE is true.")
+                self.move_raw(disc, mkvoutpath, dest_dir)
+                self.set_permissions(disc, dest_dir)
+            elif disc.disctype == "dvd":
+                logging.info("RIPMETHOD is backup.")
+                handbrake.handbrake_mkv(mkvoutpath, dest_dir, logfile, disc)
+            else:
+                handbrake.handbrake_all(mkvoutpath, dest_dir, logfile, disc)
+
+        if disc.job is not None:
+            disc.job.set_stage("transcoded", disc)
+        self.report_errors(disc)
+
+        # remove raw files, if specified in config
+        if cfg['DELRAWFILES']:
+            self.delete_raw(mkvoutpath)
+
+    def report_errors(self, disc):
+        """
+        Log and notify the result of the transcode, listing failed titles
+
+        Parameters:
+        disc: disc object
+
+        Return value: None
+        """
 
-        # report errors if any
         if disc.errors:
             errlist = ', '.join(disc.errors)
             if cfg['NOTIFY_TRANSCODE']:
@@ -122,10 +259,6 @@ class Ripper(object):
                 utils.notify("ARM notification", str(disc.videotitle) + " processing complete.")
             logging.info("ARM processing complete")
 
-        # remove raw files, if specified in config
-        if cfg['DELRAWFILES']:
-            self.delete_raw(mkvoutpath)
-
     def create_output_dirs(self, disc):
         """
         Creates output directories necessary for rips
@@ -137,27 +270,81 @@ class Ripper(object):
         """
 
         if disc.disctype in ["dvd", "bluray"]:
-            output_dir = utils.make_dir(os.path.join(cfg['MEDIA_DIR'], disc.videotitle + " (" + disc.videoyear + ")"))
+            output_dir = utils.make_dir(os.path.join(cfg['MEDIA_DIR'], utils.output_name(disc)))
         elif disc.disctype == "data":
+            if disc.job is not None and disc.job.rawpath and os.path.isdir(disc.job.rawpath):
+                # continue the image of an interrupted run of this job
+                return disc.job.rawpath
             output_dir = utils.make_dir(os.path.join(cfg['ARMPATH'], str(disc.label)))
+            if disc.job is not None:
+                jobs.update(disc.job.job_id, rawpath=output_dir)
+                disc.job.rawpath = output_dir
         return output_dir
 
-    def makemkv_rip(self, disc, logfile):
+    def finish_output_dir(self, disc, dest_dir):
+        """
+        Give an output directory created while the title was still being looked
+        up its final name
+
+        Parameters:
+        disc: disc object
+        dest_dir: path of the output directory
+
+        Return value: path of the output directory after renaming
+        """
+
+        disc.wait_identified()
+        final_dir = os.path.join(cfg['MEDIA_DIR'], utils.output_name(disc))
+        if dest_dir == final_dir or os.path.basename(dest_dir).startswith(os.path.basename(final_dir) + "_"):
+            return dest_dir
+        if not os.path.isdir(dest_dir):
+            # the encodes were moved to the title directory (see utils.move_files), which removed it
+            logging.info("Output of the job is in " + final_dir)
+            return final_dir
+
+        try:
+            if not os.listdir(dest_dir):
+                os.rmdir(dest_dir)
+                return final_dir
+            if os.path.exists(final_dir):
+                final_dir = final_dir + "_" + str(round(time.time() * 100))
+            logging.info("Renaming " + dest_dir + " to " + final_dir)
+            os.rename(dest_dir, final_dir)
+        except OSError as rename_error:
+            logging.error("Could not rename " + dest_dir + ": " + str(rename_error))
+            return dest_dir
+        return final_dir
+
+    def makemkv_rip(self, disc, logfile, on_title=None, mainfeature=False):
         """
         Run MakeMKV and return the output path to the files generated
 
         Parameters:
         disc: disc object
         logfile: path to intended logfile
+        on_title: optional function called with each title file as soon as it is ripped
+        mainfeature: rip only the main feature
 
         Return value: path to the directory containing the ripped files
         """
 
-        mkvoutpath = makemkv.makemkv(logfile, disc)
+        def ripped(f):
+            # measure the raw files as they pile up, before the transcodes start removing them
+            jobs.record_scratch(disc, utils.dir_size(os.path.dirname(f)))
+            on_title(f)
+
+        mkvoutpath = makemkv.makemkv(logfile, disc, ripped if on_title is not None else None, mainfeature)
         if mkvoutpath is None:
             logging.error("MakeMKV did not complete successfully.  Exiting ARM!")
             sys.exit()
 
+        # the title is needed from here on to name and move the files
+        disc.wait_identified()
+
+        if disc.job is not None:
+            disc.job.set_stage("ripped", disc, rawpath=mkvoutpath)
+            disc.job.record_scratch(utils.dir_size(mkvoutpath))
+
         if cfg['SKIP_TRANSCODE']:
             logging.debug(str(disc.videotitle + " rip complete."))
             if cfg['NOTIFY_RIP']:
@@ -169,11 +356,12 @@ class Ripper(object):
 
         return mkvoutpath
 
-    def move_raw(self, mkvoutpath, dest_dir):
+    def move_raw(self, disc, mkvoutpath, dest_dir):
         """
-        Moves raw mkv files to dest_dir
+        Moves raw mkv files to dest_dir.  The files are moved concurrently (see fileops.move_all).
 
         Parameters:
+        disc: disc object
         mkvoutpath: path to raw ripped mkv files
         dest_dir: path to destination directory
 
@@ -182,6 +370,7 @@ class Ripper(object):
 
         logging.info("Moving raw mkv files. NOTE: Identified main feature may not be actual main feature")
         files = os.listdir(mkvoutpath)
+        moves = []
         if disc.videotype == "movie":
             logging.debug("Videotype: " + disc.videotype)
             # if videotype is movie, then move biggest title to media_dir
@@ -207,13 +396,16 @@ class Ripper(object):
                 for f in files:
                     if(f == largest_file_name):
                         # move main into media_dir
-                        utils.move_files(mkvoutpath, f, disc.hasnicetitle, disc.videotitle + " (" + disc.videoyear + ")", True)
-                    else:
+                        target = utils.move_target(mkvoutpath, f, disc.hasnicetitle, disc.videotitle + " (" + disc.videoyear + ")", True)
+                    elif not str(cfg['EXTRAS_SUB']).lower() == "none":
                         # move others into extras folder
-                        if not str(cfg['EXTRAS_SUB']).lower() == "none":
-                            utils.move_files(mkvoutpath, f, disc.hasnicetitle, disc.videotitle + " (" + disc.videoyear + ")", False)
-                        else:
-                            logging.info("Not moving extra: " + f)
+                        target = utils.move_target(mkvoutpath, f, disc.hasnicetitle, disc.videotitle + " (" + disc.videoyear + ")", False)
+                    else:
+                        logging.info("Not moving extra: " + f)
+                        target = None
+                    if target is not None:
+                        moves.append((os.path.join(mkvoutpath, f), target))
+            fileops.move_all(moves)
             # Clean up
             logging.debug("Attempting to remove extra folder in ARMPATH: " + dest_dir)
             try:
@@ -228,8 +420,9 @@ class Ripper(object):
 
             for f in files:
                 mkvoutfile = os.path.join(mkvoutpath, f)
-                logging.debug("Moving file: " + mkvoutfile + " to: " + mkvoutpath + f)
-                shutil.move(mkvoutfile, dest_dir)
+                logging.debug("Moving file: " + mkvoutfile + " to: " + dest_dir)
+                moves.append((mkvoutfile, dest_dir))
+            fileops.move_all(moves)
 
     def delete_raw(self, mkvoutpath):
         """
@@ -259,20 +452,13 @@ class Ripper(object):
         return value: None
         """
 
-        cmd = 'abcde -d "{0}" >> "{1}" 2>&1'.format(
-            disc.devpath,
-            logfile
-        )
+        cmd = ["abcde", "-d", disc.devpath]
 
-        logging.debug("Sending command: " + cmd)
         try:
-            subprocess.check_output(
-                cmd,
-                shell=True
-            ).decode("utf-8")
+            runner.run(cmd, logfile, runner.abcde_progress, runner.ProgressReporter(disc, "music"))
             logging.info("abcde call successful")
-        except subprocess.CalledProcessError as ab_error:
-            err = "Call to abcde failed with code: " + str(ab_error.returncode) + "(" + str(ab_error.output) + ")"
+        except (subprocess.CalledProcessError, OSError) as ab_error:
+            err = "Call to abcde failed: " + str(ab_error)
             logging.error(err)
             logging.info("Music rip failed.  See previous errors.  Exiting.")
             # sys.exit(err)
@@ -283,14 +469,14 @@ class Ripper(object):
 
     def rip_data(self, disc, datapath, logfile):
         """
-        Rip data disc using cat on the command line
+        Rip data disc to an iso image, with checksums calculated during the copy (see datacopy)
 
         Parameters:
         disc: disc object
         datapath: path to copy data to
         logfile: location of intended logfile
 
-        Return value: None
+        Return value: True if the disc was copied
         """
 
         if (disc.label) == "":
@@ -300,39 +486,54 @@ class Ripper(object):
 
         logging.info("Ripping data disc to: " + filename)
 
-        cmd = 'cat "{0}" > "{1}" 2>> {2}'.format(
-            disc.devpath,
-            filename,
-            logfile
-        )
-
-        logging.debug("Sending command: " + cmd)
-
+        hashes = [h.strip().lower() for h in str(cfg['DATA_HASH']).split(",") if h.strip().lower() not in ["", "none"]]
+        mapfile = filename + ".map"
+        progress = runner.ProgressReporter(disc, "data disc")
+        ripped = False
         try:
-            subprocess.check_output(
-                cmd,
-                shell=True
-            ).decode("utf-8")
+            if cfg['DATA_RESCUE'] and os.path.exists(mapfile):
+                # an earlier run of this job hit read errors
+                result = datacopy.rescue_image(disc.devpath, filename, mapfile, hashes, cfg['DATA_BLOCK_SIZE'],
+                                               cfg['DATA_RESCUE_RETRIES'], progress)
+            else:
+                try:
+                    result = datacopy.copy_image(disc.devpath, filename, hashes, cfg['DATA_BLOCK_SIZE'], progress)
+                except datacopy.ReadError as read_error:
+                    if not cfg['DATA_RESCUE']:
+                        raise
+                    logging.warning("Data disc has unreadable sectors (" + str(read_error) + ").  Continuing in rescue mode.")
+                    result = datacopy.rescue_image(disc.devpath, filename, mapfile, hashes, cfg['DATA_BLOCK_SIZE'],
+                                                   cfg['DATA_RESCUE_RETRIES'], progress, read_error.offset)
+            datacopy.write_hashes(filename, result['hashes'])
+            if result.get('bad'):
+                utils.notify("ARM notification", "Data disc: " + disc.label + " copied with " + str(result['bad'] // datacopy.SECTOR) +
+                             " unreadable sectors.  See " + mapfile)
+            else:
+                if os.path.exists(mapfile):
+                    os.remove(mapfile)
+                utils.notify("ARM notification", "Data disc: " + disc.label + " copying complete.")
             logging.info("Data rip call successful")
-            utils.notify("ARM notification", "Data disc: " + disc.label + " copying complete.")
-            return True
-        except subprocess.CalledProcessError as dd_error:
-            err = "Data rip failed with code: " + str(dd_error.returncode) + "(" + str(dd_error.output) + ")"
+            ripped = True
+        except (OSError, ValueError, datacopy.ReadError) as dd_error:
+            err = "Data rip failed: " + str(dd_error)
             logging.error(err)
             logging.info("Data rip failed.  See previous errors.  Exiting.")
 
         disc.eject()
+        return ripped
 
-    def set_permissions(self, dest_dir):
+    def set_permissions(self, disc, dest_dir):
         """
-        Set file to default permissions '777'
+        Set the configured permissions and owner on the files of the job
 
         Parameters:
+        disc: disc object.  Only files created since its job was created are changed.
         dest_dir: path of directory to change permissions of
 
         Return value: None
         """
 
-        if cfg['SET_MEDIA_PERMISSIONS']:
-            perm_result = utils.set_permissions(dest_dir)
+        if cfg['SET_MEDIA_PERMISSIONS'] or cfg['SET_MEDIA_OWNER']:
+            since = disc.job.created if disc.job is not None else None
+            perm_result = utils.set_permissions(dest_dir, since)
             logging.info("Permissions set successfully: " + str(perm_result))
@@ -0,0 +1,223 @@
+#!/usr/bin/python3
+
+import os
+import re
+import time
+import json
+import logging
+import selectors
+import subprocess
+import jobs
+
+# Longest partial line kept in memory.  Longer output without a line break is passed on in pieces.
+MAX_LINE = 65536
+
+HB_PROGRESS = re.compile(r'Encoding: task (\d+) of (\d+), ([\d.]+) %(?: \(([\d.]+) fps, avg ([\d.]+) fps, ETA (\d+)h(\d+)m(\d+)s\))?')
+ABCDE_PROGRESS = re.compile(r'(Grabbing|Encoding|Tagging) track (\d+)(?: of (\d+))?')
+
+
+def run(cmd, logfile=None, parser=None, on_event=None, on_line=None, check=True):
+    """
+    Run an external tool without a shell and stream its output line by line.
+    stdout and stderr are read as they are written, so memory use doesn't grow
+    with the amount of output.  Both are appended to the logfile unchanged.
+
+    Parameters:
+    cmd: list of program arguments
+    logfile: optional path of the logfile to append the output to
+    parser: optional function turning a line of output into a progress event dict (or None)
+    on_event: optional function called with each progress event
+    on_line: optional function called with (line, stream) for each line, stream is "stdout" or "stderr"
+    check: raise subprocess.CalledProcessError if the tool exits with a non-zero code
+
+    Return value: exit code of the tool
+    """
+    logging.debug("Sending command: %s", (" ".join(cmd)))
+
+    log = open(logfile, "ab") if logfile else None
+    try:
+        proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        if log:
+            log.close()
+        raise
+    sel = selectors.DefaultSelector()
+    completed = False
+    try:
+        sel.register(proc.stdout, selectors.EVENT_READ, "stdout")
+        sel.register(proc.stderr, selectors.EVENT_READ, "stderr")
+        partial = {"stdout": b"", "stderr": b""}
+
+        while sel.get_map():
+            for key, mask in sel.select():
+                stream = key.data
+                chunk = os.read(key.fd, 65536)
+                if not chunk:
+                    sel.unregister(key.fileobj)
+                    lines = [partial[stream]] if partial[stream] else []
+                    partial[stream] = b""
+                else:
+                    if log:
+                        log.write(chunk)
+                    # HandBrake ends its progress lines with a carriage return
+                    lines = re.split(b'[\r\n]', partial[stream] + chunk)
+                    partial[stream] = lines.pop()
+                    if len(partial[stream]) > MAX_LINE:
+                        lines.append(partial[stream])
+                        partial[stream] = b""
+
+                for line in lines:
+                    if not line:
+                        continue
+                    line = line.decode("utf-8", errors="ignore")
+                    if on_line:
+                        on_line(line, stream)
+                    if parser:
+                        event = parser(line)
+                        if event and on_event:
+                            on_event(event)
+        completed = True
+    finally:
+        sel.close()
+        # a callback raised: don't leave the tool running, or a zombie behind
+        if not completed and proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        proc.stdout.close()
+        proc.stderr.close()
+        if log:
+            log.close()
+
+    logging.debug("Exit code of " + cmd[0] + " is: " + str(proc.returncode))
+    if check and proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return proc.returncode
+
+
+def handbrake_progress(line):
+    """
+    Parse a HandBrake progress line such as
+    Encoding: task 1 of 1, 45.30 % (120.12 fps, avg 118.40 fps, ETA 00h12m30s)
+
+    Parameters:
+    line: line of HandBrake output
+
+    Return value: event dict with tool, task, tasks, percent, fps and eta (seconds) or None
+    """
+    result = HB_PROGRESS.search(line)
+    if not result:
+        return None
+    event = {
+        'tool': "handbrake",
+        'task': int(result.group(1)),
+        'tasks': int(result.group(2)),
+        'percent': float(result.group(3)),
+        'fps': None,
+        'eta': None,
+    }
+    if result.group(4):
+        event['fps'] = float(result.group(4))
+        event['eta'] = int(result.group(6)) * 3600 + int(result.group(7)) * 60 + int(result.group(8))
+    return event
+
+
+def makemkv_progress(line):
+    """
+    Parse MakeMKV robot mode progress messages
+    PRGC/PRGT:code,id,"name" - name of the current/total operation
+    PRGV:current,total,max - progress of the current and total operation
+
+    Parameters:
+    line: line of MakeMKV output
+
+    Return value: event dict with tool and either operation or percent/title_percent, or None
+    """
+    if line.startswith("PRGV:"):
+        try:
+            current, total, maximum = [int(v) for v in line[5:].split(",")]
+        except ValueError:
+            return None
+        if maximum <= 0:
+            return None
+        return {
+            'tool': "makemkv",
+            'percent': round(total * 100.0 / maximum, 1),
+            'title_percent': round(current * 100.0 / maximum, 1),
+        }
+    if line.startswith("PRGC:") or line.startswith("PRGT:"):
+        return {
+            'tool': "makemkv",
+            'operation': line[5:].split(",", 2)[-1].strip('"'),
+        }
+    return None
+
+
+def abcde_progress(line):
+    """
+    Parse abcde track markers such as "Grabbing track 03: ..." or "Encoding track 3 of 12: ..."
+
+    Parameters:
+    line: line of abcde output
+
+    Return value: event dict with tool, operation, track and tracks or None
+    """
+    result = ABCDE_PROGRESS.search(line)
+    if not result:
+        return None
+    return {
+        'tool': "abcde",
+        'operation': result.group(1).lower(),
+        'track': int(result.group(2)),
+        'tracks': int(result.group(3)) if result.group(3) else None,
+    }
+
+
+class ProgressReporter(object):
+    """
+    Receives progress events from run() and records the latest one in the
+    disc's job, so the web server and the job list can show it.  Events are
+    written at most once per interval and logged at debug level.
+
+    Methods:
+        __init__(self, disc, description, interval=10)
+        __call__(self, event)
+    """
+
+    def __init__(self, disc, description, interval=10):
+        """
+        Constructor
+
+        Parameters:
+        disc: disc object
+        description: what is running, e.g. "title 3"
+        interval: minimum seconds between recorded events
+
+        Return value: None
+        """
+        self.disc = disc
+        self.description = description
+        self.interval = interval
+        self.last = 0
+        self.operation = ""
+
+    def __call__(self, event):
+        """
+        Record a progress event
+
+        Parameters:
+        event: event dict from one of the progress parsers
+
+        Return value: None
+        """
+        if 'operation' in event:
+            self.operation = event['operation']
+        if 'percent' not in event and 'track' not in event or time.time() - self.last < self.interval:
+            return
+        self.last = time.time()
+
+        event = dict(event, description=self.description)
+        if self.operation:
+            event['operation'] = self.operation
+        logging.debug("Progress: " + json.dumps(event, sort_keys=True))
+        if self.disc is not None and self.disc.job is not None:
+            jobs.update(self.disc.job.job_id, progress=json.dumps(event, sort_keys=True))
@@ -0,0 +1,277 @@
+#!/usr/bin/python3
+
+import os
+import time
+import logging
+import db
+import utils
+
+from config import cfg
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS space_reservations (
+    job_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    dev INTEGER NOT NULL,
+    bytes INTEGER NOT NULL,
+    path TEXT,
+    until_stage TEXT NOT NULL,
+    created REAL,
+    PRIMARY KEY (job_id, kind)
+);
+"""
+
+GB = 1073741824
+
+# Directory each kind of reservation is made in, and the stage after which its space is no longer needed
+KINDS = {
+    'raw': ("RAWPATH", "transcoded"),
+    'output': ("MEDIA_DIR", "complete"),
+    'data': ("ARMPATH", "complete"),
+}
+
+
+class NoSpaceError(Exception):
+    """
+    Raised when a job can't get the space it needs within SPACE_WAIT_MINUTES
+    """
+
+
+def free_space(path):
+    """
+    Free space available to ARM on the file system of a path
+
+    Parameters:
+    path: path of a file or directory, which doesn't have to exist yet
+
+    Return value: free bytes
+    """
+    st = os.statvfs(existing_parent(path))
+    return st.f_bavail * st.f_frsize
+
+
+def device(path):
+    """
+    Identify the file system a path is on, so directories sharing a file system share its free space
+
+    Parameters:
+    path: path of a file or directory, which doesn't have to exist yet
+
+    Return value: device number
+    """
+    return os.stat(existing_parent(path)).st_dev
+
+
+def existing_parent(path):
+    """
+    Nearest directory of a path that exists
+
+    Parameters:
+    path: path
+
+    Return value: path of the path itself or its closest existing parent
+    """
+    path = os.path.abspath(path)
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return path
+
+
+def disc_size(disc):
+    """
+    Size of the disc in the drive
+
+    Parameters:
+    disc: disc object
+
+    Return value: size in bytes, 0 if it can't be read
+    """
+    try:
+        with open(disc.devpath, "rb") as dev:
+            return dev.seek(0, os.SEEK_END)
+    except OSError as size_error:
+        logging.debug("Could not get the size of " + disc.devpath + ": " + str(size_error))
+        return 0
+
+
+def estimate(disc, plan, mainfeature):
+    """
+    Estimate the space a job needs for its raw files and its output
+
+    Parameters:
+    disc: disc object
+    plan: MakeMKV title plan (see makemkv.get_plan), may be empty
+    mainfeature: True if only the main feature is processed
+
+    Return value: dict of reservation kind (see KINDS) to bytes
+    """
+    if disc.disctype == "data":
+        return {'data': disc_size(disc)}
+
+    titles = [t for t in plan if t.get('mainfeature')] if mainfeature else [t for t in plan if t.get('selected')]
+    if disc.disctype == "dvd" and mainfeature:
+        # HandBrake reads the main feature straight from the disc
+        raw = 0
+        source = sum(t['size'] for t in titles) or disc_size(disc)
+    elif titles and (cfg['RIPMETHOD'] == "mkv" or disc.disctype == "dvd" or mainfeature):
+        raw = sum(t['size'] for t in titles)
+        source = raw
+    else:
+        # a backup of the whole disc
+        raw = disc_size(disc) or sum(t['size'] for t in plan)
+        source = raw
+
+    ratio = 1.0 if cfg['SKIP_TRANSCODE'] else cfg['SPACE_ENCODE_RATIO']
+    return {'raw': raw, 'output': int(source * ratio)}
+
+
+def reserved(conn, job_id):
+    """
+    Space reserved by other unfinished jobs, less what they have already written
+
+    Parameters:
+    conn: database connection
+    job_id: job to leave out
+
+    Return value: dict of device number to bytes
+    """
+    totals = {}
+    rows = conn.execute("SELECT r.* FROM space_reservations r JOIN jobs j ON j.job_id = r.job_id "
+                        "WHERE j.status IN ('queued', 'running') AND r.job_id != ?", (job_id,)).fetchall()
+    for row in rows:
+        written = utils.dir_size(row['path']) if row['path'] and os.path.isdir(row['path']) else 0
+        totals[row['dev']] = totals.get(row['dev'], 0) + max(0, row['bytes'] - written)
+    return totals
+
+
+def reserve(job_id, needs):
+    """
+    Reserve space for a job if every file system it writes to has enough free
+    space left after the reservations of other jobs and SPACE_MARGIN_GB
+
+    Parameters:
+    job_id: id of the job
+    needs: dict of reservation kind (see KINDS) to bytes
+
+    Return value: tuple of True if the space was reserved and a list of messages about file systems that are too full
+    """
+    conn = db.connect(SCHEMA)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        others = reserved(conn, job_id)
+        wanted = {}
+        paths = {}
+        for kind, size in needs.items():
+            path = cfg[KINDS[kind][0]]
+            dev = device(path)
+            wanted[dev] = wanted.get(dev, 0) + size
+            paths.setdefault(dev, path)
+
+        short = []
+        margin = int(cfg['SPACE_MARGIN_GB'] * GB)
+        for dev, size in wanted.items():
+            available = free_space(paths[dev]) - others.get(dev, 0) - margin
+            if size > available:
+                short.append(paths[dev] + " needs " + str(round(size / float(GB), 1)) + " GB, " +
+                             str(round(max(available, 0) / float(GB), 1)) + " GB available")
+        if short:
+            conn.execute("ROLLBACK")
+            return False, short
+
+        now = time.time()
+        for kind, size in needs.items():
+            conn.execute("INSERT OR REPLACE INTO space_reservations (job_id, kind, dev, bytes, path, until_stage, created) "
+                         "VALUES (?, ?, ?, ?, NULL, ?, ?)", (job_id, kind, device(cfg[KINDS[kind][0]]), size, KINDS[kind][1], now))
+        conn.execute("COMMIT")
+        return True, []
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+def admit(disc, plan, mainfeature, downgrade=None):
+    """
+    Wait until there is space for a job before it starts writing.  If the job
+    doesn't fit it is downgraded to the main feature if that fits (when
+    downgrade is given and SPACE_DOWNGRADE is on), otherwise it waits for other
+    jobs to free their space for up to SPACE_WAIT_MINUTES.
+
+    Parameters:
+    disc: disc object, with its job
+    plan: MakeMKV title plan, may be empty
+    mainfeature: True if only the main feature is processed
+    downgrade: optional function returning the plan to use for a main feature only rip,
+               or None if the job can't be downgraded
+
+    Return value: True if only the main feature should be processed
+    Raises NoSpaceError if there isn't enough space in time
+    """
+    if not cfg['SPACE_CHECK'] or disc.job is None:
+        return mainfeature
+
+    needs = estimate(disc, plan, mainfeature)
+    logging.info("Estimated space needed: " + ", ".join(k + " " + str(round(v / float(GB), 1)) + " GB" for k, v in sorted(needs.items())))
+    deadline = time.time() + cfg['SPACE_WAIT_MINUTES'] * 60
+    notified = False
+    while True:
+        admitted, short = reserve(disc.job.job_id, needs)
+        if admitted:
+            return mainfeature
+
+        logging.warning("Not enough space for this job: " + "; ".join(short))
+        if not mainfeature and downgrade is not None and cfg['SPACE_DOWNGRADE']:
+            main_plan = downgrade()
+            if main_plan is not None:
+                main_needs = estimate(disc, main_plan, True)
+                if reserve(disc.job.job_id, main_needs)[0]:
+                    logging.warning("Only the main feature of " + str(disc.videotitle or disc.label) + " fits.  Ripping the main feature only")
+                    utils.notify("ARM notification", "Not enough space for all of " + str(disc.videotitle or disc.label) +
+                                 ".  Ripping the main feature only.")
+                    return True
+
+        if time.time() >= deadline:
+            raise NoSpaceError("Not enough space for " + str(disc.videotitle or disc.label) + ": " + "; ".join(short))
+        if not notified:
+            utils.notify("ARM notification", "Waiting for space to rip " + str(disc.videotitle or disc.label) + ": " + "; ".join(short))
+            notified = True
+        time.sleep(cfg['SPACE_RETRY_INTERVAL'])
+
+
+def track(disc, kind, path):
+    """
+    Record where a job writes the files of a reservation, so the space already
+    written isn't counted twice by other jobs
+
+    Parameters:
+    disc: disc object
+    kind: reservation kind (see KINDS)
+    path: directory the files are written to
+
+    Return value: None
+    """
+    if not cfg['SPACE_CHECK'] or disc.job is None:
+        return
+    conn = db.connect(SCHEMA)
+    conn.execute("UPDATE space_reservations SET path = ? WHERE job_id = ? AND kind = ?", (path, disc.job.job_id, kind))
+    conn.close()
+
+
+def release(job_id, stages=None):
+    """
+    Release the reservations of a job that are no longer needed
+
+    Parameters:
+    job_id: id of the job
+    stages: stages the job has completed, or None to release everything when the job finishes
+
+    Return value: None
+    """
+    conn = db.connect(SCHEMA)
+    if stages is None:
+        conn.execute("DELETE FROM space_reservations WHERE job_id = ?", (job_id,))
+    else:
+        conn.execute("DELETE FROM space_reservations WHERE job_id = ? AND until_stage IN (" + ", ".join("?" for s in stages) + ")",
+                     [job_id] + list(stages))
+    conn.close()
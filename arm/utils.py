@@ -5,58 +5,60 @@ import sys
 import time
 import logging
 import fcntl
+import stat
+import pwd
+import grp
 import subprocess
 import shutil
-import requests
+import fileops
+import notifier
+import emby
 
 from config import cfg
 
+# Connections kept open to each web service by the shared HTTP session
+HTTP_POOL_SIZE = 8
+
+_session = None
+
 
 def notify(title, body):
-    # Send notificaions
+    # Send notificaions in the background (see notifier)
     # title = title for notification
     # body = body of the notification
 
-    if cfg['PB_KEY'] != "":
-        try:
-            from pushbullet import Pushbullet
-            pb = Pushbullet(cfg['PB_KEY'])
-            pb.push_note(title, body)
-        except:  # noqa: E722
-            logging.error("Failed sending PushBullet notification.  Continueing processing...")
+    notifier.enqueue(title, body)
 
-    if cfg['IFTTT_KEY'] != "":
-        try:
-            import pyfttt as pyfttt
-            event = cfg['IFTTT_EVENT']
-            pyfttt.send_event(cfg['IFTTT_KEY'], event, title, body)
-        except:  # noqa: E722
-            logging.error("Failed sending IFTTT notification.  Continueing processing...")
 
-    if cfg['PO_USER_KEY'] != "":
-        try:
-            from pushover import init, Client
-            init(cfg['PO_APP_KEY'])
-            Client(cfg['PO_USER_KEY']).send_message(body, title=title)
-        except:  # noqa: E722
-            logging.error("Failed sending PushOver notification.  Continueing processing...")
+def http_session():
+    """
+    Get the HTTP session shared by the web service lookups.  Connections are
+    pooled, so concurrent and repeated requests to the same service reuse them.
 
+    Parameters:
+    None
 
-def scan_emby():
-    """Trigger a media scan on Emby"""
+    Return value: requests.Session
+    """
+    global _session
+    if _session is None:
+        # requests takes longer to import than the rest of ARM; only load it once a web service is called
+        import requests
+        _session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+        _session.mount("http://", adapter)
+        _session.mount("https://", adapter)
+    return _session
 
-    if cfg['EMBY_REFRESH']:
-        logging.info("Sending Emby library scan request")
-        url = "http://" + cfg['EMBY_SERVER'] + ":" + cfg['EMBY_PORT'] + "/Library/Refresh?api_key=" + cfg['EMBY_API_KEY']
-        try:
-            req = requests.post(url)
-            if req.status_code > 299:
-                req.raise_for_status()
-            logging.info("Emby Library Scan request successful")
-        except requests.exceptions.HTTPError:
-            logging.error("Emby Library Scan request failed with status code: " + str(req.status_code))
-    else:
-        logging.info("EMBY_REFRESH config parameter is false.  Skipping emby scan.")
+
+def scan_emby(paths=None):
+    """Trigger a media scan on Emby for the files written (see emby.queue)
+    paths = list of new files, or None to scan the whole library"""
+
+    try:
+        emby.queue(paths)
+    except Exception as emby_error:
+        logging.error("Could not queue Emby library scan: " + str(emby_error))
 
 
 def move_files(basepath, filename, hasnicetitle, videotitle, ismainfeature=False):
@@ -64,7 +66,32 @@ def move_files(basepath, filename, hasnicetitle, videotitle, ismainfeature=False
     basepath = path to source directory
     filename = name of file to be moved
     hasnicetitle = hasnicetitle value
-    ismainfeature = True/False"""
+    ismainfeature = True/False
+    returns the path the file was moved to, or None"""
+
+    target = move_target(basepath, filename, hasnicetitle, videotitle, ismainfeature)
+    if target is None:
+        return None
+    try:
+        fileops.move(os.path.join(basepath, filename), target)
+    except (OSError, shutil.Error) as move_error:
+        logging.error("Unable to move '" + filename + "' to " + os.path.dirname(target) + ": " + str(move_error))
+        return None
+    return target
+
+def move_target(basepath, filename, hasnicetitle, videotitle, ismainfeature=False):
+    """
+    Work out where move_files puts a file, creating the directories for it
+
+    Parameters:
+    basepath: path to source directory
+    filename: name of file to be moved
+    hasnicetitle: hasnicetitle value
+    videotitle: name of the title directory
+    ismainfeature: True if the file is the main feature, False for extras
+
+    Return value: destination path, or None if the file isn't moved
+    """
 
     logging.debug("Arguments: " + basepath + " : " + filename + " : " + str(hasnicetitle) + " : " + videotitle + " : " + str(ismainfeature))
 
@@ -73,39 +100,67 @@ def move_files(basepath, filename, hasnicetitle, videotitle, ismainfeature=False
 
         if not os.path.exists(m_path):
             logging.info("Creating base title directory: " + m_path)
-            os.makedirs(m_path)
+            os.makedirs(m_path, exist_ok=True)
 
         if ismainfeature is True:
             logging.info("Track is the Main Title.  Moving '" + filename + "' to " + m_path)
 
             m_file = os.path.join(m_path, videotitle + "." + cfg['DEST_EXT'])
             if not os.path.isfile(m_file):
-                try:
-                    shutil.move(os.path.join(basepath, filename), m_file)
-                except shutil.Error:
-                    logging.error("Unable to move '" + filename + "' to " + m_path)
-            else:
-                logging.info("File: " + m_file + " already exists.  Not moving.")
+                return m_file
+            logging.info("File: " + m_file + " already exists.  Not moving.")
         else:
             e_path = os.path.join(m_path, cfg['EXTRAS_SUB'])
 
             if not os.path.exists(e_path):
                 logging.info("Creating extras directory " + e_path)
-                os.makedirs(e_path)
+                os.makedirs(e_path, exist_ok=True)
 
             logging.info("Moving '" + filename + "' to " + e_path)
 
             e_file = os.path.join(e_path, videotitle + "." + cfg['DEST_EXT'])
             if not os.path.isfile(e_file):
-                try:
-                    shutil.move(os.path.join(basepath, filename), os.path.join(e_path, filename))
-                except shutil.Error:
-                    logging.error("Unable to move '" + filename + "' to " + e_path)
-            else:
-                logging.info("File: " + e_file + " already exists.  Not moving.")
+                return os.path.join(e_path, filename)
+            logging.info("File: " + e_file + " already exists.  Not moving.")
 
     else:
         logging.info("hasnicetitle is false.  Not moving files.")
+    return None
+
+def output_name(disc):
+    """
+    Name of the directories for the files of a video disc: its title and year,
+    or a name made from the job id and disc label while the title is still
+    being looked up
+
+    Parameters:
+    disc: disc object
+
+    Return value: directory name
+    """
+    if disc.videotitle:
+        return disc.videotitle + " (" + disc.videoyear + ")"
+    job_id = disc.job.job_id if disc.job is not None else os.getpid()
+    return "job_" + str(job_id) + "_" + (disc.label or disc.disctype)
+
+def dir_size(path):
+    """
+    Total size of the files in a directory tree
+
+    Parameters:
+    path: path of the directory
+
+    Return value: size in bytes
+    """
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for f in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, f))
+            except OSError:
+                # removed in the meantime
+                pass
+    return total
 
 def make_dir(path):
     """
@@ -170,21 +225,123 @@ def find_file(filename, search_path):
             return True
     return False
 
-def set_permissions(directory_to_traverse):
-    try:
-        corrected_chmod_value = int(str(cfg['CHMOD_VALUE']), 8)
-        logging.info("Setting permissions to: " + str(cfg['CHMOD_VALUE']) + " on: " + directory_to_traverse)
-        os.chmod(directory_to_traverse, corrected_chmod_value)
-
-        for dirpath, l_directories, l_files in os.walk(directory_to_traverse):
-            for cur_dir in l_directories:
-                logging.debug("Setting path: " + cur_dir + " to permissions value: " + str(cfg['CHMOD_VALUE']))
-                os.chmod(os.path.join(dirpath, cur_dir), corrected_chmod_value)
-            for cur_file in l_files:
-                logging.debug("Setting file: " + cur_file + " to permissions value: " + str(cfg['CHMOD_VALUE']))
-                os.chmod(os.path.join(dirpath, cur_file), corrected_chmod_value)
+def set_permissions(directory_to_traverse, since=None):
+    """
+    Set the mode (SET_MEDIA_PERMISSIONS, CHMOD_VALUE) and owner (SET_MEDIA_OWNER,
+    CHOWN_USER, CHOWN_GROUP) of a directory tree in a single pass
+
+    Parameters:
+    directory_to_traverse: path of the directory
+    since: optional time in seconds since the epoch.  Only entries created or changed
+           since then are updated, e.g. the files written by a job.
+
+    Return value: True if every entry could be updated, False otherwise
+    """
+    mode = cfg['CHMOD_VALUE'] if cfg['SET_MEDIA_PERMISSIONS'] else None
+    uid = gid = -1
+    if cfg['SET_MEDIA_OWNER']:
+        try:
+            uid = owner_id(cfg['CHOWN_USER'], pwd.getpwnam)
+            gid = owner_id(cfg['CHOWN_GROUP'], grp.getgrnam)
+        except KeyError as owner_error:
+            logging.error("Unknown owner for media files: " + str(owner_error))
+            uid = gid = -1
+    if mode is None and uid == -1 and gid == -1:
         return True
-    except Exception as e:
-        err = "Permissions setting failed as: " + str(e)
-        logging.error(err)
-        return False
+
+    logging.info("Setting permissions to: " + (format(mode, "o") if mode is not None else "unchanged") +
+                 ", owner to: " + str(cfg['CHOWN_USER'] if uid != -1 else "unchanged") + ":" + str(cfg['CHOWN_GROUP'] if gid != -1 else "unchanged") +
+                 " on: " + directory_to_traverse + (" (files of this job only)" if since else ""))
+    counts = apply_permissions(directory_to_traverse, mode, uid, gid, since)
+    logging.info("Permissions: " + str(counts['checked']) + " entries checked, " + str(counts['chmod']) + " chmod, " +
+                 str(counts['chown']) + " chown, " + str(counts['unchanged']) + " already set, " + str(counts['old']) +
+                 " older than the job, " + str(counts['errors']) + " errors")
+    if counts['errors']:
+        logging.error("Permissions setting failed as: " + counts['first_error'])
+    return not counts['errors']
+
+def owner_id(name, lookup):
+    """
+    Turn a user or group name from the config into an id
+
+    Parameters:
+    name: user or group name or number, empty to leave it unchanged
+    lookup: pwd.getpwnam or grp.getgrnam
+
+    Return value: id, or -1 to leave it unchanged
+    """
+    if name is None or str(name).strip() == "":
+        return -1
+    if str(name).isdigit():
+        return int(name)
+    return lookup(str(name))[2]
+
+def apply_permissions(path, mode, uid, gid, since=None):
+    """
+    Walk a directory tree with os.scandir, changing the mode and owner of each
+    entry that doesn't have them yet.  Symlinks are left alone.  With since,
+    files that weren't created or changed since then are skipped.  Directories
+    are always checked and walked, as a new file can be added to an old
+    directory, e.g. the extras directory of a title ripped before.
+
+    Parameters:
+    path: path of the directory
+    mode: permission bits, or None to leave them unchanged
+    uid: user id, or -1 to leave it unchanged
+    gid: group id, or -1 to leave it unchanged
+    since: optional time in seconds since the epoch
+
+    Return value: dict with the number of entries checked, chmod, chown, unchanged, old and errors, and the first_error
+    """
+    counts = {'checked': 0, 'chmod': 0, 'chown': 0, 'unchanged': 0, 'old': 0, 'errors': 0, 'first_error': ""}
+
+    def update(entry_path, st):
+        counts['checked'] += 1
+        if since is not None and not stat.S_ISDIR(st.st_mode) and max(st.st_mtime, st.st_ctime) < since:
+            counts['old'] += 1
+            return
+        changed = False
+        try:
+            if uid != -1 and st.st_uid != uid or gid != -1 and st.st_gid != gid:
+                os.chown(entry_path, uid, gid)
+                counts['chown'] += 1
+                changed = True
+            if mode is not None and stat.S_IMODE(st.st_mode) != mode:
+                os.chmod(entry_path, mode)
+                counts['chmod'] += 1
+                changed = True
+        except OSError as perm_error:
+            counts['errors'] += 1
+            counts['first_error'] = counts['first_error'] or str(perm_error)
+            return
+        if not changed:
+            counts['unchanged'] += 1
+
+    try:
+        update(path, os.stat(path))
+    except OSError as perm_error:
+        counts['errors'] += 1
+        counts['first_error'] = str(perm_error)
+        return counts
+
+    stack = [path]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except OSError as perm_error:
+            counts['errors'] += 1
+            counts['first_error'] = counts['first_error'] or str(perm_error)
+            continue
+        for entry in entries:
+            try:
+                if entry.is_symlink():
+                    continue
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                # removed in the meantime
+                continue
+            update(entry.path, st)
+            if stat.S_ISDIR(st.st_mode):
+                stack.append(entry.path)
+    return counts
@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+
+import sys
+import os
+import argparse
+import logging
+import subprocess
+import logger
+import jobs
+import drives
+import notifier
+import emby
+import config
+
+from config import cfg
+
+
+def entry():
+    """ Entry to program, parses arguments"""
+    parser = argparse.ArgumentParser(description='ARM job queue')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('run', help='Run the worker that processes queued jobs')
+    add = subparsers.add_parser('add', help='Queue a job for a drive')
+    add.add_argument('devpath', help='Devpath')
+    subparsers.add_parser('list', help='List recent jobs')
+    subparsers.add_parser('drives-changed', help='Forget the cached MakeMKV drive numbers after a drive was added or removed')
+
+    return parser.parse_args()
+
+
+def run():
+    """
+    Process queued jobs, starting at most MAX_CONCURRENT_JOBS at a time.  Each job
+    runs main.py in its own process.  Jobs interrupted by a crash or reboot are
+    requeued and resume at their last completed stage; so are jobs that were
+    still running when the worker started, once their process is gone.  Discs
+    inserted while the worker runs are queued by its drive monitor (see
+    drives.DriveMonitor).
+    Changes to the config file are applied between polls.
+
+    Parameters:
+    None
+
+    Return value: None
+    """
+    logging.info("Starting ARM worker with " + str(cfg['MAX_CONCURRENT_JOBS']) + " concurrent job(s)")
+
+    mainpy = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    monitor = drives.DriveMonitor()
+    running = {}
+    while True:
+        # pick up changes to arm.yaml; jobs started from now on read the new file themselves
+        config.reload()
+
+        # reap finished jobs
+        for job_id, proc in list(running.items()):
+            if proc.poll() is None:
+                continue
+            del running[job_id]
+            job = jobs.get(job_id)
+            if job.status == "running":
+                logging.error("Job " + str(job_id) + " exited with code " + str(proc.returncode) + " before finishing")
+                job.finish("failed")
+            else:
+                logging.info("Job " + str(job_id) + " finished with status " + job.status)
+
+        # requeue jobs interrupted by a crash or reboot, and those left by an earlier worker once they exit
+        jobs.recover(cfg['MAX_JOB_ATTEMPTS'], running)
+
+        # start new jobs
+        while len(running) < cfg['MAX_CONCURRENT_JOBS']:
+            job = jobs.claim(cfg['MAX_CONCURRENT_JOBS'])
+            if job is None:
+                break
+            logging.info("Starting job " + str(job.job_id) + " for " + job.devpath + " at stage " + job.stage)
+            proc = subprocess.Popen([sys.executable, mainpy, "-d", job.devpath, "-j", str(job.job_id)])
+            jobs.update(job.job_id, pid=proc.pid)
+            running[job.job_id] = proc
+
+        # send notifications queued by the jobs, merging those of drives finishing together
+        notifier.dispatch(cfg['NOTIFY_COALESCE_SECONDS'])
+
+        # tell Emby about new files once the jobs finishing close together are all done
+        emby.dispatch(cfg['EMBY_DEBOUNCE_SECONDS'])
+
+        # wait for the next poll, or start a job as soon as a disc is inserted
+        monitor.wait(cfg['WORKER_POLL_INTERVAL'])
+
+
+def list_jobs():
+    """
+    Print recent jobs with the peak space their raw files used in RAWPATH
+
+    Parameters:
+    None
+
+    Return value: None
+    """
+    for job in jobs.list_jobs():
+        print("{0:>6}  {1:<10} {2:<8} {3:<11} {4:>8}  {5}".format(
+            job.job_id, job.devpath, job.status, job.stage,
+            str(round(job.peak_scratch / 1073741824.0, 1)) + "G" if job.peak_scratch else "-",
+            job.disc.get('videotitle', job.disc.get('label', ""))))
+
+
+if __name__ == "__main__":
+    args = entry()
+
+    if args.command == "add":
+        logger.logger("arm_worker.log")
+        jobs.enqueue(args.devpath)
+    elif args.command == "list":
+        list_jobs()
+    elif args.command == "drives-changed":
+        logger.logger("arm_worker.log")
+        import makemkv
+        makemkv.invalidate_drive_cache()
+    else:
+        logger.logger("arm_worker.log")
+        try:
+            run()
+        except Exception:
+            logging.exception("The ARM worker has crashed.  See traceback below for details.")
+            raise
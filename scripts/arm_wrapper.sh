@@ -2,5 +2,30 @@
 
 DEVNAME=$1
 
-echo "Starting ARM on ${DEVNAME}" | logger -t ARM
-/bin/su -l -c "echo /usr/bin/python3 /opt/arm/arm/main.py -d ${DEVNAME} | at now" -s /bin/bash arm
+# Socket of the ARM worker, read from ARM_SOCKET in arm.yaml.  An empty value disables the socket.
+CONFIG="${ARM_CONFIG:-/etc/arm/arm.yaml}"
+SOCKET=/run/arm/arm.sock
+if grep -q '^ARM_SOCKET:' "${CONFIG}" 2>/dev/null; then
+    SOCKET=$(sed -n "s/^ARM_SOCKET:[[:space:]]*[\"']\{0,1\}\([^\"'#]*\).*/\1/p" "${CONFIG}" | tail -n 1 | sed 's/[[:space:]]*$//')
+fi
+
+# Hand the event to the running worker, which keeps track of the drive's tray and queues a job for a new disc.
+# python3 -S only loads the socket module, so this takes milliseconds.
+if [ -n "${SOCKET}" ] && [ -S "${SOCKET}" ] && /usr/bin/python3 -S -c '
+import sys, socket
+s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+s.sendto((sys.argv[2] + " " + sys.argv[3]).encode(), sys.argv[1])
+' "${SOCKET}" "${ACTION:-change}" "${DEVNAME}" 2>/dev/null; then
+    exit 0
+fi
+
+# The worker isn't running; queue the job in the database for when it starts.
+# udev sets ACTION.  Drives being added or removed change MakeMKV's disc numbers.
+if [ "${ACTION}" = "add" ] || [ "${ACTION}" = "remove" ]; then
+    echo "Optical drive ${DEVNAME} ${ACTION}, forgetting MakeMKV drive numbers" | logger -t ARM
+    /bin/su -l -c "/usr/bin/python3 /opt/arm/arm/worker.py drives-changed" -s /bin/bash arm
+    exit 0
+fi
+
+echo "Queueing ARM job for ${DEVNAME}" | logger -t ARM
+/bin/su -l -c "/usr/bin/python3 /opt/arm/arm/worker.py add ${DEVNAME}" -s /bin/bash arm
@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+"""
+Benchmark a single HandBrake encode of a title against the chapter-split
+parallel encode used when HB_CHAPTER_SPLIT is enabled.
+
+Uses HANDBRAKE_CLI, the HandBrake presets/arguments, HB_CONCURRENT_JOBS and
+HB_THREADS_PER_JOB from /etc/arm/arm.yaml.
+
+Usage::
+    python3 scripts/bench_chapter_split.py -i /path/to/backup -t 1 [-d bluray] [-o /tmp/arm_bench]
+"""
+
+import os
+import sys
+import time
+import shlex
+import argparse
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "arm"))
+
+import handbrake  # noqa: E402
+
+from config import cfg  # noqa: E402
+
+
+class BenchDisc(object):
+    """Minimal stand-in for classes.Disc without udev or a job"""
+
+    def __init__(self, disctype):
+        self.disctype = disctype
+        self.titles = {}
+        self.errors = []
+        self.job = None
+
+
+def entry():
+    """ Entry to program, parses arguments"""
+    parser = argparse.ArgumentParser(description='Benchmark chapter-split encoding against a single HandBrake encode')
+    parser.add_argument('-i', '--input', help='Source for HandBrake (disc backup or file)', required=True)
+    parser.add_argument('-t', '--title', help='Title to encode', type=int, required=True)
+    parser.add_argument('-d', '--disctype', help='dvd or bluray, selects the HandBrake preset', default="bluray")
+    parser.add_argument('-o', '--output', help='Directory for the encoded files', default="/tmp/arm_bench")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = entry()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+    logfile = os.path.join(args.output, "bench.log")
+    disc = BenchDisc(args.disctype)
+
+    if args.disctype == "dvd":
+        hb_args = cfg['HB_ARGS_DVD']
+        hb_preset = cfg['HB_PRESET_DVD']
+    else:
+        hb_args = cfg['HB_ARGS_BD']
+        hb_preset = cfg['HB_PRESET_BD']
+
+    titles = handbrake.scan_titles(args.input, disc)
+    if args.title not in titles:
+        sys.exit("Title " + str(args.title) + " not found on " + args.input)
+    title = titles[args.title]
+    print("Title " + str(args.title) + ": " + str(title['duration']) + " seconds, " + str(len(title['chapters'])) + " chapters")
+
+    single = os.path.join(args.output, "single." + cfg['DEST_EXT'])
+    cmd = ["nice", cfg['HANDBRAKE_CLI'], "-i", args.input, "-o", single, "--preset", hb_preset,
+           "-t", str(args.title)] + shlex.split(hb_args)
+    start = time.time()
+    if not handbrake.run_handbrake("single encode", cmd, logfile, disc):
+        sys.exit("Single encode failed.  See " + logfile)
+    single_time = time.time() - start
+
+    split = os.path.join(args.output, "split." + cfg['DEST_EXT'])
+    start = time.time()
+    if not handbrake.encode_split(args.input, title, split, hb_preset, hb_args, logfile, disc):
+        sys.exit("Split encode failed.  See " + logfile)
+    split_time = time.time() - start
+
+    print("Single encode:  {0:8.1f} s  ({1:.2f}x realtime)".format(single_time, title['duration'] / single_time))
+    print("Split encode:   {0:8.1f} s  ({1:.2f}x realtime, {2} segments)".format(
+        split_time, title['duration'] / split_time, len(handbrake.split_chapters(title['chapters'], cfg['HB_CONCURRENT_JOBS']))))
+    print("Speedup:        {0:8.2f}x".format(single_time / split_time))
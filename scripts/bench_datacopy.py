@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+"""
+Benchmark copying data discs with datacopy against cat, which rip_data used
+before.
+
+Each image (or device, e.g. a loop device made with "losetup -f --show
+image.iso") is copied with cat, with cat followed by sha256sum (what it takes
+to get a checksum with cat), and with datacopy with and without checksums.
+Without images a file backed image of --size MB of random data is made in the
+output directory.  Run with --drop-caches to measure cold reads, which is what
+matters for an optical drive.
+
+Usage::
+    sudo python3 scripts/bench_datacopy.py [-n 3] [--drop-caches] [-o /tmp] [image.iso ...]
+"""
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "arm"))
+
+import datacopy  # noqa: E402
+
+
+def entry():
+    """ Entry to program, parses arguments"""
+    parser = argparse.ArgumentParser(description='Benchmark datacopy against cat')
+    parser.add_argument('images', help='Disc images or devices', nargs='*')
+    parser.add_argument('-n', '--runs', help='Runs per image', type=int, default=3)
+    parser.add_argument('-o', '--output', help='Directory to copy to', default=tempfile.gettempdir())
+    parser.add_argument('--size', help='Size in MB of the generated image', type=int, default=1024)
+    parser.add_argument('--blocksize', help='datacopy block size in bytes', type=int, default=4194304)
+    parser.add_argument('--drop-caches', help='Drop the page cache before each run (needs root)', action='store_true')
+
+    return parser.parse_args()
+
+
+def drop_caches():
+    """ Drop the page cache so every run reads from the device """
+    subprocess.call(["sync"])
+    with open("/proc/sys/vm/drop_caches", "w") as f:
+        f.write("3\n")
+
+
+def make_image(directory, size):
+    """ Write a file backed image of size MB of random data; returns its path """
+    fd, path = tempfile.mkstemp(prefix="arm_bench_", suffix=".iso", dir=directory)
+    with os.fdopen(fd, "wb") as f:
+        for i in range(size):
+            f.write(os.urandom(1048576))
+    return path
+
+
+def with_cat(image, dest):
+    """ Copy with cat, as rip_data did """
+    with open(dest, "wb") as out:
+        subprocess.check_call(["cat", image], stdout=out)
+    # rip_data closes the file, datacopy syncs it; compare the same amount of work
+    subprocess.call(["sync", dest])
+
+
+def with_cat_sha256(image, dest):
+    """ Copy with cat, then read the copy again for a checksum """
+    with_cat(image, dest)
+    subprocess.check_call(["sha256sum", dest], stdout=subprocess.DEVNULL)
+
+
+def with_datacopy(image, dest, hashes, blocksize):
+    """ Copy with datacopy """
+    datacopy.copy_image(image, dest, hashes, blocksize)
+
+
+def timed(func, runs, cold, *args):
+    """ Run func runs times; returns the median time """
+    times = []
+    for i in range(runs):
+        if cold:
+            drop_caches()
+        start = time.time()
+        func(*args)
+        times.append(time.time() - start)
+    return sorted(times)[len(times) // 2]
+
+
+if __name__ == "__main__":
+    args = entry()
+    images = args.images
+    generated = None
+    if not images:
+        generated = make_image(args.output, args.size)
+        images = [generated]
+    dest = os.path.join(args.output, "arm_bench_copy.iso")
+
+    print("{0:<32} {1:>10} {2:>12} {3:>12}".format("image / method", "seconds", "MB/s", "vs cat"))
+    for image in images:
+        with open(image, "rb") as f:
+            size = f.seek(0, os.SEEK_END)
+        print(os.path.basename(image)[:32] + " (" + datacopy.megabytes(size) + " MB)")
+        methods = [
+            ("cat", with_cat, []),
+            ("cat + sha256sum", with_cat_sha256, []),
+            ("datacopy", with_datacopy, [None, args.blocksize]),
+            ("datacopy sha256", with_datacopy, [["sha256"], args.blocksize]),
+            ("datacopy sha256+md5", with_datacopy, [["sha256", "md5"], args.blocksize]),
+        ]
+        baseline = None
+        for name, func, extra in methods:
+            seconds = timed(func, args.runs, args.drop_caches, image, dest, *extra)
+            baseline = baseline or seconds
+            print("  {0:<30} {1:10.2f} {2:>12} {3:11.2f}x".format(
+                name, seconds, datacopy.megabytes(size / seconds), baseline / seconds))
+        os.remove(dest)
+
+    if generated:
+        os.remove(generated)
@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+"""
+Benchmark identifying discs by reading their file system directly (discfs)
+against mounting them and checking for VIDEO_TS/BDMV/HVDVD_TS, as identify
+did before.
+
+Each image (or device) is identified both ways: the top level layout is read
+and bdmt_eng.xml or the VIDEO_TS.IFO header is read where present.  The mount
+path needs root for the loop mount.  Run with --drop-caches to measure cold
+reads, which is what matters for an optical drive.
+
+Usage::
+    sudo python3 scripts/bench_discfs.py [-n 5] [--drop-caches] image.iso [image2.iso ...]
+"""
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "arm"))
+
+import discfs  # noqa: E402
+
+SMALL_FILES = ["BDMV/META/DL/bdmt_eng.xml", "VIDEO_TS/VIDEO_TS.IFO"]
+
+
+def entry():
+    """ Entry to program, parses arguments"""
+    parser = argparse.ArgumentParser(description='Benchmark discfs against mounting discs')
+    parser.add_argument('images', help='Disc images or devices', nargs='+')
+    parser.add_argument('-n', '--runs', help='Runs per image', type=int, default=5)
+    parser.add_argument('--drop-caches', help='Drop the page cache before each run (needs root)', action='store_true')
+    parser.add_argument('--no-mount', help='Only time discfs', action='store_true')
+
+    return parser.parse_args()
+
+
+def drop_caches():
+    """ Drop the page cache so every run reads from the device """
+    subprocess.call(["sync"])
+    with open("/proc/sys/vm/drop_caches", "w") as f:
+        f.write("3\n")
+
+
+def with_discfs(image):
+    """ Identify an image with discfs; returns the names of the top level directories """
+    with discfs.DiscFS(image) as fs:
+        dirs = [e.name.upper() for e in fs.listdir("/") if e.is_dir]
+        for name in SMALL_FILES:
+            if name.split("/")[0] in dirs:
+                fs.read(name, 65536)
+    return sorted(dirs)
+
+
+def with_mount(image, mountpoint):
+    """ Identify an image by mounting it; returns the names of the top level directories """
+    subprocess.check_call(["mount", "-o", "loop,ro", image, mountpoint], stderr=subprocess.DEVNULL)
+    try:
+        dirs = [d.upper() for d in os.listdir(mountpoint) if os.path.isdir(os.path.join(mountpoint, d))]
+        if not any(d in dirs for d in ["VIDEO_TS", "BDMV", "HVDVD_TS"]):
+            # identify walked the whole disc looking for HVDVD_TS
+            for dirpath, dirnames, filenames in os.walk(mountpoint):
+                pass
+        for name in SMALL_FILES:
+            path = os.path.join(mountpoint, name)
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    f.read(65536)
+    finally:
+        subprocess.call(["umount", mountpoint])
+    return sorted(dirs)
+
+
+def timed(func, runs, cold, *args):
+    """ Run func runs times; returns the result and the median time """
+    times = []
+    result = None
+    for i in range(runs):
+        if cold:
+            drop_caches()
+        start = time.time()
+        result = func(*args)
+        times.append(time.time() - start)
+    return result, sorted(times)[len(times) // 2]
+
+
+if __name__ == "__main__":
+    args = entry()
+    mountpoint = tempfile.mkdtemp(prefix="arm_bench_")
+
+    print("{0:<40} {1:>12} {2:>12} {3:>9}".format("image", "discfs (ms)", "mount (ms)", "speedup"))
+    for image in args.images:
+        layout, fs_time = timed(with_discfs, args.runs, args.drop_caches, image)
+        mount_time = None
+        if not args.no_mount:
+            try:
+                mounted_layout, mount_time = timed(with_mount, args.runs, args.drop_caches, image, mountpoint)
+                if mounted_layout != layout:
+                    print("  layouts differ: discfs " + str(layout) + ", mount " + str(mounted_layout))
+            except (subprocess.CalledProcessError, OSError) as mount_error:
+                print("  mount failed (" + str(mount_error) + "), only timing discfs")
+        print("{0:<40} {1:12.2f} {2:>12} {3:>9}".format(
+            os.path.basename(image)[:40], fs_time * 1000,
+            "{0:.2f}".format(mount_time * 1000) if mount_time is not None else "-",
+            "{0:.1f}x".format(mount_time / fs_time) if mount_time is not None else "-"))
+
+    os.rmdir(mountpoint)
@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+"""
+Benchmark the startup of a job process: the time python takes to start and
+import arm/main.py, measured with "python3 -X importtime".
+
+Each run starts a fresh interpreter that imports main (without running it),
+as the worker does for every job before main.py can even check whether the
+drive is empty.  The median wall time is compared with an interpreter that
+imports nothing, and the modules that take longest to import are listed.  Run
+with --drop-caches to measure a cold start after the page cache is dropped.
+
+The benchmark fails (exit code 1) if importing main takes longer than
+--max-ms, or if main loads one of the modules that are only imported by the
+stages that need them (LAZY), so startup regressions are caught.
+
+Usage::
+    python3 scripts/bench_startup.py [-n 10] [--max-ms 150] [--config /etc/arm/arm.yaml] [--drop-caches]
+"""
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+ARMDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "arm")
+
+# Modules main.py must not import at startup; they are imported by the stages that use them
+LAZY = ["requests", "xmltodict", "pydvdid", "robobrowser", "pyudev", "identify", "ripper", "getkeys"]
+
+
+def entry():
+    """ Entry to program, parses arguments"""
+    parser = argparse.ArgumentParser(description='Benchmark the startup time of arm/main.py')
+    parser.add_argument('-n', '--runs', help='Number of runs', type=int, default=10)
+    parser.add_argument('--module', help='Module to import', default="main")
+    parser.add_argument('--config', help='ARM config file (ARM_CONFIG)', default=os.environ.get("ARM_CONFIG", "/etc/arm/arm.yaml"))
+    parser.add_argument('--max-ms', help='Fail if importing the module takes longer than this many ms (median)', type=float, default=150)
+    parser.add_argument('--top', help='Number of slowest imports to list', type=int, default=10)
+    parser.add_argument('--drop-caches', help='Drop the page cache before each run (needs root)', action='store_true')
+
+    return parser.parse_args()
+
+
+def drop_caches():
+    """ Drop the page cache so every run reads python and ARM from disk """
+    subprocess.call(["sync"])
+    with open("/proc/sys/vm/drop_caches", "w") as f:
+        f.write("3\n")
+
+
+def parse_importtime(output, module):
+    """
+    Parse the -X importtime report for the imports done by a module
+
+    Parameters:
+    output: stderr of the interpreter
+    module: name of the top level module
+
+    Return value: tuple of the cumulative import time of module in microseconds and a
+                  list of (self us, cumulative us, name) tuples of the modules it imported
+    """
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        name = name.strip()
+        if depth == 0 and name != module:
+            # a top level import that came before the module, e.g. by site
+            imports = []
+            continue
+        if depth == 0:
+            return int(cumulative), imports
+        imports.append((int(own), int(cumulative), name))
+    raise ValueError(module + " not found in the -X importtime output")
+
+
+def run(code, env, cold):
+    """ Start an interpreter running code; returns its wall time and stderr """
+    if cold:
+        drop_caches()
+    start = time.time()
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=ARMDIR, env=env,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    seconds = time.time() - start
+    if proc.returncode != 0:
+        sys.exit("Importing failed:\n" + proc.stderr)
+    return seconds, proc.stderr
+
+
+def median(values):
+    """ Median of a list """
+    return sorted(values)[len(values) // 2]
+
+
+if __name__ == "__main__":
+    args = entry()
+    env = dict(os.environ, ARM_CONFIG=args.config, PYTHONPATH=ARMDIR)
+
+    bare = []
+    wall = []
+    imported = []
+    report = None
+    for i in range(args.runs):
+        bare.append(run("pass", env, args.drop_caches)[0])
+        seconds, output = run("import " + args.module, env, args.drop_caches)
+        wall.append(seconds)
+        cumulative, report = parse_importtime(output, args.module)
+        imported.append(cumulative)
+
+    import_ms = median(imported) / 1000.0
+    print("{0:<40} {1:>10}".format("", "ms"))
+    print("{0:<40} {1:10.1f}".format("python startup (import nothing)", median(bare) * 1000))
+    print("{0:<40} {1:10.1f}".format("python startup + import " + args.module, median(wall) * 1000))
+    print("{0:<40} {1:10.1f}".format("import " + args.module + " (-X importtime)", import_ms))
+    print()
+    print("Slowest imports of the last run ({0} modules):".format(len(report)))
+    for own, cumulative, name in sorted(report, key=lambda r: r[0], reverse=True)[:args.top]:
+        print("  {0:<38} {1:10.1f} self {2:10.1f} cumulative".format(name, own / 1000.0, cumulative / 1000.0))
+
+    failed = False
+    loaded = sorted(set(name for own, cumulative, name in report if name.split(".")[0] in LAZY))
+    if loaded:
+        print("FAIL: " + args.module + " imports " + ", ".join(loaded) + " at startup")
+        failed = True
+    if import_ms > args.max_ms:
+        print("FAIL: importing " + args.module + " took {0:.1f} ms, more than the {1:.1f} ms allowed".format(import_ms, args.max_ms))
+        failed = True
+    sys.exit(1 if failed else 0)
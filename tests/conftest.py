@@ -0,0 +1,39 @@
+"""
+Test setup: the ARM modules import each other by name from arm/, and load the
+config file named by ARM_CONFIG when config is first imported.  Tests get a
+config file of their own, with the database and every path in a temporary
+directory.
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+ARMDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "arm")
+TMPDIR = tempfile.mkdtemp(prefix="armtest-")
+
+with open(os.path.join(TMPDIR, "arm.yaml"), "w") as config_file:
+    config_file.write("DBFILE: " + os.path.join(TMPDIR, "arm.db") + "\n")
+    config_file.write("LOGPATH: " + os.path.join(TMPDIR, "logs") + "\n")
+os.environ["ARM_CONFIG"] = os.path.join(TMPDIR, "arm.yaml")
+os.environ["ARM_CONFIG_CACHE"] = os.path.join(TMPDIR, "config.cache")
+sys.path.insert(0, ARMDIR)
+
+
+@pytest.fixture
+def set_config(monkeypatch, tmp_path):
+    """
+    Replace the config for one test.  Takes config keys and values; keys that
+    aren't given get their default, except DBFILE, which is a new database in
+    the test's temporary directory.
+    """
+    import config
+
+    def configure(**raw):
+        raw.setdefault('DBFILE', str(tmp_path / "arm.db"))
+        values, unknown = config.compile_config(raw)
+        assert not unknown
+        monkeypatch.setattr(config, "_current", config.Config(values, config.yamlfile, None))
+    return configure
@@ -0,0 +1,132 @@
+import os
+import errno
+import hashlib
+
+import datacopy
+
+from datacopy import SECTOR, NON_TRIED, NON_TRIMMED, BAD_SECTOR, FINISHED, RescueMap
+
+
+def make_disc(path, sectors):
+    """ Write a disc image of random sectors; returns its contents """
+    data = os.urandom(sectors * SECTOR)
+    with open(path, "wb") as f:
+        f.write(data)
+    return data
+
+
+def failing_read_at(bad_sectors, reads):
+    """
+    Stand-in for datacopy.read_at that fails with EIO for reads touching
+    bad_sectors and records every read in reads
+    """
+    def read_at(fd, count, pos):
+        reads.append((pos, count))
+        if any(pos <= s * SECTOR < pos + count for s in bad_sectors):
+            raise OSError(errno.EIO, "Input/output error")
+        return os.pread(fd, count, pos)
+    return read_at
+
+
+def test_set_splits_area():
+    rescue_map = RescueMap(10 * SECTOR)
+    rescue_map.set(2 * SECTOR, 3 * SECTOR, FINISHED)
+    assert rescue_map.blocks == [[0, 2 * SECTOR, NON_TRIED], [2 * SECTOR, 3 * SECTOR, FINISHED],
+                                 [5 * SECTOR, 5 * SECTOR, NON_TRIED]]
+
+
+def test_set_merges_neighbours():
+    rescue_map = RescueMap(10 * SECTOR)
+    rescue_map.set(2 * SECTOR, 3 * SECTOR, FINISHED)
+    rescue_map.set(5 * SECTOR, 1 * SECTOR, FINISHED)
+    rescue_map.set(0, 2 * SECTOR, FINISHED)
+    assert rescue_map.blocks == [[0, 6 * SECTOR, FINISHED], [6 * SECTOR, 4 * SECTOR, NON_TRIED]]
+    rescue_map.set(6 * SECTOR, 4 * SECTOR, FINISHED)
+    assert rescue_map.blocks == [[0, 10 * SECTOR, FINISHED]]
+
+
+def test_set_across_several_areas():
+    rescue_map = RescueMap(10 * SECTOR)
+    rescue_map.set(1 * SECTOR, 1 * SECTOR, BAD_SECTOR)
+    rescue_map.set(3 * SECTOR, 1 * SECTOR, NON_TRIMMED)
+    rescue_map.set(0, 5 * SECTOR, FINISHED)
+    assert rescue_map.blocks == [[0, 5 * SECTOR, FINISHED], [5 * SECTOR, 5 * SECTOR, NON_TRIED]]
+    assert rescue_map.finished() == 5 * SECTOR
+
+
+def test_mapfile_round_trip(tmp_path):
+    mapfile = str(tmp_path / "disc.map")
+    rescue_map = RescueMap(10 * SECTOR)
+    rescue_map.set(0, 4 * SECTOR, FINISHED)
+    rescue_map.set(4 * SECTOR, 1 * SECTOR, BAD_SECTOR)
+    rescue_map.save(mapfile)
+
+    loaded = RescueMap.load(mapfile, 0)
+    assert loaded.size == 10 * SECTOR
+    assert loaded.blocks == rescue_map.blocks
+
+
+def test_rescue_image_bad_sectors(tmp_path, monkeypatch):
+    src = str(tmp_path / "disc.iso")
+    dest = str(tmp_path / "image.iso")
+    mapfile = str(tmp_path / "image.map")
+    data = make_disc(src, 64)
+    reads = []
+    monkeypatch.setattr(datacopy, "read_at", failing_read_at([10, 11], reads))
+
+    result = datacopy.rescue_image(src, dest, mapfile, hashes=["md5"], blocksize=8 * SECTOR, retries=1)
+
+    assert result['bad'] == 2 * SECTOR
+    assert result['bytes'] == 62 * SECTOR
+    # no checksum of an incomplete image
+    assert result['hashes'] == {}
+    with open(dest, "rb") as f:
+        image = f.read()
+    assert image[:10 * SECTOR] == data[:10 * SECTOR]
+    assert image[10 * SECTOR:12 * SECTOR] == bytes(2 * SECTOR)
+    assert image[12 * SECTOR:] == data[12 * SECTOR:]
+    # the sectors around the bad ones were trimmed down to single sectors
+    assert RescueMap.load(mapfile, 0).blocks == [[0, 10 * SECTOR, FINISHED], [10 * SECTOR, 2 * SECTOR, BAD_SECTOR],
+                                                 [12 * SECTOR, 52 * SECTOR, FINISHED]]
+
+
+def test_rescue_image_resumes_from_mapfile(tmp_path, monkeypatch):
+    src = str(tmp_path / "disc.iso")
+    dest = str(tmp_path / "image.iso")
+    mapfile = str(tmp_path / "image.map")
+    data = make_disc(src, 64)
+    reads = []
+    monkeypatch.setattr(datacopy, "read_at", failing_read_at([20], reads))
+    datacopy.rescue_image(src, dest, mapfile, blocksize=8 * SECTOR, retries=0)
+
+    # the sector can be read the second time; only it is read again
+    reads = []
+    monkeypatch.setattr(datacopy, "read_at", failing_read_at([], reads))
+    hashed = []
+    hash_file = datacopy.hash_file
+    monkeypatch.setattr(datacopy, "hash_file", lambda path, hashes, blocksize: hashed.append(blocksize) or hash_file(path, hashes, blocksize))
+    result = datacopy.rescue_image(src, dest, mapfile, hashes=["md5"], blocksize=8 * SECTOR, retries=1)
+
+    assert reads == [(20 * SECTOR, SECTOR)]
+    assert result['bad'] == 0
+    assert result['hashes'] == {'md5': hashlib.md5(data).hexdigest()}
+    # hashed with the block size asked for, not the one sector of the last pass
+    assert hashed == [8 * SECTOR]
+    with open(dest, "rb") as f:
+        assert f.read() == data
+    assert RescueMap.load(mapfile, 0).blocks == [[0, 64 * SECTOR, FINISHED]]
+
+
+def test_rescue_image_single_sector_blocks(tmp_path, monkeypatch):
+    src = str(tmp_path / "disc.iso")
+    dest = str(tmp_path / "image.iso")
+    mapfile = str(tmp_path / "image.map")
+    make_disc(src, 16)
+    monkeypatch.setattr(datacopy, "read_at", failing_read_at([5], []))
+
+    result = datacopy.rescue_image(src, dest, mapfile, hashes=["md5"], blocksize=SECTOR, retries=0)
+
+    assert result['bad'] == SECTOR
+    assert result['hashes'] == {}
+    assert RescueMap.load(mapfile, 0).blocks == [[0, 5 * SECTOR, FINISHED], [5 * SECTOR, SECTOR, BAD_SECTOR],
+                                                 [6 * SECTOR, 10 * SECTOR, FINISHED]]
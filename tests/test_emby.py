@@ -0,0 +1,115 @@
+import json
+import time
+import threading
+import http.server
+
+import pytest
+
+import emby
+
+EMBY_CONFIG = dict(EMBY_REFRESH=True, EMBY_SERVER="127.0.0.1", EMBY_API_KEY="key", EMBY_MAX_PATHS=2,
+                   MEDIA_DIR="/home/arm/media", EMBY_MEDIA_DIR="/emby/media")
+
+
+class StubEmby(http.server.HTTPServer):
+    """
+    Emby server answering every request with the status set for its path in
+    statuses (200 by default) and recording the requests it got
+    """
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.statuses = {}
+        self.requests = []
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        path, _, query = self.path.partition("?")
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self.server.requests.append((path, query, json.loads(body.decode()) if body else None))
+        self.send_response(self.server.statuses.get(path, 200))
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(set_config):
+    stub = StubEmby()
+    thread = threading.Thread(target=stub.serve_forever, kwargs={"poll_interval": 0.05})
+    thread.start()
+    set_config(EMBY_PORT=stub.server_address[1], **EMBY_CONFIG)
+    yield stub
+    stub.shutdown()
+    stub.server_close()
+    thread.join()
+
+
+def queued():
+    """ Paths waiting in the update queue """
+    conn = emby.db.connect(emby.SCHEMA)
+    paths = sorted(r['path'] for r in conn.execute("SELECT path FROM emby_updates"))
+    conn.close()
+    return paths
+
+
+def test_dispatch_waits_for_quiet_queue(server):
+    emby.queue(["/home/arm/media/movies/A (2001)"])
+    assert not emby.dispatch(60)
+    assert server.requests == []
+    assert queued() == ["/home/arm/media/movies/A (2001)"]
+
+
+def test_dispatch_sends_paths_in_one_update(server):
+    emby.queue(["/home/arm/media/movies/A (2001)"])
+    emby.queue(["/home/arm/media/movies/B (2002)"])
+    assert emby.dispatch(0)
+    assert server.requests == [("/Library/Media/Updated", "api_key=key",
+                                {'Updates': [{'Path': "/emby/media/movies/A (2001)", 'UpdateType': "Created"},
+                                             {'Path': "/emby/media/movies/B (2002)", 'UpdateType': "Created"}]})]
+    assert queued() == []
+
+
+def test_dispatch_refreshes_when_update_fails(server):
+    server.statuses["/Library/Media/Updated"] = 404
+    emby.queue(["/home/arm/media/movies/A (2001)"])
+    assert emby.dispatch(0)
+    assert [r[0] for r in server.requests] == ["/Library/Media/Updated", "/Library/Refresh"]
+    assert queued() == []
+
+
+def test_dispatch_refreshes_for_unknown_or_many_paths(server):
+    emby.queue()
+    emby.queue(["/home/arm/media/movies/A (2001)"])
+    assert emby.dispatch(0)
+    emby.queue(["/a", "/b", "/c"])
+    assert emby.dispatch(0)
+    assert [r[0] for r in server.requests] == ["/Library/Refresh", "/Library/Refresh"]
+
+
+def test_dispatch_keeps_queue_when_refresh_fails(server):
+    server.statuses["/Library/Refresh"] = 500
+    emby.queue()
+    assert not emby.dispatch(0)
+    assert queued() == [emby.FULL_REFRESH]
+
+    del server.statuses["/Library/Refresh"]
+    assert emby.dispatch(0)
+    assert queued() == []
+
+
+def test_flush_waits_for_quiet_queue(server, set_config):
+    set_config(EMBY_PORT=server.server_address[1], EMBY_DEBOUNCE_SECONDS=0.3, **EMBY_CONFIG)
+    emby.queue(["/home/arm/media/movies/A (2001)"])
+    start = time.time()
+    emby.flush()
+    assert time.time() - start >= 0.25
+    assert [r[0] for r in server.requests] == ["/Library/Media/Updated"]
+    assert queued() == []
+    # nothing left to send
+    emby.flush()
+    assert len(server.requests) == 1
@@ -0,0 +1,31 @@
+import os
+import stat
+import time
+
+import utils
+
+
+def mode(path):
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+
+def test_apply_permissions_new_file_in_old_directory(tmp_path):
+    old_dir = tmp_path / "Title (2001)" / "extras" / "featurettes"
+    old_dir.mkdir(parents=True)
+    old_file = old_dir / "old.mkv"
+    old_file.write_bytes(b"old")
+    os.chmod(str(old_file), 0o600)
+    time.sleep(0.01)
+
+    since = time.time()
+    new_file = old_dir / "new.mkv"
+    new_file.write_bytes(b"new")
+    os.chmod(str(new_file), 0o600)
+
+    counts = utils.apply_permissions(str(tmp_path / "Title (2001)"), 0o775, -1, -1, since)
+
+    assert mode(str(new_file)) == 0o775
+    # files from before the job are left alone
+    assert mode(str(old_file)) == 0o600
+    assert counts['old'] == 1
+    assert counts['errors'] == 0
@@ -20,6 +20,10 @@ Thanks to derex99 for the disc favicon
 from http.server import BaseHTTPRequestHandler, HTTPServer
 # import SocketServer
 import os
+import time
+import json
+import datetime
+import sqlite3
 import subprocess
 
 
@@ -44,6 +48,31 @@ def getsize(path):
     freegb = free/1073741824
     return freegb
 
+def getjobs():
+    if not os.path.exists(cfg['DBFILE']):
+        return []
+    conn = sqlite3.connect(cfg['DBFILE'], timeout=30)
+    conn.row_factory = sqlite3.Row
+    try:
+        return conn.execute("SELECT * FROM jobs ORDER BY job_id DESC LIMIT 50").fetchall()
+    except sqlite3.OperationalError:
+        return []
+    finally:
+        conn.close()
+
+def getprogress(job):
+    if job['status'] != "running" or 'progress' not in job.keys() or not job['progress']:
+        return ""
+    event = json.loads(job['progress'])
+    progress = event.get('description', "") + " " + event.get('operation', "")
+    if event.get('percent') is not None:
+        progress += " " + str(event['percent']) + "%"
+    if event.get('track') is not None:
+        progress += " track " + str(event['track'])
+    if event.get('eta') is not None:
+        progress += " ETA " + str(datetime.timedelta(seconds=event['eta']))
+    return progress.strip()
+
 class S(BaseHTTPRequestHandler):
     def _set_headers(self):
         self.send_response(200)
@@ -53,15 +82,14 @@ class S(BaseHTTPRequestHandler):
     def info(self):
         freeraw = getsize(RAWPATH)
         freearm = getsize(ARMPATH)
-        output = subprocess.check_output("atq | perl -lane 'print $F[0]'", shell=True)
-        list = sorted(output.split(), key=str, reverse=True)
         self.wfile.write("<html><head><title>ARM Status</title><meta http-equiv=\"refresh\" content=\"60\"><style>table {font-family: arial, sans-serif;border-collapse: collapse;width: 100%;}td, th {border: 1px solid #dddddd;text-align: left;padding: 8px;}tr:nth-child(even) {background-color: \#dddddd;}</style></head><body><h1>Disk Info</h1>".encode("utf-8"))
         self.wfile.write(("<h2>" + str(freeraw) + " GB free for ripping</h2>").encode("utf-8"))
         self.wfile.write(("<h2>" + str(freearm) + " GB free for transcoding</h2>").encode("utf-8"))
-        self.wfile.write("<html><body><h1>Queue Items</h1><table><tr><th>Queue Number</th><th>Command</th></tr>".encode("utf-8"))
-        for line in list:
-            item = subprocess.check_output("at -c {0} | tail -n 2".format(line), shell=True)
-            self.wfile.write(("<tr><td>" + line + "</td><td>" + item + "</td></tr>").encode("utf-8"))
+        self.wfile.write("<h1>Jobs</h1><table><tr><th>Job</th><th>Drive</th><th>Status</th><th>Stage</th><th>Progress</th><th>Updated</th></tr>".encode("utf-8"))
+        for job in getjobs():
+            self.wfile.write(("<tr><td>" + str(job['job_id']) + "</td><td>" + job['devpath'] + "</td><td>" + job['status'] + "</td><td>" +
+                              job['stage'] + "</td><td>" + getprogress(job) + "</td><td>" + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(job['updated'])) +
+                              "</td></tr>").encode("utf-8"))
         self.wfile.write("</table></body></html>".encode("utf-8"))
 
     def do_GET(self):